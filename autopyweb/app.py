@@ -1,11 +1,13 @@
 # -*- coding: utf-8 -*-
 #
-import os
+import asyncio
 import sys
+import time
+from functools import partial
 from os import path
 from sanic import Sanic  # type: ignore
-from sanic.exceptions import SanicException, ServerError  # type: ignore
-from sanic.response import text, json  # type: ignore
+from sanic.exceptions import NotFound, SanicException  # type: ignore
+from sanic.response import json, file, HTTPResponse  # type: ignore
 from typing import Optional
 
 if __name__ == "__main__":
@@ -21,7 +23,19 @@ if __name__ == "__main__":
     )
     sys.exit(1)
 
-from .functions import get_git_projects, add_git_project, setup_python_project  # noqa: E402
+from . import config  # noqa: E402
+from .capacity import capacity  # noqa: E402
+from .deployments import deployments, FILTERS as DEPLOYMENT_FILTERS  # noqa: E402
+from .functions import deploy_git_project, deploy_git_projects, rollback_project  # noqa: E402
+from .garbage import garbage_collector  # noqa: E402
+from .jobs import job_queue  # noqa: E402
+from .metrics import registry  # noqa: E402
+from .releases import release_store  # noqa: E402
+from .supervisor import supervisor  # noqa: E402
+from .tracing import TRACE_FILE  # noqa: E402
+from .usage import usage_collector  # noqa: E402
+from .venvs import venv_pool  # noqa: E402
+from .wheelhouse import wheelhouse  # noqa: E402
 
 app = Sanic(__name__)
 app.config["RESPONSE_TIMEOUT"] = 318  # (two seconds before Gunicorn worker times out)
@@ -42,75 +56,363 @@ class InvalidParameter(SanicException):
         super(InvalidParameter, self).__init__(message, 400)
 
 
-def wrap_exception(exc):
-    if isinstance(exc, SanicException):
-        return exc
-    args = getattr(exc, "args", [])
-    message = repr(exc)
-    if args:
-        try:
-            next_line = str(args[0])
-            message = message + "\n" + next_line
-        except IndexError:
-            pass
-        try:
-            next_line = args[1]
-            message = message + "\n" + next_line
-        except IndexError:
-            pass
-    return ServerError(message=message)
+@app.listener("after_server_start")
+async def prepopulate_wheelhouse(app, loop):
+    if not config.WHEELHOUSE_PREPOPULATE:
+        return
+    # Off the event loop, so the server can answer requests while the toolchain wheels download
+    loop.run_in_executor(None, wheelhouse.prepopulate)
+
+
+@app.listener("after_server_start")
+async def fill_venv_pool(app, loop):
+    venv_pool.refill_async()
+
+
+@app.listener("after_server_start")
+async def start_usage_collector(app, loop):
+    usage_collector.start()
+
+
+@app.listener("after_server_start")
+async def start_garbage_collector(app, loop):
+    garbage_collector.start()
 
 
 @app.route("/list")
 async def list(request):
-    projs = get_git_projects(path.dirname(os.getcwd()))
-    for proj in projs:
-        print(proj.active_branch)
-    return text("ok", 200)
+    filters = {k: next(iter(request.args.getlist(k, [None]))) for k in DEPLOYMENT_FILTERS}
+    try:
+        limit = int(next(iter(request.args.getlist("limit", [50]))))
+        offset = int(next(iter(request.args.getlist("offset", [0]))))
+        assert limit >= 0 and offset >= 0
+    except (ValueError, AssertionError):
+        raise InvalidParameter("limit and offset must be whole numbers")
+    loop = asyncio.get_event_loop()
+    rows, total = await loop.run_in_executor(None, partial(deployments.list, limit=limit, offset=offset, **filters))
+    next_offset = offset + len(rows)
+    return json(
+        {
+            "deployments": rows,
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "next_offset": next_offset if next_offset < total else None,
+        }
+    )
 
 
-@app.post("/add")
-async def add(request):
-    origin_endpoint = next(iter(request.args.getlist("origin", [None])))
+def deployment_usage(name, limit=None):
+    # A deployment's usage is that of its live release's app
+    row = deployments.get(name)
+    process = path.basename(row["live_release"]) if row is not None and row.get("live_release", None) else name
+    samples = usage_collector.samples(process, limit=limit)
+    if samples is None:
+        return None
+    return {
+        "name": name,
+        "process": process,
+        "interval": usage_collector.interval,
+        "latest": samples[-1] if samples else None,
+        "peak": {f: max(s[f] for s in samples) for f in ("cpu", "rss", "fds", "threads")} if samples else None,
+        "samples": samples,
+    }
+
+
+@app.route("/deployments/<name>/usage")
+async def usage_status(request, name):
+    try:
+        limit = next(iter(request.args.getlist("limit", [None])))
+        limit = None if limit is None else int(limit)
+        assert limit is None or limit > 0
+    except (ValueError, AssertionError):
+        raise InvalidParameter("limit must be a whole number")
+    loop = asyncio.get_event_loop()
+    found = await loop.run_in_executor(None, partial(deployment_usage, path.basename(name), limit=limit))
+    if found is None:
+        raise NotFound("Usage not found: {}".format(str(name)))
+    return json(found)
+
+
+@app.route("/usage")
+async def usage_totals(request):
+    loop = asyncio.get_event_loop()
+    return json(await loop.run_in_executor(None, usage_collector.latest))
+
+
+def parse_deploy_params(get, prefix=""):
+    """
+    Validate the parameters of one deploy.
+    :param get: called with a parameter name and its default, returns the parameter
+    :param prefix: put in front of parameter names in error messages
+    :return: the origin, the keyword arguments for deploy_git_project, and the debounce window
+    :rtype: tuple
+    """
+    origin_endpoint = get("origin", None)
     if origin_endpoint is None:
-        raise MissingParameter("origin")
-    maybe_tag = next(iter(request.args.getlist("tag", [None])))
-    maybe_branch = next(iter(request.args.getlist("branch", [None])))
-    maybe_commit = next(iter(request.args.getlist("commit", [None])))
-    maybe_dirname = next(iter(request.args.getlist("dirname", [None])))
-    maybe_update = next(iter(request.args.getlist("update", [False])))
+        raise MissingParameter(prefix + "origin")
+    maybe_tag = get("tag", None)
+    maybe_branch = get("branch", None)
+    maybe_commit = get("commit", None)
+    maybe_dirname = get("dirname", None)
+    maybe_update = get("update", False)
     do_update = maybe_update in TRUTHS
+    maybe_depth = get("depth", None)
+    maybe_filter = get("filter", None)
+    maybe_debounce = get("debounce", config.DEBOUNCE_WINDOW)
+    if maybe_depth is not None:
+        try:
+            maybe_depth = int(maybe_depth)
+            assert maybe_depth >= 0
+        except (ValueError, AssertionError):
+            raise InvalidParameter(prefix + "depth must be a whole number")
+    try:
+        maybe_debounce = float(maybe_debounce)
+        assert maybe_debounce >= 0
+    except (ValueError, AssertionError):
+        raise InvalidParameter(prefix + "debounce must be a number of seconds")
 
     if not any({maybe_tag, maybe_branch, maybe_commit}):
-        raise MissingParameter("tag or branch or commit")
+        raise MissingParameter(prefix + "tag or branch or commit")
     elif all({maybe_tag, maybe_branch, maybe_commit}):
-        raise InvalidParameter("Cannot have all three tag and branch and commit parameters")
+        raise InvalidParameter(prefix + "Cannot have all three tag and branch and commit parameters")
     elif all({maybe_tag, maybe_branch}):
-        raise InvalidParameter("Cannot have both tag and branch parameters")
+        raise InvalidParameter(prefix + "Cannot have both tag and branch parameters")
     elif all({maybe_branch, maybe_commit}):
-        raise InvalidParameter("Cannot have both branch and commit parameters")
+        raise InvalidParameter(prefix + "Cannot have both branch and commit parameters")
     elif all({maybe_commit, maybe_tag}):
-        raise InvalidParameter("Cannot have both commit and tag parameters")
+        raise InvalidParameter(prefix + "Cannot have both commit and tag parameters")
     kwargs = {
         "tag": maybe_tag,
         "branch": maybe_branch,
         "commit": maybe_commit,
         "dirname": maybe_dirname,
         "do_update": do_update,
+        "depth": maybe_depth,
+        "blob_filter": maybe_filter,
     }
+    return origin_endpoint, kwargs, maybe_debounce
+
+
+@app.post("/add")
+async def add(request):
+    origin_endpoint, kwargs, maybe_debounce = parse_deploy_params(
+        lambda name, default: next(iter(request.args.getlist(name, [default])))
+    )
+    params = dict(kwargs, origin=origin_endpoint)
+    # The same deploy requested again while it runs, say by a repeated webhook, attaches to the running job.
+    # A branch moves, so pushes to it are debounced, and a push after its deploy has fetched supersedes that deploy
+    key = "\n".join(
+        str(v) for v in (origin_endpoint, kwargs["tag"], kwargs["branch"], kwargs["commit"], kwargs["dirname"])
+    )
+    debounce = maybe_debounce if kwargs["branch"] is not None else None
+    record, attached = job_queue.submit_once(
+        key, "add", deploy_project, config.DEPLOY_LOCATION, origin_endpoint, params=params, debounce=debounce, **kwargs
+    )
+    return json(
+        {
+            "job_id": record["id"],
+            "state": record["state"],
+            "status": "/jobs/{}".format(record["id"]),
+            "attached": attached,
+        },
+        status=202,
+    )
+
+
+@app.post("/add/batch")
+async def add_batch(request):
+    """
+    Deploy many refs at once, like the branches of review environments. Takes a JSON list of deploys,
+    each with the parameters of /add, or an object with that list under "deployments".
+    Each origin is fetched once for all of its refs.
+    """
+    body = request.json
+    if isinstance(body, dict):
+        body = body.get("deployments", None)
+    if not isinstance(body, (list, tuple)) or not body:
+        raise MissingParameter("deployments")
+    specs = []
+    for i, item in enumerate(body):
+        if not isinstance(item, dict):
+            raise InvalidParameter("deployments[{:d}] must be an object".format(i))
+        origin_endpoint, kwargs, _ = parse_deploy_params(item.get, prefix="deployments[{:d}].".format(i))
+        specs.append(dict(kwargs, origin=origin_endpoint))
+    job = job_queue.submit("add_batch", deploy_batch, config.DEPLOY_LOCATION, specs, params={"deployments": specs})
+    return json({"job_id": job.id, "state": job.state, "status": "/jobs/{}".format(job.id)}, status=202)
+
+
+def deploy_batch(job, location, specs):
+    """
+    Deploy a batch, run in the background by the job queue.
+    :return: how many of the deploys succeeded, and the result and timings of each
+    :rtype: dict
+    """
+    started = time.time()
+    results = deploy_git_projects(location, specs, job=job)
+    return {
+        "succeeded": len([r for r in results if r["state"] == "succeeded"]),
+        "failed": len([r for r in results if r["state"] != "succeeded"]),
+        "duration": time.time() - started,
+        "deployments": results,
+    }
+
+
+def deploy_project(job, location, origin_endpoint, **kwargs):
+    """
+    The deployment pipeline, run in the background by the job queue.
+    :param job: the job to record stage timings against
+    :type job: autopyweb.jobs.Job
+    :return: the deployed link and release, and how long the app took to become ready
+    :rtype: dict
+    """
+    print("Deploying git project: {}".format(str(origin_endpoint)))
+    ctx = deploy_git_project(location, origin_endpoint, job=job, **kwargs)
+    print("Done deploying project: {}".format(str(ctx["switch"])))
+    readiness = ctx.get("ready", None) or {}
+    return {
+        "link": ctx["switch"],
+        "release": ctx["checkout"],
+        "time_to_ready": readiness.get("time_to_ready", None),
+        "readiness": readiness,
+    }
+
+
+def release_record(name):
+    link_path = path.join(config.DEPLOY_LOCATION, path.basename(name))
+    if not path.islink(link_path):
+        return None
+    return release_store.get(link_path)
+
+
+@app.route("/releases/<name>")
+async def release_status(request, name):
+    loop = asyncio.get_event_loop()
+    record = await loop.run_in_executor(None, release_record, name)
+    if record is None:
+        raise NotFound("Release not found: {}".format(str(name)))
+    return json(record)
+
+
+@app.route("/releases/<name>/trace")
+async def release_trace(request, name):
+    trace_file = path.join(config.DEPLOY_LOCATION, path.basename(name), TRACE_FILE)
+    if not path.isfile(trace_file):
+        raise NotFound("Trace not found: {}".format(str(name)))
+    return await file(trace_file, mime_type="application/json")
+
+
+@app.post("/releases/<name>/rollback")
+async def rollback(request, name):
+    if not path.islink(path.join(config.DEPLOY_LOCATION, path.basename(name))):
+        raise NotFound("Release not found: {}".format(str(name)))
+    job = job_queue.submit("rollback", rollback_release, config.DEPLOY_LOCATION, name, params={"name": name})
+    return json({"job_id": job.id, "state": job.state, "status": "/jobs/{}".format(job.id)}, status=202)
+
+
+def rollback_release(job, location, name):
+    with job.run_stage("rollback"):
+        return rollback_project(location, name)
+
+
+@app.route("/jobs")
+async def jobs(request):
     try:
-        print("adding git project to filesystem: {}".format(str(origin_endpoint)))
-        project_path = add_git_project(path.dirname(os.getcwd()), origin_endpoint, **kwargs)
-        print("finished add git project: {}".format(str(origin_endpoint)))
-    except Exception as e:
-        raise wrap_exception(e)
-    try:
-        print("Setting up project: {}".format(str(project_path)))
-        success = setup_python_project(project_path)
-        print("Done set up project.")
-    except Exception as e:
-        raise wrap_exception(e)
-    return json({"success": success})
+        limit = int(next(iter(request.args.getlist("limit", [50]))))
+        offset = int(next(iter(request.args.getlist("offset", [0]))))
+        assert limit >= 0 and offset >= 0
+    except (ValueError, AssertionError):
+        raise InvalidParameter("limit and offset must be whole numbers")
+    loop = asyncio.get_event_loop()
+    records, total = await loop.run_in_executor(None, partial(job_queue.list, limit=limit, offset=offset))
+    next_offset = offset + len(records)
+    return json(
+        {
+            "jobs": records,
+            "total": total,
+            "limit": limit,
+            "offset": offset,
+            "next_offset": next_offset if next_offset < total else None,
+        }
+    )
+
+
+@app.route("/jobs/<job_id>")
+async def job_status(request, job_id):
+    loop = asyncio.get_event_loop()
+    record = await loop.run_in_executor(None, job_queue.get, job_id)
+    if record is None:
+        raise NotFound("Job not found: {}".format(str(job_id)))
+    return json(record)
+
+
+@app.route("/jobs/<job_id>/trace")
+async def job_trace(request, job_id):
+    trace_file = path.join(config.TRACE_DIR, "{}.json".format(path.basename(job_id)))
+    if not path.isfile(trace_file):
+        raise NotFound("Trace not found: {}".format(str(job_id)))
+    return await file(trace_file, mime_type="application/json")
+
+
+@app.route("/metrics")
+async def metrics(request):
+    # Merges the snapshots every worker writes to the state dir
+    loop = asyncio.get_event_loop()
+    body = await loop.run_in_executor(None, registry.render)
+    return HTTPResponse(body, content_type="text/plain; version=0.0.4; charset=utf-8")
+
+
+@app.route("/capacity")
+async def capacity_status(request):
+    loop = asyncio.get_event_loop()
+    return json(await loop.run_in_executor(None, capacity.status))
+
+
+@app.post("/capacity/rebalance")
+async def rebalance(request):
+    loop = asyncio.get_event_loop()
+    changes = await loop.run_in_executor(None, capacity.rebalance)
+    return json({"changes": changes})
+
+
+@app.route("/gc")
+async def gc_status(request):
+    # What a collection would evict now
+    loop = asyncio.get_event_loop()
+    return json(await loop.run_in_executor(None, partial(garbage_collector.collect, dry_run=True)))
+
+
+@app.post("/gc")
+async def gc(request):
+    job = job_queue.submit("gc", collect_garbage)
+    return json({"job_id": job.id, "state": job.state, "status": "/jobs/{}".format(job.id)}, status=202)
+
+
+def collect_garbage(job):
+    with job.run_stage("gc"):
+        return garbage_collector.collect()
+
+
+@app.route("/venvs/pool")
+async def venv_pool_status(request):
+    # Claims are counted by this worker, autopyweb_cache_requests_total{cache="venv_pool"} counts the whole host
+    loop = asyncio.get_event_loop()
+    return json(await loop.run_in_executor(None, venv_pool.stats))
+
+
+@app.route("/processes")
+async def processes(request):
+    loop = asyncio.get_event_loop()
+    return json({"processes": await loop.run_in_executor(None, supervisor.list)})
+
+
+@app.route("/processes/<name>")
+async def process_status(request, name):
+    loop = asyncio.get_event_loop()
+    record = await loop.run_in_executor(None, supervisor.get, name)
+    if record is None:
+        raise NotFound("Process not found: {}".format(str(name)))
+    return json(record)
 
 
 def run(host: Optional[str] = None, port: Optional[int] = None, debug: bool = False, **kwargs):
@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Sizes the gunicorn workers and threads of every app on the host together, so they share its cores and memory.
+The host's budget of workers is the smaller of its cores times WORKERS_PER_CORE and its memory budget divided
+by the memory of one worker. Each app gets at least one worker, and the rest of the budget is shared out by
+weight, which is the app's priority times one plus the cores it was last seen using, from autopyweb.usage.
+Sync (WSGI) workers each get SYNC_THREADS threads, async workers (sanic, tornado and the like) serve many
+requests each and get one thread.
+An app whose gunicorn.conf.py sets `workers` keeps that, and takes it out of the budget for the others.
+Running apps are resized with gunicorn's TTIN and TTOU signals, which add or remove one worker each.
+The size of each app is also written to `gunicorn.workers` in its release, which its run.sh reads, so an app
+restarted by the supervisor keeps its size.
+"""
+import json
+import os
+import signal
+import threading
+import time
+from os import path
+
+from . import config
+from .locks import FileLock
+from .supervisor import supervisor, LIVE_STATES
+from .usage import usage_collector
+
+SYNC = "sync"
+ASYNC = "async"
+
+# gunicorn worker classes whose workers each serve many requests at once
+ASYNC_WORKER_CLASSES = ("sanic.worker", "tornado", "uvicorn", "aiohttp", "gevent", "eventlet", "meinheld")
+
+WORKERS_FILE = "gunicorn.workers"
+
+# Seconds between the signals to a gunicorn master, so the kernel doesn't merge them into one
+SIGNAL_INTERVAL = 0.1
+
+_clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+
+
+def worker_kind(worker_class):
+    """
+    :param worker_class: gunicorn worker class, None for its default sync worker
+    :return: SYNC or ASYNC
+    """
+    if worker_class and any(str(worker_class).startswith(c) for c in ASYNC_WORKER_CLASSES):
+        return ASYNC
+    return SYNC
+
+
+def host_memory():
+    """
+    :return: bytes of memory of the host, None if unknown
+    """
+    try:
+        with open("/proc/meminfo", "r") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _stat_fields(pid):
+    with open("/proc/{:d}/stat".format(pid), "r") as f:
+        # The command name is in brackets and may contain spaces
+        return f.read().rsplit(")", 1)[1].split()
+
+
+def cpu_seconds(pid):
+    """
+    CPU time used by a process, its live children and the children it has waited on.
+    :return: seconds, None if the process is gone
+    """
+    try:
+        fields = _stat_fields(pid)
+    except (OSError, IndexError):
+        return None
+    # utime, stime, cutime and cstime, counted from the state field
+    ticks = sum(int(f) for f in fields[11:15])
+    for child in os.listdir("/proc"):
+        if not child.isdigit():
+            continue
+        try:
+            child_fields = _stat_fields(int(child))
+            if int(child_fields[1]) == pid:
+                ticks += int(child_fields[11]) + int(child_fields[12])
+        except (OSError, IndexError, ValueError):
+            continue
+    return ticks / float(_clock_ticks)
+
+
+def read_workers(project_dir, default=1):
+    try:
+        with open(path.join(project_dir, WORKERS_FILE), "r") as f:
+            return int(f.read().strip())
+    except (OSError, ValueError):
+        return default
+
+
+def write_workers(project_dir, workers):
+    workers_file = path.join(project_dir, WORKERS_FILE)
+    tmp_file = "{}.{}-{}.tmp".format(workers_file, os.getpid(), threading.get_ident())
+    with open(tmp_file, "w") as f:
+        f.write("{:d}\n".format(int(workers)))
+    os.replace(tmp_file, workers_file)
+
+
+class CapacityScheduler(object):
+    def __init__(
+        self, state_file=None, cores=None, memory_budget=None, worker_memory=None, workers_per_core=None, grace=None
+    ):
+        """
+        :param state_file: where the apps and their sizes are kept, shared by every autopyweb worker
+        :param cores: cores to share out, defaults to those of the host
+        :param memory_budget: bytes of memory to share out, defaults to a share of the host's
+        :param worker_memory: bytes one gunicorn worker is expected to use
+        :param workers_per_core: workers to run for each core
+        :param grace: seconds an app which was sized but isn't running yet keeps its share, while it is launched
+        """
+        self.state_file = config.CAPACITY_FILE if state_file is None else state_file
+        self.cores = cores or config.HOST_CORES or os.cpu_count() or 1
+        if memory_budget is None:
+            memory_budget = config.HOST_MEMORY_BUDGET
+        if not memory_budget:
+            memory = host_memory()
+            memory_budget = int(memory * config.HOST_MEMORY_SHARE / 100.0) if memory else 0
+        self.memory_budget = memory_budget
+        self.worker_memory = config.WORKER_MEMORY if worker_memory is None else worker_memory
+        self.workers_per_core = config.WORKERS_PER_CORE if workers_per_core is None else workers_per_core
+        self.grace = config.READY_TIMEOUT * 2 if grace is None else grace
+        self._lock = threading.Lock()
+
+    def budget(self):
+        """
+        :return: workers the host can run
+        :rtype: int
+        """
+        budget = max(1, int(self.cores * self.workers_per_core))
+        if self.memory_budget and self.worker_memory:
+            budget = min(budget, max(1, int(self.memory_budget // self.worker_memory)))
+        return budget
+
+    def max_workers(self, kind):
+        # Past this an app gains nothing from more workers, whatever the budget
+        return self.cores if kind == ASYNC else 2 * self.cores + 1
+
+    def threads(self, kind):
+        return 1 if kind == ASYNC else config.SYNC_THREADS
+
+    def targets(self, apps):
+        """
+        Share the budget out between apps.
+        :param apps: dict of app name to app, each with "kind", "priority", "load" and, if pinned, "pinned" workers
+        :return: dict of app name to workers
+        :rtype: dict
+        """
+        targets = {}
+        remaining = self.budget()
+        for name, app in apps.items():
+            if app.get("pinned", None):
+                targets[name] = int(app["pinned"])
+                remaining -= targets[name]
+        scheduled = sorted(n for n in apps.keys() if n not in targets)
+        for name in scheduled:
+            targets[name] = 1
+            remaining -= 1
+        weights = {n: max(0.01, float(apps[n].get("priority", 1))) * (1 + apps[n].get("load", 0)) for n in scheduled}
+        # Hand out the rest one worker at a time, each to the app with the most weight per worker it would have
+        while remaining > 0:
+            growable = [n for n in scheduled if targets[n] < self.max_workers(apps[n]["kind"])]
+            if not growable:
+                break
+            name = max(growable, key=lambda n: weights[n] / (targets[n] + 1))
+            targets[name] += 1
+            remaining -= 1
+        return targets
+
+    def _load(self):
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save(self, apps):
+        os.makedirs(path.dirname(self.state_file), exist_ok=True)
+        tmp_file = "{}.{}-{}.tmp".format(self.state_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(apps, f, indent=1)
+        os.replace(tmp_file, self.state_file)
+
+    def _locked(self):
+        return FileLock("{}.lock".format(self.state_file))
+
+    def _running(self, apps, now):
+        # Forget apps which are no longer running, unless they were only just sized and are being launched
+        running = {}
+        for name, app in apps.items():
+            record = supervisor.get(name)
+            if record is not None and record["state"] in LIVE_STATES and record.get("pid", None):
+                running[name] = dict(app, pid=record["pid"])
+            elif now - app.get("assigned", 0) < self.grace:
+                running[name] = dict(app, pid=None)
+        return running
+
+    def assign(self, name, project_dir, kind, priority=1, pinned=None):
+        """
+        Size a new app, given the apps already running. The others are resized by the next rebalance.
+        :param name: process name of the app
+        :param project_dir: its release directory
+        :param kind: SYNC or ASYNC
+        :param pinned: workers set by the app itself
+        :return: workers and threads for the app
+        :rtype: tuple
+        """
+        now = time.time()
+        with self._lock, self._locked():
+            apps = self._running(self._load(), now)
+            app = apps.get(name, {})
+            app.update(cwd=project_dir, kind=kind, priority=priority, pinned=pinned, assigned=now)
+            apps[name] = app
+            if app.get("pid", None) and app.get("workers", None):
+                # Already running, it is resized by a rebalance
+                workers = app["workers"]
+            else:
+                workers = app["workers"] = self.targets(apps)[name]
+            self._save(apps)
+        write_workers(project_dir, workers)
+        return workers, self.threads(kind)
+
+    def _sample(self, name, app, now):
+        # The usage collector's last minute of samples, if it is collecting, else the cores used since the last
+        # rebalance
+        samples = usage_collector.samples(name, limit=max(1, int(60 // max(1, usage_collector.interval))))
+        if samples and now - samples[-1]["time"] < 2 * usage_collector.interval:
+            app["load"] = round(sum(s["cpu"] for s in samples) / len(samples), 3)
+            return
+        cpu = cpu_seconds(app["pid"]) if app.get("pid", None) else None
+        if cpu is None:
+            return
+        if app.get("cpu", None) is not None and now > app.get("sampled", now) and cpu >= app["cpu"]:
+            app["load"] = round((cpu - app["cpu"]) / (now - app["sampled"]), 3)
+        app["cpu"] = cpu
+        app["sampled"] = now
+
+    def rebalance(self):
+        """
+        Resize every running app to its share of the host, as it stands now.
+        :return: the changes made, each with the app name and its workers before and after
+        :rtype: list
+        """
+        now = time.time()
+        changes = []
+        with self._lock, self._locked():
+            apps = self._running(self._load(), now)
+            for name, app in apps.items():
+                self._sample(name, app, now)
+            targets = self.targets(apps)
+            for name in sorted(apps.keys()):
+                app = apps[name]
+                current = app.get("workers", None) or targets[name]
+                if app["pid"] is not None and targets[name] != current:
+                    self._resize(app["pid"], targets[name] - current)
+                    changes.append({"name": name, "from": current, "to": targets[name]})
+                if app["pid"] is not None or current != targets[name]:
+                    app["workers"] = targets[name]
+                    if path.isdir(app["cwd"]):
+                        write_workers(app["cwd"], targets[name])
+            self._save(apps)
+        return changes
+
+    def _resize(self, pid, delta):
+        sig = signal.SIGTTIN if delta > 0 else signal.SIGTTOU
+        for i in range(abs(delta)):
+            if i:
+                time.sleep(SIGNAL_INTERVAL)
+            try:
+                os.kill(pid, sig)
+            except (ProcessLookupError, PermissionError):
+                return
+
+    def status(self):
+        """
+        :return: the budget, and every app with its size and load
+        :rtype: dict
+        """
+        with self._lock, self._locked():
+            apps = self._running(self._load(), time.time())
+        return {
+            "cores": self.cores,
+            "memory_budget": self.memory_budget,
+            "budget": self.budget(),
+            "apps": [dict(app, name=name) for name, app in sorted(apps.items())],
+        }
+
+
+capacity = CapacityScheduler()
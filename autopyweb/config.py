@@ -0,0 +1,163 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Runtime settings for AutoPyWeb.
+Every setting can be overridden with an environment variable of the same name, prefixed with `AUTOPYWEB_`.
+"""
+import os
+from os import path, environ
+
+
+def _env_str(name, default):
+    return environ.get("AUTOPYWEB_{}".format(name), default)
+
+
+def _env_int(name, default):
+    val = environ.get("AUTOPYWEB_{}".format(name), None)
+    if val is None or not len(val.strip()):
+        return default
+    return int(val)
+
+
+# Where deployed projects are placed. Historically this is the parent directory of the autopyweb checkout.
+DEPLOY_LOCATION = path.abspath(_env_str("LOCATION", path.dirname(os.getcwd())))
+# Where autopyweb keeps its own bookkeeping (job records, caches, etc)
+STATE_DIR = path.abspath(_env_str("STATE_DIR", path.join(DEPLOY_LOCATION, ".autopyweb")))
+
+# Number of deployment jobs which may run at the same time in one autopyweb worker
+MAX_CONCURRENT_DEPLOYS = _env_int("MAX_CONCURRENT_DEPLOYS", 4)
+# Number of deploys which may run at the same time across every autopyweb worker on this host
+MAX_GLOBAL_DEPLOYS = _env_int("MAX_GLOBAL_DEPLOYS", MAX_CONCURRENT_DEPLOYS)
+# Number of deploys of one /add/batch request which may run at the same time
+BATCH_WORKERS = _env_int("BATCH_WORKERS", MAX_CONCURRENT_DEPLOYS)
+# Number of independent stages of one deploy which may run at the same time
+PIPELINE_WORKERS = _env_int("PIPELINE_WORKERS", 3)
+# Number of finished jobs to remember before the oldest are forgotten
+JOB_HISTORY = _env_int("JOB_HISTORY", 200)
+# Trace of each deploy job, in the Chrome trace format. The newest JOB_HISTORY are kept
+TRACE_DIR = path.abspath(_env_str("TRACE_DIR", path.join(STATE_DIR, "traces")))
+
+# Where each autopyweb worker saves its metrics, so /metrics can report on the whole host
+METRICS_DIR = path.abspath(_env_str("METRICS_DIR", path.join(STATE_DIR, "metrics")))
+
+# Records of the supervised gunicorn process of each deployed app
+PROCESS_DIR = path.abspath(_env_str("PROCESS_DIR", path.join(STATE_DIR, "processes")))
+# Seconds an app gets to shut down gracefully after SIGTERM, before it is sent SIGINT
+PROCESS_STOP_TIMEOUT = _env_int("PROCESS_STOP_TIMEOUT", 10)
+# Seconds an app gets to exit after SIGINT, before it is killed
+PROCESS_KILL_TIMEOUT = _env_int("PROCESS_KILL_TIMEOUT", 5)
+# Seconds to wait before restarting a crashed app, doubled for each crash in a row
+PROCESS_RESTART_BACKOFF = _env_int("PROCESS_RESTART_BACKOFF", 1)
+# Most seconds to wait before restarting a crashed app
+PROCESS_RESTART_BACKOFF_MAX = _env_int("PROCESS_RESTART_BACKOFF_MAX", 60)
+# An app which stays up this many seconds is considered healthy, and its count of crashes in a row is reset
+PROCESS_STABLE_AFTER = _env_int("PROCESS_STABLE_AFTER", 30)
+# Stop restarting an app after it crashes this many times in a row (0 to restart it forever)
+PROCESS_START_RETRIES = _env_int("PROCESS_START_RETRIES", 5)
+
+# Seconds a launched app has to accept connections and answer its warm-up requests before its deploy fails
+READY_TIMEOUT = _env_int("READY_TIMEOUT", 60)
+# Comma separated paths requested from a launched app to warm it up, once for each of its workers
+WARMUP_PATHS = _env_str("WARMUP_PATHS", "/")
+# History of the releases behind each dirname link, for rollbacks
+RELEASE_DIR = path.abspath(_env_str("RELEASE_DIR", path.join(STATE_DIR, "releases")))
+# Seconds to keep a replaced release running, so a rollback to it is instant, before it is stopped and removed
+RELEASE_KEEP_WARM = _env_int("RELEASE_KEEP_WARM", 300)
+# Seconds a deploy of a branch waits for more pushes to it before it starts. Pushes which come while it waits
+# are coalesced into it, and a push after that supersedes it, so only the newest commit is launched
+DEBOUNCE_WINDOW = _env_int("DEBOUNCE_WINDOW", 3)
+# Deployment plans, by a hash of each checkout's manifests, so a redeploy skips detecting and resolving it again
+PLAN_DIR = path.abspath(_env_str("PLAN_DIR", path.join(STATE_DIR, "plans")))
+# Number of plans to keep, the least recently saved are forgotten
+PLAN_HISTORY = _env_int("PLAN_HISTORY", 500)
+# Results of running each project's setup.py and gunicorn.conf.py, by a hash of those files
+INTROSPECTION_DIR = path.abspath(_env_str("INTROSPECTION_DIR", path.join(STATE_DIR, "introspection")))
+# Number of worker processes which run project setup.py and gunicorn.conf.py files, outside of the server
+INTROSPECTION_WORKERS = _env_int("INTROSPECTION_WORKERS", 2)
+# Seconds a project's setup.py or gunicorn.conf.py may run before its worker is killed
+INTROSPECTION_TIMEOUT = _env_int("INTROSPECTION_TIMEOUT", 60)
+# Bytes of address space each of those workers may use (0 for no limit)
+INTROSPECTION_MEMORY_LIMIT = _env_int("INTROSPECTION_MEMORY_LIMIT", 1024 * 1024 * 1024)
+# Files each of those workers runs before it is replaced with a fresh one
+INTROSPECTION_MAX_CALLS = _env_int("INTROSPECTION_MAX_CALLS", 50)
+# SQLite registry of every deployment and its latest deploy, behind /list
+REGISTRY_DB = path.abspath(_env_str("REGISTRY_DB", path.join(STATE_DIR, "deployments.sqlite3")))
+
+# Cores to share out between the gunicorn workers of every app, 0 for every core of the host
+HOST_CORES = _env_int("HOST_CORES", 0)
+# Bytes of memory to share out between the gunicorn workers of every app, 0 for HOST_MEMORY_SHARE of the host's
+HOST_MEMORY_BUDGET = _env_int("HOST_MEMORY_BUDGET", 0)
+# Percent of the host's memory to share out, when HOST_MEMORY_BUDGET isn't set
+HOST_MEMORY_SHARE = _env_int("HOST_MEMORY_SHARE", 75)
+# Bytes of memory one gunicorn worker is expected to use
+WORKER_MEMORY = _env_int("WORKER_MEMORY", 128 * 1024 * 1024)
+# gunicorn workers to run for each core, across every app
+WORKERS_PER_CORE = _env_int("WORKERS_PER_CORE", 2)
+# Threads of each sync (WSGI) gunicorn worker. Async workers get one
+SYNC_THREADS = _env_int("SYNC_THREADS", 4)
+# The apps on the host and the workers each was given
+CAPACITY_FILE = path.abspath(_env_str("CAPACITY_FILE", path.join(STATE_DIR, "capacity.json")))
+
+# Resource usage samples of every app's process tree, a ring buffer file for each app
+USAGE_DIR = path.abspath(_env_str("USAGE_DIR", path.join(STATE_DIR, "usage")))
+# Seconds between samples of every app's resource usage (0 to not sample)
+USAGE_INTERVAL = _env_int("USAGE_INTERVAL", 10)
+# Samples kept for each app, the oldest are overwritten
+USAGE_HISTORY = _env_int("USAGE_HISTORY", 360)
+
+# Set to 0 to not compile each release and its venv to bytecode before launching it.
+# A project can opt out with `precompile = False` in its gunicorn.conf.py
+PRECOMPILE = _env_int("PRECOMPILE", 1)
+# Processes used to compile a release, 0 for one for each core
+PRECOMPILE_WORKERS = _env_int("PRECOMPILE_WORKERS", 0)
+
+# Persistent bare mirrors of each origin, so redeploys only fetch new objects
+MIRROR_DIR = path.abspath(_env_str("MIRROR_DIR", path.join(STATE_DIR, "mirrors")))
+# Evict least recently used mirrors when the store grows past this many bytes (0 for no limit)
+MIRROR_MAX_BYTES = _env_int("MIRROR_MAX_BYTES", 20 * 1024 * 1024 * 1024)
+# Evict mirrors not used for this many seconds (0 for no limit)
+MIRROR_MAX_AGE = _env_int("MIRROR_MAX_AGE", 30 * 24 * 60 * 60)
+# Seconds to wait for another deploy to finish with a mirror
+MIRROR_LOCK_TIMEOUT = _env_int("MIRROR_LOCK_TIMEOUT", 600)
+
+# How each deployed commit is checked out of its mirror.
+# "worktree" shares the mirror's object store, "clone" gives each checkout its own copy.
+CHECKOUT_MODE = _env_str("CHECKOUT_MODE", "worktree")
+
+# Commits of history to fetch for a deploy, 0 fetches the full history of the requested ref
+FETCH_DEPTH = _env_int("FETCH_DEPTH", 0)
+# Partial clone filter for fetches, eg "blob:none" to fetch file contents only when a checkout needs them
+FETCH_FILTER = _env_str("FETCH_FILTER", "")
+
+# Interpreter used to build project virtualenvs
+PYTHON = _env_str("PYTHON", "/usr/bin/python3")
+# Store of virtualenvs shared between deployments with the same requirements
+VENV_DIR = path.abspath(_env_str("VENV_DIR", path.join(STATE_DIR, "venvs")))
+# Keep a venv which no deployment uses for this many seconds before removing it, in case it is needed again
+VENV_GC_AGE = _env_int("VENV_GC_AGE", 24 * 60 * 60)
+# Seconds to wait for another deploy to finish building a venv
+VENV_LOCK_TIMEOUT = _env_int("VENV_LOCK_TIMEOUT", 1800)
+# Base venvs with the toolchain preinstalled, kept ready for deploys which need a new venv
+VENV_POOL_DIR = path.abspath(_env_str("VENV_POOL_DIR", path.join(STATE_DIR, "venv-pool")))
+# Number of ready venvs to keep in the pool for each flavor (0 disables the pool)
+VENV_POOL_SIZE = _env_int("VENV_POOL_SIZE", 2)
+
+# Wheels shared by every deployment, fed to pip with --find-links
+WHEELHOUSE_DIR = path.abspath(_env_str("WHEELHOUSE_DIR", path.join(STATE_DIR, "wheelhouse")))
+# pip's own http and wheel build cache, shared by every deployment
+PIP_CACHE_DIR = path.abspath(_env_str("PIP_CACHE_DIR", path.join(STATE_DIR, "pip-cache")))
+# Set to 1 to install only from the wheelhouse, never from a package index
+WHEELHOUSE_OFFLINE = _env_int("WHEELHOUSE_OFFLINE", 0)
+# Set to 0 to not fill the wheelhouse with the toolchain packages when autopyweb starts
+WHEELHOUSE_PREPOPULATE = _env_int("WHEELHOUSE_PREPOPULATE", 1)
+
+# Seconds between background collections of unused checkouts, venvs, mirrors and cached wheels (0 to not collect)
+GC_INTERVAL = _env_int("GC_INTERVAL", 600)
+# Evict the least recently used of them while together they use more than this many bytes (0 for no limit)
+GC_QUOTA_BYTES = _env_int("GC_QUOTA_BYTES", 50 * 1024 * 1024 * 1024)
+# Evict checkouts and cached wheels not used for this many seconds (0 for no limit)
+GC_MAX_AGE = _env_int("GC_MAX_AGE", 7 * 24 * 60 * 60)
+# Never evict a checkout younger than this many seconds, it may still be being deployed
+GC_MIN_AGE = _env_int("GC_MIN_AGE", 60 * 60)
+# Files and directories removed a second when evicting, so running apps keep their disk I/O (0 for no limit)
+GC_DELETE_RATE = _env_int("GC_DELETE_RATE", 1000)
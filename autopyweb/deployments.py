@@ -0,0 +1,167 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A persistent registry of deployments, in SQLite.
+There is one row for each dirname link, describing the latest deploy to it and the release it serves.
+The deploy pipeline keeps the rows up to date, so listing deployments never has to scan the deploy location.
+SQLite does the locking, so every autopyweb worker can share the registry.
+"""
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+from os import path
+
+from . import config
+
+DEPLOYING = "deploying"
+LIVE = "live"
+FAILED = "failed"
+
+COLUMNS = (
+    "name",  # the dirname link, like "myproject-pr021"
+    "link",  # full path of the link
+    "project",
+    "origin",
+    "ref_kind",  # "branch", "tag" or "commit"
+    "ref",
+    "sha",  # commit of the latest deploy
+    "release",  # checkout of the latest deploy
+    "live_release",  # checkout the link points at now
+    "venv",
+    "socket",
+    "pid",
+    "status",
+    "error",
+    "job_id",
+    "created",
+    "updated",
+    "deployed",  # when the link was last switched
+)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS deployments (
+    name TEXT PRIMARY KEY,
+    link TEXT NOT NULL,
+    project TEXT NOT NULL,
+    origin TEXT NOT NULL,
+    ref_kind TEXT,
+    ref TEXT,
+    sha TEXT,
+    release TEXT,
+    live_release TEXT,
+    venv TEXT,
+    socket TEXT,
+    pid INTEGER,
+    status TEXT NOT NULL,
+    error TEXT,
+    job_id TEXT,
+    created REAL NOT NULL,
+    updated REAL NOT NULL,
+    deployed REAL
+);
+CREATE INDEX IF NOT EXISTS deployments_project ON deployments (project, updated);
+CREATE INDEX IF NOT EXISTS deployments_origin ON deployments (origin, updated);
+CREATE INDEX IF NOT EXISTS deployments_status ON deployments (status, updated);
+CREATE INDEX IF NOT EXISTS deployments_updated ON deployments (updated);
+"""
+
+# Filters accepted by DeploymentRegistry.list
+FILTERS = ("project", "origin", "status", "ref_kind", "ref", "sha")
+
+MAX_PAGE = 500
+
+
+class DeploymentRegistry(object):
+    def __init__(self, db_path=None):
+        if db_path is None:
+            db_path = config.REGISTRY_DB
+        self.db_path = db_path
+        self._ready = False
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if not self._ready:
+            os.makedirs(path.dirname(self.db_path), exist_ok=True)
+        conn = sqlite3.connect(self.db_path, timeout=30)
+        conn.row_factory = sqlite3.Row
+        if not self._ready:
+            with self._lock:
+                if not self._ready:
+                    conn.execute("PRAGMA journal_mode=WAL")
+                    conn.executescript(SCHEMA)
+                    conn.commit()
+                    self._ready = True
+        return conn
+
+    def record(self, name, **fields):
+        """
+        Create or update the row of a dirname link. Only the given fields are changed.
+        A new row needs at least link, project, origin and status.
+        :return: the row
+        :rtype: dict
+        """
+        unknown = set(fields.keys()) - set(COLUMNS)
+        if unknown:
+            raise ValueError("Unknown deployment fields: {}".format(", ".join(sorted(unknown))))
+        now = time.time()
+        fields["updated"] = now
+        with closing(self._connect()) as conn:
+            with conn:
+                assignments = ", ".join("{} = ?".format(k) for k in fields.keys())
+                cur = conn.execute(
+                    "UPDATE deployments SET {} WHERE name = ?".format(assignments), list(fields.values()) + [name]
+                )
+                if cur.rowcount == 0:
+                    fields.update(name=name, created=now)
+                    conn.execute(
+                        "INSERT INTO deployments ({}) VALUES ({})".format(
+                            ", ".join(fields.keys()), ", ".join("?" for _ in fields)
+                        ),
+                        list(fields.values()),
+                    )
+            return self._get(conn, name)
+
+    def _get(self, conn, name):
+        row = conn.execute("SELECT * FROM deployments WHERE name = ?", (name,)).fetchone()
+        return None if row is None else dict(row)
+
+    def get(self, name):
+        """
+        :return: the row of a dirname link, or None
+        :rtype: dict | None
+        """
+        with closing(self._connect()) as conn:
+            return self._get(conn, name)
+
+    def list(self, limit=50, offset=0, **filters):
+        """
+        Deployments, most recently updated first.
+        :param filters: exact values to match, any of FILTERS
+        :return: one page of rows, and the number of rows matching the filters
+        :rtype: tuple
+        """
+        unknown = set(filters.keys()) - set(FILTERS)
+        if unknown:
+            raise ValueError("Cannot filter deployments by: {}".format(", ".join(sorted(unknown))))
+        filters = {k: v for k, v in filters.items() if v is not None}
+        where = " AND ".join("{} = ?".format(k) for k in filters.keys()) or "1"
+        limit = max(0, min(int(limit), MAX_PAGE))
+        offset = max(0, int(offset))
+        with closing(self._connect()) as conn:
+            total = conn.execute(
+                "SELECT COUNT(*) FROM deployments WHERE {}".format(where), list(filters.values())
+            ).fetchone()[0]
+            rows = conn.execute(
+                "SELECT * FROM deployments WHERE {} ORDER BY updated DESC, rowid DESC LIMIT ? OFFSET ?".format(where),
+                list(filters.values()) + [limit, offset],
+            ).fetchall()
+        return [dict(r) for r in rows], total
+
+
+def deployment_name(link_path):
+    return path.basename(link_path.rstrip("/"))
+
+
+deployments = DeploymentRegistry()
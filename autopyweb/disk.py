@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Measuring and removing the directory trees autopyweb keeps on disk.
+Trees are removed a file at a time at a limited rate, so removing a big checkout or venv doesn't starve the
+running apps of disk I/O. A tree is first renamed out of the way in one step, so nothing ever sees it half removed,
+and then removed at that rate in the background.
+"""
+import os
+import stat
+import threading
+import time
+import uuid
+from os import path
+
+from . import config
+
+# Trees renamed out of the way, still being removed. Left behind by a removal which was interrupted
+TRASH_PREFIX = ".gc-"
+
+
+def tree_stats(location):
+    """
+    :return: bytes used by the files of a tree, and the newest time any of them was accessed or changed.
+      Directories only count when they were changed, listing them to measure the tree updates their access time
+    :rtype: tuple
+    """
+    total = 0
+    newest = 0
+    try:
+        st = os.lstat(location)
+        newest = st.st_mtime if stat.S_ISDIR(st.st_mode) else max(st.st_mtime, st.st_atime)
+    except OSError:
+        return 0, 0
+    for root, dirs, files in os.walk(location):
+        for f in files:
+            try:
+                st = os.lstat(path.join(root, f))
+            except OSError:
+                continue
+            total += st.st_size
+            newest = max(newest, st.st_mtime, st.st_atime)
+    return total, newest
+
+
+def dir_size(location):
+    return tree_stats(location)[0]
+
+
+def remove_tree(location, rate=None):
+    """
+    Remove a tree, at most `rate` files and directories a second. Symlinks are removed, never followed.
+    :param rate: defaults to config.GC_DELETE_RATE, 0 for no limit
+    :return: the number of entries removed
+    :rtype: int
+    """
+    if rate is None:
+        rate = config.GC_DELETE_RATE
+    started = time.time()
+    removed = 0
+    if path.islink(location) or path.isfile(location):
+        try:
+            os.unlink(location)
+            return 1
+        except OSError:
+            return 0
+    for root, dirs, files in os.walk(location, topdown=False):
+        for name in files + dirs:
+            entry = path.join(root, name)
+            try:
+                if name in dirs and not path.islink(entry):
+                    os.rmdir(entry)
+                else:
+                    os.unlink(entry)
+            except OSError:
+                continue
+            removed += 1
+            if rate > 0:
+                ahead = removed / float(rate) - (time.time() - started)
+                if ahead > 0:
+                    time.sleep(ahead)
+    try:
+        os.rmdir(location)
+        removed += 1
+    except OSError:
+        pass
+    return removed
+
+
+def trash(location):
+    """
+    Rename a tree out of the way, to be removed with remove_tree.
+    :return: its new path, or None if it was already gone
+    """
+    trashed = path.join(
+        path.dirname(location), "{}{}-{}".format(TRASH_PREFIX, path.basename(location), uuid.uuid4().hex)
+    )
+    try:
+        os.rename(location, trashed)
+    except FileNotFoundError:
+        return None
+    return trashed
+
+
+def discard(location, wait=False, rate=None):
+    """
+    Rename a tree out of the way now, and remove it at the throttled rate in a background thread.
+    :param wait: remove it in this thread instead, before returning
+    :return: True if there was a tree to remove
+    """
+    trashed = trash(location)
+    if trashed is None:
+        return False
+    if wait:
+        remove_tree(trashed, rate=rate)
+    else:
+        thread = threading.Thread(target=remove_tree, args=(trashed, rate), name="remove-tree", daemon=True)
+        thread.start()
+    return True
+
+
+def trashed(location):
+    """
+    :return: paths of the trees in a directory which were renamed out of the way but not yet removed
+    :rtype: list
+    """
+    try:
+        return [path.join(location, e) for e in os.listdir(location) if e.startswith(TRASH_PREFIX)]
+    except OSError:
+        return []
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Environments for the subprocesses autopyweb runs.
+Rather than activating a venv in the server's own process, the activated environment is computed here and
+handed to each subprocess as `env=`. The server's environment is never changed, so deploys can run in parallel.
+"""
+import os
+import sys
+from os import path
+
+# Variables which would leak the server's own python setup into a project's subprocesses
+PARAMS_TO_CLEAN = ("VIRTUAL_ENV", "PYTHON_HOME", "PYTHONHOME", "PS1", "PYTHONPATH", "LIBRARY_ROOTS")
+
+
+def _active_venv_bins(env):
+    bins = set()
+    venv = env.get("VIRTUAL_ENV", None)
+    if venv:
+        bins.add(path.join(venv, "bin"))
+    if sys.prefix != getattr(sys, "base_prefix", sys.prefix):
+        # autopyweb itself runs from a venv which isn't activated
+        bins.add(path.join(sys.prefix, "bin"))
+    return bins
+
+
+def clean_env(base=None):
+    """
+    The server's environment with no virtualenv activated.
+    :param base: environment to start from, defaults to os.environ
+    :rtype: dict
+    """
+    env = dict(os.environ if base is None else base)
+    venv_bins = _active_venv_bins(env)
+    for p in PARAMS_TO_CLEAN:
+        env.pop(p, None)
+    env["PATH"] = os.pathsep.join(p for p in env.get("PATH", "").split(os.pathsep) if p and p not in venv_bins)
+    return env
+
+
+def venv_env(venv_path, base=None):
+    """
+    The environment `. venv_path/bin/activate` would give, without running a shell.
+    :param venv_path: the venv to activate, or None for no venv
+    :param base: environment to start from, defaults to os.environ
+    :rtype: dict
+    """
+    env = clean_env(base)
+    if venv_path is None:
+        return env
+    venv_path = path.abspath(venv_path)
+    env["VIRTUAL_ENV"] = venv_path
+    env["PATH"] = os.pathsep.join(p for p in (path.join(venv_path, "bin"), env.get("PATH", "")) if p)
+    return env
@@ -1,42 +1,40 @@
 # -*- coding: utf-8 -*-
 #
-from os import path, environ
-import subprocess
+from os import path
 import os
-from git import Repo  # type: ignore
-from shutil import rmtree
+import sqlite3
 import time
-from setuptools.sandbox import save_pkg_resources_state, save_modules  # type: ignore
+from concurrent.futures import ThreadPoolExecutor
+from shutil import rmtree
+from subprocess import DEVNULL
+from . import config, tracing
+from .capacity import capacity, worker_kind, read_workers, WORKERS_FILE
+from .deployments import deployments, deployment_name, DEPLOYING, LIVE, FAILED
+from .environment import clean_env, venv_env
+from .introspection import introspection_pool, IntrospectionError
+from .locks import FileSemaphore
+from .lockfiles import read_toml, is_poetry_project, pep621_requirements, locked_requirements
+from .metrics import cache_lookup, stage_timer, time_to_ready, deploy_results, deploys_in_flight, deploys_waiting
+from .mirrors import mirror_store, plan_fetch, fetch_plan, fetch_plans, REMOTE_NAME
+from .pipeline import Pipeline, Stage
+from .plans import plan_store, plain_settings
+from .readiness import probe
+from .requirements import read_requirements
+from .jobs import Superseded
+from .releases import release_store, release_in_use, StaleRelease
+from .supervisor import supervisor
+from .venvs import venv_store, venv_pool, requirements_key, marker_environment, make_layer, layer_base, interpreter_id
+from .venvs import COMPILED_FILE, READY_FILE
+from .wheelhouse import wheelhouse
+
+# A venv in the checkout, layered over its shared venv, for what only that checkout installs
+LAYER_NAME = "appvenv"
 
 
 def debug_print(output, *args, **kwargs):
     print(output, *args, **kwargs)
 
 
-def get_git_projects(location):
-    location = path.abspath(location)
-    contents = os.listdir(location)
-    directories = [c for c in contents if path.isdir(c)]
-    git_dirs = []
-    for d in directories:
-        full_d = path.join(location, d)
-        d_contents = os.listdir(full_d)
-        d_directories = [c for c in d_contents if path.isdir(c)]
-        if ".git" in d_directories:
-            git_dirs.append(full_d)
-    debug_print("Found {} potential repo dirs. Now loading them in Repo classes.".format(str(len(git_dirs))))
-    repos = []
-    for d in git_dirs:
-        try:
-            r = Repo(d)
-        except Exception as e:
-            debug_print(e)
-            debug_print("Not adding {}".format(d))
-            continue
-        repos.append(r)
-    return repos
-
-
 def guess_project_name(guess_string):
     if guess_string.startswith("https://"):
         guess_string = guess_string[8:]
@@ -69,383 +67,363 @@ def path_friendly(instring):
     return instring
 
 
-def add_git_project(location, origin_url, tag=None, branch=None, commit=None, dirname=None, do_update=False, **kwargs):
+def checkout_commit(repo, new_repo_path, ref_commit, mode=None):
     """
-    TODO: Document
-    :param location:
-    :param origin_url:
-    :param tag:
-    :param branch:
-    :param commit:
-    :param dirname:
-    :param do_update:
-    :param kwargs:
-    :return:
+    Write a detached checkout of `ref_commit` from the mirror `repo` to `new_repo_path`.
+    In "worktree" mode the checkout is a git worktree of the mirror, it shares the mirror's object store
+    so only the working tree is written to disk. In "clone" mode it is a standalone clone with its own
+    object database.
+    :param repo: the bare mirror
+    :type repo: git.Repo
+    :param new_repo_path:
+    :param ref_commit:
+    :param mode: "worktree" or "clone", defaults to config.CHECKOUT_MODE
+    :return: path of the checkout
     """
-    project_name = path_friendly(guess_project_name(origin_url)).lower()
-    location = path.abspath(location)
-    t = str(int(time.time()))
-    bare_location = path.join(location, "bare-{}-{}".format(project_name, t))
-    if path.isdir(bare_location):
-        rmtree(bare_location)
-    repo = Repo.init(bare_location, bare=True)
-    try:
-        REMOTE_NAME = "origin"
-        origin_remote = repo.create_remote(REMOTE_NAME, origin_url)
-        exists = origin_remote.exists()
+    if mode is None:
+        mode = config.CHECKOUT_MODE
+    if mode == "worktree":
+        # Forget worktrees of old checkouts which have been removed, one of them may have been at this path
+        repo.git.worktree("prune")
+        repo.git.worktree("add", "--detach", new_repo_path, str(ref_commit))
+    elif mode == "clone":
+        cloned_repo = repo.clone(new_repo_path)
+        cloned_repo.head.reference = cloned_repo.commit(ref_commit)
+        # We're now in detached-head mode, this is what we want.
+        # Now reset working tree to the specified commit
+        cloned_repo.head.reset(index=True, working_tree=True)
+    else:
+        raise RuntimeError("Unknown checkout mode: {}".format(mode))
+    return new_repo_path
+
+
+def fetch_git_project(origin_url, tag=None, branch=None, commit=None, depth=None, blob_filter=None):
+    """
+    Fetch the requested tag, branch or commit from an origin into its persistent mirror.
+    :param origin_url: git url of the project
+    :param tag: deploy this tag
+    :param branch: deploy the tip of this branch
+    :param commit: deploy this commit id
+    :param depth: fetch only this many commits of history, 0 for all of it. Defaults to config.FETCH_DEPTH
+    :param blob_filter: partial clone filter for the fetch, like "blob:none". Defaults to config.FETCH_FILTER
+    :return: the fetch plan, and the full sha of the commit to deploy
+    :rtype: tuple
+    """
+    plan = plan_fetch(tag=tag, branch=branch, commit=commit)
+    cache_lookup("mirror", path.isdir(mirror_store.mirror_path(origin_url)))
+    with mirror_store.open(origin_url) as repo:
+        exists = repo.remotes[REMOTE_NAME].exists()
         if not exists:
             raise RuntimeError("Origin does not exist: {}".format(origin_url))
-        try:
-            easy_refspec = "refs/heads/*:refs/remotes/{:s}/*".format(REMOTE_NAME)
-            for fetch_info in origin_remote.fetch(easy_refspec):
-                print("Updated {} to {}".format(fetch_info.ref, fetch_info.commit))
-        except Exception:
-            raise RuntimeError("Cannot fetch data from origin: {}".format(origin_url))
-        if tag is not None:
-            refspec = "+refs/tags/{t:s}:refs/remotes/{r:s}/{t:s}".format(t=str(tag), r=REMOTE_NAME)
-            fetchs_found = origin_remote.fetch(refspec=refspec)
-            if len(fetchs_found) < 1:
-                raise RuntimeError("Tag not found on that origin: {:s}".format(branch))
-            try:
-                ref = repo.remotes[REMOTE_NAME].refs[str(tag)]
-                ref_commit = ref.commit
-                _dirname = "{:s}-tag-{:s}-{:s}".format(project_name, path_friendly(tag), str(ref_commit)[:7])
-            except KeyError:
-                raise RuntimeError("Tag not found on that origin: {}".format(tag))
-        elif branch is not None:
-            refspec = "+refs/heads/{h:s}:refs/remotes/{r:s}/{h:s}".format(h=branch, r=REMOTE_NAME)
-            fetchs_found = origin_remote.fetch(refspec=refspec)
-            if len(fetchs_found) < 1:
-                raise RuntimeError("Branch not found on that origin: {:s}".format(branch))
-            try:
-                ref = repo.remotes[REMOTE_NAME].refs[str(branch)]
-                ref_commit = ref.commit
-                _dirname = "{:s}-br-{:s}-{:s}".format(project_name, path_friendly(branch), str(ref_commit)[:7])
-            except KeyError:
-                raise RuntimeError("Branch not found on that origin: {}".format(branch))
-        elif commit is not None:
-            raise NotImplementedError("Cannot yet fetch remote reference from just a commit id.")
-            # try:
-            #     ref = repo.remotes[REMOTE_NAME].refs[commit]
-            #     _dirname = "sha-{:s}".format(ref.commit)
-            # except KeyError:
-            #     raise RuntimeError("Commit not found on that origin: {}".format(commit))
-        else:
-            try:
-                ref = repo.remotes[REMOTE_NAME].refs.master
-                ref_commit = ref.commit
-                _dirname = "{:s}-m-{:s}".format(project_name, str(ref_commit)[:7])
-            except (KeyError, AttributeError):
-                raise RuntimeError("master ref not found on that origin.")
-        if dirname is not None:
-            # override dirname with one provided (like, "pr021")
-            _dirname = "{:s}-{:s}".format(project_name, path_friendly(str(dirname)))
-        linked_repo_path = path.join(location, _dirname)
-        clone_dir = "{:s}-{:s}".format(project_name, str(ref_commit))
-        new_repo_path = path.join(location, clone_dir)
-        skip_symlink = False
-        if path.exists(linked_repo_path):
-            existing_repo = os.readlink(linked_repo_path)
-            if not path.exists(existing_repo):
-                # Old dangling symlink. Just kill it, and move on.
-                try:
-                    os.unlink(linked_repo_path)
-                except Exception as e:
-                    raise RuntimeError(
-                        "Found a non-removable dangling symlink where we want to place a new "
-                        "directory link.\n" + str(e)
-                    )
-            elif existing_repo == new_repo_path:
-                # We already have this exact dirname linked to the correct repo!
-                skip_symlink = True
-            elif do_update:
-                # First delete this symlink
-                try:
-                    os.unlink(linked_repo_path)
-                except Exception as e:
-                    if path.exists(linked_repo_path):
-                        raise RuntimeError(
-                            "Cannot update that dirname to new repo because the only link cannot "
-                            "be removed.\n" + str(e)
-                        )
-                    # old link is gone, lets continue
-                # Terminate current version
-                try:
-                    _ = stop(existing_repo, wait=True)  # noqa: F841
-                except Exception:
-                    # Don't matter, just continue
-                    pass
-                # Remove the entire old directory tree
-                try:
-                    rmtree(existing_repo)
-                except Exception:
-                    pass
-            else:
-                raise RuntimeError("Oh no! That dir already exists pointing to another thing!")
-        if not path.isdir(new_repo_path):
-            cloned_repo = repo.clone(new_repo_path)
-            cloned_repo.head.reference = cloned_repo.commit(ref_commit)
-            # We're now in detached-head mode, this is what we want.
-            # Now reset working tree to the specified commit
-            cloned_repo.head.reset(index=True, working_tree=True)
-        else:
-            # clone of that project at that commit already exists!
-            # just symlink it and call it done.
-            pass
-        if not skip_symlink:
-            os.symlink(new_repo_path, linked_repo_path)
-    finally:
-        # Always remove the bare_location tree
-        rmtree(bare_location)
-    return linked_repo_path
+        with tracing.span("git fetch", "git", refspec=plan.refspec, depth=depth, filter=blob_filter):
+            ref_commit = fetch_plan(repo, plan, depth=depth, blob_filter=blob_filter)
+        return plan, ref_commit.hexsha
 
 
-class CleanEnv(object):
-
-    params_to_clean = ["VIRTUAL_ENV", "PYTHON_HOME", "PS1", "PYTHONPATH", "LIBRARY_ROOTS"]
-    params_to_save = ["PATH"]
-
-    def __init__(self):
-        self.old_vals = {}
-        for p in self.params_to_clean:
-            self.old_vals[p] = None
-        for p in self.params_to_save:
-            self.old_vals[p] = None
-
-    def __enter__(self):
-        for p in self.params_to_clean:
-            self.old_vals[p] = environ.get(p, None)
-        for p in self.params_to_save:
-            self.old_vals[p] = environ.get(p, None)
-        for p in self.params_to_clean:
-            environ.unsetenv(p)
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        for p in self.params_to_clean:
-            old_val = self.old_vals.get(p, None)
-            if old_val is not None:
-                environ.putenv(p, old_val)
-        for p in self.params_to_save:
-            old_val = self.old_vals.get(p, None)
-            if old_val is not None:
-                environ.putenv(p, old_val)
-
-
-class InVenv(object):
-    def __init__(self, venv_path=None):
-        if venv_path is None:
-            cwd = path.abspath(os.getcwd())
-            venv_path = path.join(cwd, "venv")
-        self.venv_path = venv_path
-        self.old_path = None
-        self.e = None
-        self.p = None
-        self.m = None
-
-    def __enter__(self):
-        self.old_path = old_path = environ.get("PATH", None)
-        self.p = save_pkg_resources_state()
-        _ = self.p.__enter__()  # noqa: F841
-        self.m = save_modules()
-        _ = self.m.__enter__()  # noqa: F841
-        self.e = CleanEnv()
-        self.e.__enter__()
-        if old_path:
-            first_colon = old_path.index(":")
-            first_part = old_path[:first_colon]
-            if first_part.endswith("venv/bin"):
-                replacement_path = old_path[first_colon + 1 :]
-                environ.putenv("PATH", replacement_path)
-        if self.venv_path is False:
-            # if isinstance(args, list):
-            #     if args[0] == "python3":
-            #         args[0] = "/usr/bin/python3"
-            #     elif args[0] == "pip3":
-            #         args[0] = "/usr/bin/pip3"
-            #     elif args[0] == "python":
-            #         args[0] = "/usr/bin/python"
-            #     elif args[0] == "pip":
-            #         args[0] = "/usr/bin/pip"
-            # elif isinstance(args, str):
-            #     if args.startswith("python3 "):
-            #         args = args.replace("python3", "/usr/bin/python3", 1)
-            #     elif args.startswith("python "):
-            #         args = args.replace("python", "/usr/bin/python", 1)
-            #     elif args.startswith("pip3 "):
-            #         args = args.replace("pip3", "/usr/bin/pip3", 1)
-            #     elif args.startswith("pip "):
-            #         args = args.replace("pip", "/usr/bin/pip", 1)
-            pass
-        else:
-            venv_parent = path.dirname(self.venv_path)
-            activate_location = path.join(self.venv_path, "bin", "activate")
-
-            cmd2 = ". {} && echo ~~MARKER~~ && set".format(activate_location)
-            env = (
-                subprocess.Popen(cmd2, shell=True, cwd=venv_parent, stdout=subprocess.PIPE)
-                .stdout.read()
-                .decode("utf-8")
-                .splitlines()
-            )
-            marker = False
-            new_envs = {}
-            for e in env:
-                if marker:
-                    e = e.strip().split("=", 1)
-                    if len(e) > 1:
-                        name = str(e[0]).upper()
-                        if name in ("IFS", "OPTIND"):
-                            continue
-                        else:
-                            new_envs[name] = e[1].lstrip("'").rstrip("'")
-                elif e.strip() == "~~MARKER~~":
-                    marker = True
-            environ.update(new_envs)
-            # if isinstance(args, list):
-            #     if args[0] == "python3":
-            #         args[0] = path.join(venv_path, "bin", "python3")
-            #     elif args[0] == "pip3":
-            #         args[0] = path.join(venv_path, "bin", "pip3")
-            #     elif args[0] == "python":
-            #         args[0] = path.join(venv_path, "bin", "python")
-            #     elif args[0] == "pip":
-            #         args[0] = path.join(venv_path, "bin", "pip")
-            # elif isinstance(args, str):
-            #     if args.startswith("python3 "):
-            #         args = args.replace("python3", path.join(venv_path, "bin", "python3"), 1)
-            #     elif args.startswith("pip3 "):
-            #         args = args.replace("pip3", path.join(venv_path, "bin", "pip3"), 1)
-            #     elif args.startswith("python "):
-            #         args = args.replace("python", path.join(venv_path, "bin", "python"), 1)
-            #     elif args.startswith("pip "):
-            #         args = args.replace("pip", path.join(venv_path, "bin", "pip"), 1)
-
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if self.e is not None:
-            self.e.__exit__(exc_type, exc_val, exc_tb)
-        if self.old_path is not None:
-            environ.putenv("PATH", self.old_path)
-        if self.m is not None:
-            self.m.__exit__(exc_type, exc_val, exc_tb)
-        if self.p is not None:
-            self.p.__exit__(exc_type, exc_val, exc_tb)
-
-
-class NoVenv(InVenv):
-    def __init__(self):
-        # Pass venv_path=False to indicate _no_ venv.
-        super(NoVenv, self).__init__(venv_path=False)
+def release_paths(location, origin_url, plan, ref_commit, dirname=None):
+    """
+    Where a fetched commit is checked out, and the dirname link which points at it.
+    :param location: directory where deployed projects are placed
+    :param origin_url: git url of the project
+    :param plan: the fetch plan, from fetch_git_project
+    :param ref_commit: full sha of the commit, from fetch_git_project
+    :param dirname: link the checkout under this name (like "pr021") instead of one derived from the ref
+    :return: path of the dirname link, and path of the checkout
+    :rtype: tuple
+    """
+    project_name = path_friendly(guess_project_name(origin_url)).lower()
+    location = path.abspath(location)
+    short_sha = str(ref_commit)[:7]
+    if plan.kind == "tag":
+        _dirname = "{:s}-tag-{:s}-{:s}".format(project_name, path_friendly(plan.name), short_sha)
+    elif plan.kind == "commit":
+        _dirname = "{:s}-sha-{:s}".format(project_name, short_sha)
+    elif plan.name != "master":
+        _dirname = "{:s}-br-{:s}-{:s}".format(project_name, path_friendly(plan.name), short_sha)
+    else:
+        _dirname = "{:s}-m-{:s}".format(project_name, short_sha)
+    if dirname is not None:
+        # override dirname with one provided (like, "pr021")
+        _dirname = "{:s}-{:s}".format(project_name, path_friendly(str(dirname)))
+    linked_repo_path = path.join(location, _dirname)
+    clone_dir = "{:s}-{:s}".format(project_name, str(ref_commit))
+    new_repo_path = path.join(location, clone_dir)
+    return linked_repo_path, new_repo_path
+
+
+def prepare_release(location, origin_url, plan, ref_commit, dirname=None, do_update=False):
+    """
+    Check out a fetched commit from the origin's mirror as a new release, without linking it yet.
+    See release_paths for the parameters.
+    :param do_update: the dirname link may already point at another release, which this one will replace
+    :return: path of the checkout
+    """
+    linked_repo_path, new_repo_path = release_paths(location, origin_url, plan, ref_commit, dirname=dirname)
+    if path.lexists(linked_repo_path):
+        existing_repo = os.readlink(linked_repo_path)
+        if not path.exists(existing_repo):
+            # Old dangling symlink. Just kill it, and move on.
+            try:
+                os.unlink(linked_repo_path)
+            except Exception as e:
+                raise RuntimeError(
+                    "Found a non-removable dangling symlink where we want to place a new directory link.\n" + str(e)
+                )
+        elif existing_repo != new_repo_path and not do_update:
+            raise RuntimeError("Oh no! That dir already exists pointing to another thing!")
+    if not path.isdir(new_repo_path):
+        with mirror_store.open(origin_url) as repo:
+            # Checked again under the mirror's lock, another deploy of this commit may have just checked it out
+            if not path.isdir(new_repo_path):
+                with tracing.span("git checkout", "git", commit=str(ref_commit)):
+                    checkout_commit(repo, new_repo_path, ref_commit)
+    # Otherwise a clone of that project at that commit already exists! Just link it and call it done.
+    return new_repo_path
 
 
 def make_venv(parent_dir, venv_name="venv"):
-    args = "/usr/bin/python3 -m venv --symlinks {}".format(venv_name)
+    args = [config.PYTHON, "-m", "venv", "--symlinks", venv_name]
     venv_path = path.join(parent_dir, venv_name)
-    with NoVenv():
-        resp = subprocess.run(args, cwd=parent_dir, shell=True)
+    os.makedirs(parent_dir, exist_ok=True)
+    resp = tracing.run(args, cwd=parent_dir, shell=False, env=clean_env())
     assert resp.returncode == 0
     assert path.isdir(venv_path)
     return venv_path
 
 
 def init_pyproject_toml_project(file_path):
+    """
+    Read pyproject.toml, and poetry.lock next to it, without poetry.
+    A usable lock gives the pinned and hashed requirement set straight away, to install with pip alone.
+    Without one a poetry project still needs poetry to resolve it, and a PEP 621 project is installed with pip.
+    :return: whether it is a poetry or PEP 621 project, and its parameters
+    :rtype: tuple
+    """
     if not path.isfile(file_path):
         return False, {}
+    try:
+        pyproject = read_toml(file_path)
+    except ValueError as e:
+        debug_print("Cannot read {}: {}".format(file_path, repr(e)))
+        return False, {}
+    dependencies = pep621_requirements(pyproject)
+    if not is_poetry_project(pyproject) and dependencies is None:
+        # Only a build-system or tool settings, the requirements are in setup.py or requirements.txt
+        return False, {}
     project_dir = path.dirname(file_path)
-    venv_dir = make_venv(project_dir, venv_name=".venv")
-    pip3_path = path.join(venv_dir, "bin", "pip3")
+    lock_file = path.join(project_dir, "poetry.lock")
+    if path.isfile(lock_file):
+        try:
+            requirements = locked_requirements(read_toml(lock_file), pyproject, marker_environment())
+        except (ValueError, KeyError, TypeError) as e:
+            debug_print("Cannot install {} without poetry: {}".format(lock_file, repr(e)))
+        else:
+            return (
+                True,
+                {
+                    "project_type": "poetry",
+                    "locked": True,
+                    "venv_name": ".venv",
+                    "venv_key": requirements_key(files=[lock_file], texts=requirements),
+                    "requirements": requirements,
+                    "app_requirements": ["."],
+                },
+            )
+    if is_poetry_project(pyproject):
+        # The lock file pins the whole requirement set, without one fall back to the unresolved pyproject.toml
+        manifests = [lock_file] if path.isfile(lock_file) else [file_path]
+        venv_key = requirements_key(files=manifests)
+        return True, {"project_type": "poetry", "venv_name": ".venv", "venv_key": venv_key, "app_requirements": ["."]}
+    venv_key = requirements_key(texts=sorted(str(r).strip() for r in dependencies))
+    return (
+        True,
+        {
+            "project_type": "pep621",
+            "venv_name": "dynvenv",
+            "venv_key": venv_key,
+            "requirements": dependencies,
+            "app_requirements": ["."],
+        },
+    )
+
+
+def export_poetry_requirements(project_dir, venv_dir):
     poetry_path = path.join(venv_dir, "bin", "poetry")
-    with InVenv(venv_dir):
-        resp = subprocess.run([pip3_path, "install", "setuptools", "wheel"], cwd=project_dir, shell=False)
-        resp = subprocess.run([pip3_path, "install", "poetry>=1.0.2"], cwd=project_dir, shell=False)
-        # set poetry config
-        # virtualenvs.in-project = true
-        resp = subprocess.run(
-            "{} config --local virtualenvs.in-project true".format(poetry_path), cwd=project_dir, shell=True
-        )
-        req_txt_file = path.join(project_dir, "tempreq.txt")
-        resp = subprocess.run(
-            "{} export -f requirements.txt --without-hashes -o {}".format(poetry_path, req_txt_file),
-            cwd=project_dir,
-            shell=True,
-        )
+    req_txt_file = path.join(project_dir, "tempreq.txt")
+    resp = tracing.run(
+        [poetry_path, "export", "-f", "requirements.txt", "--without-hashes", "-o", req_txt_file],
+        cwd=project_dir,
+        shell=False,
+        env=venv_env(venv_dir),
+    )
     requirements = []
     if resp.returncode == 0:
         with open(req_txt_file, "r", encoding="utf-8") as f:
             lines = f.readlines()
         requirements.extend(lines)
         os.unlink(req_txt_file)
-    return True, {"venv": venv_dir, "requirements": requirements}
+    return requirements
 
 
-def install_poetry_project(project_dir, venv_dir):
+def install_poetry_project(project_dir, venv_dir, with_toolchain=True):
+    pip3_path = path.join(venv_dir, "bin", "pip3")
     poetry_path = path.join(venv_dir, "bin", "poetry")
-    with InVenv(venv_dir):
-        resp = subprocess.run("{} install".format(poetry_path), cwd=project_dir, shell=True)
+    env = venv_env(venv_dir)
+    if with_toolchain:
+        resp = wheelhouse.install(pip3_path, ["setuptools", "wheel"], cwd=project_dir, env=env)
+    # Neither the pool nor the toolchain has poetry, only a project without a usable poetry.lock needs it
+    resp = wheelhouse.install(pip3_path, ["poetry>=1.0.2"], cwd=project_dir, env=env)
+    # set poetry config
+    # virtualenvs.in-project = true
+    resp = tracing.run(
+        [poetry_path, "config", "--local", "virtualenvs.in-project", "true"], cwd=project_dir, shell=False, env=env
+    )
+    # The venv is shared by every checkout with this lock file, so don't install this checkout into it.
+    # The project itself is installed into the checkout's own layer, see install_app_layer.
+    resp = tracing.run(
+        [poetry_path, "install", "--no-root"], cwd=project_dir, shell=False, env=wheelhouse.pip_env(env)
+    )
     return resp
 
 
+def install_locked_requirements(location, venv_dir, requirements, with_toolchain=True):
+    """
+    Install a locked requirement set in one step. pip checks the hash of every file and resolves nothing,
+    every dependency is already in the set.
+    """
+    pip3 = path.join(venv_dir, "bin", "pip3")
+    env = venv_env(venv_dir)
+    if with_toolchain:
+        wheelhouse.install(pip3, ["setuptools", "wheel"], cwd=location, env=env)
+    # Next to the venv in the store, the checkout may be shared
+    req_file = path.join(path.dirname(venv_dir), "locked-requirements.txt")
+    with open(req_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(requirements) + "\n")
+    return wheelhouse.install(pip3, ["--require-hashes", "--no-deps", "-r", req_file], cwd=location, env=env)
+
+
 def init_setup_py_project(file_path):
     if not path.isfile(file_path):
         return False, {}
-    project_dir = path.dirname(file_path)
-    venv_dir = make_venv(project_dir, venv_name="dynvenv")
-    import distutils.core
-
-    with InVenv(venv_dir):
-        setup = distutils.core.run_setup(file_path)
-    requirements = setup.install_requires
-    return True, {"venv": venv_dir, "requirements": requirements}
+    setup_cfg = path.join(path.dirname(file_path), "setup.cfg")
+    # And the other files setup.py read, like a requirements.txt, which the plan depends on too
+    setup, inputs = introspection_pool.introspect("setup_py", file_path, extra_files=[setup_cfg], with_inputs=True)
+    requirements = setup["install_requires"]
+    venv_key = requirements_key(texts=sorted(str(r).strip() for r in requirements))
+    return (
+        True,
+        {
+            "venv_name": "dynvenv",
+            "venv_key": venv_key,
+            "requirements": requirements,
+            "app_requirements": ["."],
+            "inputs": inputs,
+        },
+    )
 
 
-def install_setup_py_project(location, venv_dir):
+def install_setup_py_project(location, venv_dir, requirements, with_toolchain=True):
     pip3 = path.join(venv_dir, "bin", "pip3")
-    with InVenv(venv_dir):
-        resp = subprocess.run([pip3, "install", "setuptools", "wheel"], cwd=location, shell=False)
-        resp = subprocess.run("{} install .".format(pip3), cwd=location, shell=True)
+    resp = None
+    env = venv_env(venv_dir)
+    if with_toolchain:
+        resp = wheelhouse.install(pip3, ["setuptools", "wheel"], cwd=location, env=env)
+    # Only the dependencies go into the shared venv, the project itself is installed into the checkout's own
+    # layer, see install_app_layer.
+    if requirements:
+        resp = wheelhouse.install(pip3, [str(r) for r in requirements], cwd=location, env=env)
     return resp
 
 
 def init_requirements_txt_project(file_path):
     if not path.isfile(file_path):
         return False, {}
-    project_dir = path.dirname(file_path)
-    venv_dir = make_venv(project_dir, "dynvenv")
-    requirements = []
-    with open(file_path, "r", encoding="utf-8") as f:
-        lines = f.readlines()
-    requirements.extend(lines)
-    return True, {"venv": venv_dir, "requirements": requirements}
+    # Keyed by the files it includes with -r and -c too
+    files, shared, local = read_requirements(file_path)
+    requirements = [r for r in shared if not r.startswith("-c ")] + local
+    return (
+        True,
+        {
+            "venv_name": "dynvenv",
+            "venv_key": requirements_key(files=files),
+            "requirements": requirements,
+            # Editable and local requirements are this checkout's own, they aren't installed into the shared venv
+            "app_requirements": local,
+        },
+    )
 
 
-def install_requirements_txt(project_dir, file_path, venv):
+def install_requirements_txt(project_dir, file_path, venv, with_toolchain=True):
     pip3_path = path.join(venv, "bin", "pip3")
-    with InVenv(venv):
-        resp = subprocess.run([pip3_path, "install", "setuptools", "wheel"], cwd=project_dir, shell=False)
-        resp = subprocess.run([pip3_path, "install", "-r", file_path], cwd=project_dir, shell=False)
+    env = venv_env(venv)
+    resp = None
+    if with_toolchain:
+        resp = wheelhouse.install(pip3_path, ["setuptools", "wheel"], cwd=project_dir, env=env)
+    _, shared, _ = read_requirements(file_path)
+    if shared:
+        # Next to the venv in the store, the checkout may be shared
+        req_file = path.join(path.dirname(venv), "requirements.txt")
+        with open(req_file, "w", encoding="utf-8") as f:
+            f.write("\n".join(shared) + "\n")
+        resp = wheelhouse.install(pip3_path, ["-r", req_file], cwd=project_dir, env=env)
     return resp
 
 
+def install_app_layer(location, venv, requirements):
+    """
+    Install what only this checkout uses, like the project itself or its editable requirements, into a venv
+    layered over its shared venv. That is how a src layout, console scripts and C extensions of the project
+    work. The shared venv stays as every other checkout linked to it expects.
+    :param location: the project checkout
+    :param venv: the checkout's link to its shared venv
+    :param requirements: requirement lines, read by pip from the checkout
+    :return: path of the layer, the app is run from it
+    """
+    layer = path.join(location, LAYER_NAME)
+    if path.isfile(path.join(layer, READY_FILE)) and layer_base(layer) == venv:
+        return layer
+    if path.lexists(layer):
+        rmtree(layer)
+    make_layer(venv, layer)
+    req_file = path.join(layer, "requirements.txt")
+    with open(req_file, "w", encoding="utf-8") as f:
+        f.write("\n".join(requirements) + "\n")
+    resp = wheelhouse.install(path.join(layer, "bin", "pip3"), ["-r", req_file], cwd=location, env=venv_env(layer))
+    if resp.returncode == 0:
+        with open(path.join(layer, READY_FILE), "w") as f:
+            f.write(str(time.time()))
+    else:
+        debug_print("Cannot install {} into {}".format(", ".join(requirements), layer))
+    return layer
+
+
 def install_gunicorn(venv):
     pip3_path = path.join(venv, "bin", "pip3")
     venv_parent = path.dirname(venv)
-    with InVenv(venv):
-        resp = subprocess.run([pip3_path, "install", "gunicorn>=20.0.1,<20.99"], cwd=venv_parent, shell=False)
+    resp = wheelhouse.install(pip3_path, ["gunicorn>=20.0.1,<20.99"], cwd=venv_parent, env=venv_env(venv))
     return resp
 
 
 def load_gunicorn_conf(conf_file):
-    g = {"__file__": conf_file}
-    _locals = {}
-    with NoVenv():
-        try:
-            with open(conf_file, "r") as f:
-                exec(f.read(), g, _locals)
-        except Exception:
-            _locals = {}
-    return _locals
+    """
+    The plain settings in a gunicorn.conf.py. Its hooks are left to gunicorn, which loads the file itself.
+    """
+    try:
+        return introspection_pool.introspect("gunicorn_conf", conf_file)
+    except IntrospectionError as e:
+        debug_print("Cannot load {}: {}".format(conf_file, repr(e)))
+        return {}
 
 
-def make_gunicorn_run(project_dir, venv, debug=True, workers=1, threads=4, target=None, **kwargs):
+def make_gunicorn_run(
+    project_dir, venv, debug=True, workers=None, threads=None, target=None, gunicorn_conf=None, **kwargs
+):
+    """
+    Write the run.sh which starts the app with gunicorn.
+    Workers and threads set here or in the project's gunicorn.conf.py are kept, otherwise the capacity scheduler
+    sizes the app to its share of the host, weighed by `priority` in gunicorn.conf.py.
+    run.sh reads the workers from gunicorn.workers, so a rebalance outlasts a restart.
+    """
     venv_path = path.abspath(venv)
     if debug:
         log_level = "debug"
@@ -453,11 +431,11 @@ def make_gunicorn_run(project_dir, venv, debug=True, workers=1, threads=4, targe
         log_level = "info"
     proj_name = path.basename(project_dir.rstrip("/"))
     run_file = path.join(project_dir, "run.sh")
-    stop_file = path.join(project_dir, "stop.sh")
     conf_file = path.join(project_dir, "gunicorn.conf.py")
     extra = []
     if path.isfile(conf_file):
-        gunicorn_conf = load_gunicorn_conf(conf_file)
+        if gunicorn_conf is None:
+            gunicorn_conf = load_gunicorn_conf(conf_file)
         extra.append("-c ./gunicorn.conf.py")
     else:
         gunicorn_conf = {}
@@ -477,116 +455,231 @@ def make_gunicorn_run(project_dir, venv, debug=True, workers=1, threads=4, targe
         workers = int(gunicorn_conf["workers"])
     if "threads" in gunicorn_conf:
         threads = int(gunicorn_conf["threads"])
+    worker_class = None
     if "worker_class" in gunicorn_conf:
-        extra.append("-k {}".format(str(gunicorn_conf["worker_class"])))
+        worker_class = str(gunicorn_conf["worker_class"])
     elif kwargs.get("is_tornado_app", False):
-        extra.append("-k tornado")
+        worker_class = "tornado"
     elif kwargs.get("is_sanic_app", False):
-        extra.append("-k sanic.worker.GunicornWorker")
+        worker_class = "sanic.worker.GunicornWorker"
+    if worker_class is not None:
+        extra.append("-k {}".format(worker_class))
+    kind = worker_kind(worker_class)
+    assigned_workers, assigned_threads = capacity.assign(
+        process_name(project_dir), path.realpath(project_dir), kind, gunicorn_conf.get("priority", 1), pinned=workers
+    )
+    if workers is None:
+        workers = assigned_workers
+    if threads is None:
+        threads = assigned_threads
     extra = " ".join(extra)
     run_template = """\
 #!/bin/sh
 . {venv_path:s}/bin/activate
-exec {venv_path:s}/bin/gunicorn --log-level {log_level:s} -b unix:./gunicorn.sock --pid ./gunicorn.pid --workers {workers:d} --threads {threads:d} -n {proj_name:s} {extra:s} {target:s}
+exec {venv_path:s}/bin/gunicorn --log-level {log_level:s} -b unix:./gunicorn.sock --pid ./gunicorn.pid --workers "$(cat ./{workers_file:s} 2>/dev/null || echo {workers:d})" --threads {threads:d} -n {proj_name:s} {extra:s} {target:s}
 """.format(
-        **locals()
-    )
-    stop_template = """\
-#!/bin/sh
-PIDFILE=./gunicorn.pid
-SOCKFILE=./gunicorn.sock
-if [ ! -f "$PIDFILE" ]; then
-    exit 0
-fi
-
-read PID <$PIDFILE
-kill -WINCH $PID
-sleep 5
-if [ -f "$PIDFILE" ]; then
-    kill -TERM $PID
-    sleep 10
-fi
-
-if [ -f "$PIDFILE" ]; then
-    kill -9 $PID
-    sleep 1
-fi
-
-rm -rf "$SOCKFILE"
-rm -rf "$PIDFILE"
-exit 0
-""".format(
-        **locals()
+        workers_file=WORKERS_FILE, **locals()
     )
     if not path.exists(run_file):
         with open(run_file, "w", encoding="latin-1") as f:
             f.write(run_template)
         os.chmod(run_file, 0o777)  # Executable for everyone.
-    if not path.exists(stop_file):
-        with open(stop_file, "w", encoding="latin-1") as f:
-            f.write(stop_template)
-        os.chmod(stop_file, 0o777)  # Executable for everyone
     return True
 
 
+def process_name(project_dir):
+    # The checkout directory, not the dirname link, so each release of a project is its own process
+    return path.basename(path.realpath(project_dir).rstrip("/"))
+
+
 def launch(project_dir):
-    with NoVenv():
-        # cmdline = "/usr/bin/nuhup {} &".format(run_file)
-        cmdline = "/usr/bin/nohup ./run.sh &"
-        resp = subprocess.run(cmdline, cwd=project_dir, shell=True)
-    return resp
+    """
+    Start the app with its run.sh, as a process supervised by this autopyweb worker.
+    :return: the process record
+    :rtype: dict
+    """
+    project_dir = path.realpath(project_dir)
+    return supervisor.start(
+        process_name(project_dir),
+        ["./run.sh"],
+        cwd=project_dir,
+        env=clean_env(),
+        log_file=path.join(project_dir, "gunicorn.log"),
+        cleanup=("gunicorn.sock", "gunicorn.pid"),
+    )
 
 
 def stop(project_dir, wait=False):
-    if wait:
-        cmdline = "./stop.sh"
+    """
+    Stop the app, and don't restart it.
+    :param wait: wait until the app has exited
+    :return: the final process record, None if the app wasn't running. A future of that if not waiting.
+    """
+    pid_file = path.join(path.realpath(project_dir), "gunicorn.pid")
+    return supervisor.stop(process_name(project_dir), wait=wait, pid_file=pid_file)
+
+
+def precompile_project(project_dir, venv=None, workers=None):
+    """
+    Compile the project's modules to bytecode, and the venv's too if that hasn't been done yet,
+    so the app's workers don't all compile the same modules on their first requests.
+    Compiled with the venv's own interpreter, on a pool of processes.
+    :param workers: number of processes, defaults to config.PRECOMPILE_WORKERS or one for each core
+    :return: the directories compiled
+    :rtype: list
+    """
+    if workers is None:
+        workers = config.PRECOMPILE_WORKERS or os.cpu_count() or 1
+    targets = [path.realpath(project_dir)]
+    compiled_marker = None
+    if venv is not None:
+        python = path.join(venv, "bin", "python")
+        # The packages of a layer were compiled as they were installed, it is the venv beneath which needs it
+        venv_real = path.realpath(layer_base(venv) or venv)
+        compiled_marker = path.join(venv_real, COMPILED_FILE)
+        if not path.isfile(compiled_marker):
+            # A stored venv is shared by many releases, it only needs compiling once
+            targets.append(path.join(venv_real, "lib"))
     else:
-        cmdline = "/usr/bin/nohup ./stop.sh &"
-    with NoVenv():
-        resp = subprocess.run(cmdline, cwd=project_dir, shell=True)
-    return resp
+        python = config.PYTHON
+    # compileall doesn't follow symlinks, so the venv link in the project is skipped
+    args = [python, "-m", "compileall", "-q", "-j", str(int(workers)), "-x", r"/\.git/"] + targets
+    resp = tracing.run(args, cwd=targets[0], stdout=DEVNULL, env=venv_env(venv))
+    if resp.returncode != 0:
+        # Some files can't be compiled, like python 2 files shipped in packages. The app can still run.
+        debug_print("Some files could not be compiled in {}".format(project_dir))
+    if len(targets) > 1:
+        with open(compiled_marker, "w") as f:
+            f.write(str(resp.returncode))
+    return targets
 
 
-def setup_python_project(location, execute=True):
+def wait_until_ready(project_dir, gunicorn_conf=None):
     """
-    We have a freshly cloned source codebase, now run it, but how?
-    :param location:
-    :type location: str
-    :return: success or not
-    :rtype: bool
+    Wait until a launched app accepts connections, then warm it up with a request to each warm-up path
+    for each of its workers. The paths and the time budget can be set in the project's gunicorn.conf.py
+    as `warmup_paths` and `ready_timeout`.
+    :raises RuntimeError: if the app isn't ready within the budget
+    :return: readiness timings
+    :rtype: dict
     """
-    # ACTION PLAN!
-    # 1) Detect if there's pyproject.toml or requirements.txt or something else?
-    # 2) Set up virtualenv for project to use
-    # 3) Install requirements with either PIP or Poetry depending on project type
-    # 4) Install gunicorn too (we need it to serve to a unix socket file)
-    # 5) Detect if its a flask app or a sanic app (support for others to come)
-    # 6) Detect where the app entrypoint is (app.py, app.wsgi, wsgi.py, source/app.py)?
-    # 7) Create a `run_gunicorn.sh` file with shell script to run the app
-    # 8) Execute it!
+    if gunicorn_conf is None:
+        gunicorn_conf = load_project_gunicorn_conf(project_dir)
+    warmup_paths = gunicorn_conf.get("warmup_paths", None)
+    if warmup_paths is None:
+        warmup_paths = [p.strip() for p in config.WARMUP_PATHS.split(",") if p.strip()]
+    return probe(
+        path.join(project_dir, "gunicorn.sock"),
+        float(gunicorn_conf.get("ready_timeout", config.READY_TIMEOUT)),
+        process_name=process_name(project_dir),
+        warmup_paths=[str(p) for p in warmup_paths],
+        warmup_rounds=int(gunicorn_conf.get("workers", read_workers(project_dir))),
+    )
 
-    # This routine will likely need to be modified and extended going forward as
-    # we encounter more project types
 
-    is_poetry_prj = False
-    is_setup_py_prj = False
-    is_bare_requirements = False
-    found_parameters = {}
+def detect_python_project(location):
+    """
+    Detect if there's pyproject.toml or setup.py or requirements.txt or something else,
+    and where the project's requirements come from.
+    :return: project parameters, with "project_type" one of "poetry", "pep621", "setup_py", "requirements" or None.
+      A poetry project with "locked" set is installed from its poetry.lock without poetry.
+    :rtype: dict
+    """
+    found_parameters = {"project_type": None}
     dir_contents = os.listdir(location)
     if "pyproject.toml" in dir_contents:
         pyproject_location = path.join(location, "pyproject.toml")
-        is_poetry_prj, params = init_pyproject_toml_project(pyproject_location)
-        found_parameters.update(params)
-    if not is_poetry_prj and "setup.py" in dir_contents:
+        is_pyproject_prj, params = init_pyproject_toml_project(pyproject_location)
+        if is_pyproject_prj:
+            found_parameters.update(params)
+            return found_parameters
+    if "setup.py" in dir_contents:
         setup_py_location = path.join(location, "setup.py")
         is_setup_py_prj, params = init_setup_py_project(setup_py_location)
-        found_parameters.update(params)
-    if not is_poetry_prj and not is_setup_py_prj and "requirements.txt" in dir_contents:
-        setup_py_location = path.join(location, "requirements.txt")
-        is_bare_requirements, params = init_requirements_txt_project(setup_py_location)
-        found_parameters.update(params)
+        if is_setup_py_prj:
+            found_parameters.update(params, project_type="setup_py")
+            return found_parameters
+    if "requirements.txt" in dir_contents:
+        requirements_location = path.join(location, "requirements.txt")
+        is_bare_requirements, params = init_requirements_txt_project(requirements_location)
+        if is_bare_requirements:
+            found_parameters.update(params, project_type="requirements")
+    return found_parameters
+
+
+def provision_project_venv(location, project, base=None):
+    """
+    Link the project to a virtualenv from the venv store, keyed by its requirements.
+    If that venv is new, install requirements with either PIP or Poetry depending on project type.
+    :param location: the project checkout
+    :param project: project parameters, from detect_python_project
+    :param base: a venv pool entry taken for this project, with the toolchain installed, to build a new venv
+      from. It is adopted only if the venv is new, it is up to the caller to give it back otherwise
+    :return: path of the venv the app runs from, the venv link in the project or a layer over it.
+      None if the project has no known requirements
+    """
+    venv_key = project.get("venv_key", None)
+    if venv_key is None:
+        return None
+    project_type = project["project_type"]
+    with venv_store.provision(venv_key) as env:
+        cache_lookup("venv", env.ready)
+        if env.ready:
+            debug_print("Reusing venv {} for {}".format(venv_key, location))
+        else:
+            # Claim a pre-built venv with the toolchain already installed, or build one if the pool is empty
+            with stage_timer("venv_create"):
+                pooled = base is not None
+                if pooled:
+                    venv_pool.adopt(base, env.venv_path)
+                else:
+                    pooled = venv_pool.claim("pip", env.venv_path)
+                if not pooled:
+                    make_venv(env.location, "venv")
+            toolchain = not pooled
+            with stage_timer("dependency_install"):
+                if needs_poetry(project):
+                    resp = install_poetry_project(location, env.venv_path, with_toolchain=toolchain)
+                elif project_type == "poetry":
+                    requirements = project["requirements"]
+                    resp = install_locked_requirements(location, env.venv_path, requirements, with_toolchain=toolchain)
+                elif project_type in ("setup_py", "pep621"):
+                    requirements = project.get("requirements", [])
+                    resp = install_setup_py_project(location, env.venv_path, requirements, with_toolchain=toolchain)
+                else:
+                    req_file = path.join(location, "requirements.txt")
+                    resp = install_requirements_txt(location, req_file, env.venv_path, with_toolchain=toolchain)
+            resp2 = None
+            if toolchain:
+                with stage_timer("gunicorn_install"):
+                    resp2 = install_gunicorn(env.venv_path)
+            if all(r is None or r.returncode == 0 for r in (resp, resp2)):
+                env.mark_ready()
+        venv_link = venv_store.link(venv_key, location, project["venv_name"])
+    app_requirements = project.get("app_requirements", None)
+    if not app_requirements:
+        return venv_link
+    with stage_timer("app_install"):
+        return install_app_layer(location, venv_link, app_requirements)
+
+
+def needs_poetry(project):
+    # A poetry project without a usable poetry.lock is resolved and installed by poetry itself
+    return project["project_type"] == "poetry" and not project.get("locked", False)
 
-    requirements = params.get("requirements", [])
+
+def resolve_requirements(location, project, venv):
+    if needs_poetry(project) and venv:
+        return export_poetry_requirements(location, venv)
+    return project.get("requirements", [])
+
+
+def detect_framework(requirements):
+    """
+    Detect if its a flask app or a sanic app or a tornado app (support for others to come)
+    :return: deploy params for make_gunicorn_run
+    :rtype: dict
+    """
     deploy_params = {
         "is_sanic_app": False,
         "is_flask_app": False,
@@ -610,20 +703,447 @@ def setup_python_project(location, execute=True):
 
     if not any({deploy_params["is_flask_app"], deploy_params["is_sanic_app"], deploy_params["is_tornado_app"]}):
         pass  # assume its a generic wsgi-compatible app
+    return deploy_params
+
+
+def load_project_gunicorn_conf(location):
+    conf_file = path.join(location, "gunicorn.conf.py")
+    if not path.isfile(conf_file):
+        return {}
+    return load_gunicorn_conf(conf_file)
+
+
+def record_deployment(link_path, **fields):
+    """
+    Update the registry row of a dirname link. A registry error never fails a deploy.
+    :param link_path: path of the dirname link, None if not known yet
+    :return: the row, or None
+    """
+    if link_path is None:
+        return None
+    try:
+        return deployments.record(deployment_name(link_path), **fields)
+    except sqlite3.Error as e:
+        debug_print("Cannot record deployment {}: {}".format(link_path, repr(e)))
+        return None
+
+
+def _fetch_stage(ctx):
+    return fetch_git_project(ctx["origin_url"], **ctx["fetch_kwargs"])
+
+
+def _checkout_stage(ctx):
+    plan, ref_commit = ctx["fetch"]
+    release = prepare_release(ctx["location"], ctx["origin_url"], plan, ref_commit, **ctx["link_kwargs"])
+    tracing.save_to(path.join(release, tracing.TRACE_FILE))
+    dirname = ctx["link_kwargs"].get("dirname", None)
+    linked_repo_path, _ = release_paths(ctx["location"], ctx["origin_url"], plan, ref_commit, dirname=dirname)
+    ctx["deployment"]["link"] = linked_repo_path
+    record_deployment(
+        linked_repo_path,
+        link=linked_repo_path,
+        project=path_friendly(guess_project_name(ctx["origin_url"])).lower(),
+        origin=ctx["origin_url"],
+        ref_kind=plan.kind,
+        ref=plan.name,
+        sha=ref_commit,
+        release=release,
+        status=DEPLOYING,
+        error=None,
+        job_id=ctx["deployment"]["job_id"],
+    )
+    return release
+
+
+def _plan_stage(ctx):
+    fetched = ctx.get("fetch", None)
+    plan, key = plan_store.lookup(ctx["checkout"], commit=fetched[1] if fetched else None)
+    cache_lookup("plan", plan is not None)
+    return plan, key
+
+
+def _detect_stage(ctx):
+    plan, _ = ctx["plan"]
+    if plan is not None:
+        return plan["project"]
+    return detect_python_project(ctx["checkout"])
+
+
+def _interpreter_stage(ctx):
+    return interpreter_id()
+
+
+def _base_venv_stage(ctx):
+    # In case the project needs a new venv. Whatever the venv stage doesn't adopt goes back to the pool
+    entry = venv_pool.take("pip") or venv_pool.build_entry("pip", claimed=True)
+    ctx["base_venvs"].append(entry)
+    return entry
+
 
-    venv = params.get("venv", None)
-    if is_poetry_prj and venv:
-        resp = install_poetry_project(location, venv)
-        print(resp)
-    elif is_setup_py_prj and venv:
-        resp = install_setup_py_project(location, venv)
-    elif is_bare_requirements and venv:
-        resp = install_requirements_txt(location, path.join(location, "requirements.txt"), venv)
-    if venv:
-        resp = install_gunicorn(venv)
-    make_gunicorn_run(location, venv, **deploy_params)
+def _venv_stage(ctx):
+    return provision_project_venv(ctx["checkout"], ctx["detect"], base=ctx["base_venv"])
+
+
+def _requirements_stage(ctx):
+    plan, _ = ctx["plan"]
+    if plan is not None:
+        return plan["requirements"]
+    return resolve_requirements(ctx["checkout"], ctx["detect"], ctx["venv"])
+
+
+def _gunicorn_conf_stage(ctx):
+    plan, _ = ctx["plan"]
+    if plan is not None:
+        return plan["gunicorn_conf"]
+    return load_project_gunicorn_conf(ctx["checkout"])
+
+
+def _scripts_stage(ctx):
+    plan, _ = ctx["plan"]
+    deploy_params = plan["deploy_params"] if plan is not None else detect_framework(ctx["requirements"])
+    return make_gunicorn_run(ctx["checkout"], ctx["venv"], gunicorn_conf=ctx["gunicorn_conf"], **deploy_params)
+
+
+def _save_plan_stage(ctx):
+    plan, key = ctx["plan"]
+    if plan is not None:
+        return key
+    fetched = ctx.get("fetch", None)
+    plan = {
+        "project": ctx["detect"],
+        "requirements": ctx["requirements"],
+        "deploy_params": detect_framework(ctx["requirements"]),
+        "gunicorn_conf": plain_settings(ctx["gunicorn_conf"]),
+    }
+    plan_store.save(key, plan, commit=fetched[1] if fetched else None, project_dir=ctx["checkout"])
+    return key
+
+
+def _compile_stage(ctx):
+    if not config.PRECOMPILE or not ctx["gunicorn_conf"].get("precompile", True):
+        return []
+    return precompile_project(ctx["checkout"], ctx["venv"])
+
+
+def _launch_stage(ctx):
+    return launch(ctx["checkout"])
+
+
+def _ready_stage(ctx):
+    release = ctx["checkout"]
+    try:
+        readiness = wait_until_ready(release, gunicorn_conf=ctx["gunicorn_conf"])
+    except Exception:
+        if not release_in_use(release):
+            # Nothing links to this release, don't leave it crash looping
+            stop(release, wait=False)
+        raise
+    # Count from when the app was launched
+    readiness["time_to_ready"] += ctx["timings"].get("launch", 0)
+    time_to_ready.observe(readiness["time_to_ready"])
+    return readiness
+
+
+def _switch_stage(ctx):
+    plan, ref_commit = ctx["fetch"]
+    dirname = ctx["link_kwargs"].get("dirname", None)
+    linked_repo_path, _ = release_paths(ctx["location"], ctx["origin_url"], plan, ref_commit, dirname=dirname)
+    try:
+        release_store.switch(linked_repo_path, ctx["checkout"], since=ctx["deployment"]["started"])
+    except StaleRelease:
+        if not release_in_use(ctx["checkout"]):
+            stop(ctx["checkout"], wait=False)
+        raise
+    launched = ctx.get("launch", None) or {}
+    record_deployment(
+        linked_repo_path,
+        live_release=ctx["checkout"],
+        venv=path.realpath(layer_base(ctx["venv"]) or ctx["venv"]),
+        socket=path.join(ctx["checkout"], "gunicorn.sock") if launched else None,
+        pid=launched.get("pid", None),
+        status=LIVE,
+        error=None,
+        deployed=time.time(),
+    )
+    return linked_repo_path
+
+
+def _rebalance_stage(ctx):
+    # Make room for the new app. Stopped apps, like replaced releases no longer kept warm, give their share back
+    return capacity.rebalance()
+
+
+def setup_stages(execute=True):
+    """
+    The stages which take a checkout to a running app.
+    A base venv with the toolchain installed is taken from the pool, or built, while the checkout is fetched,
+    it only depends on the interpreter. A checkout which needs a new venv builds it from that base.
+    A checkout with a cached plan skips detecting its project, requirements, framework and gunicorn settings.
+    gunicorn.conf.py is loaded while the venv is being set up.
+    The project and its venv are compiled to bytecode while the run script is written.
+    """
+    stages = [
+        Stage("interpreter", _interpreter_stage),
+        Stage("base_venv", _base_venv_stage, requires=("interpreter",), critical=False),
+        Stage("plan", _plan_stage, requires=("checkout",)),
+        Stage("detect", _detect_stage, requires=("plan",)),
+        Stage("venv", _venv_stage, requires=("detect", "base_venv")),
+        Stage("gunicorn_conf", _gunicorn_conf_stage, requires=("plan",)),
+        Stage("requirements", _requirements_stage, requires=("detect", "venv")),
+        Stage("scripts", _scripts_stage, requires=("venv", "requirements", "gunicorn_conf")),
+        Stage("save_plan", _save_plan_stage, requires=("scripts",), critical=False),
+    ]
     if execute:
-        launch(location)
+        # Precompiling is an optimisation, the app is launched even if it fails
+        stages.append(Stage("compile", _compile_stage, requires=("venv", "gunicorn_conf"), critical=False))
+        stages.append(Stage("launch", _launch_stage, requires=("scripts", "compile")))
+        # Once launched, a release is seen through to its switch even if a newer deploy supersedes this one,
+        # the switch itself won't undo a newer deploy
+        stages.append(Stage("ready", _ready_stage, requires=("launch",), cancellable=False))
+    return stages
+
+
+def deploy_stages(execute=True, prefetched=False):
+    """
+    Every stage of a deploy, from fetching the origin to a running app.
+    The new release is set up and launched beside the one it replaces, and the dirname link is only switched
+    over once the new release is ready. Then every app on the host is resized to its share.
+    :param prefetched: the commit was already fetched, and is seeded into the pipeline context as "fetch"
+    """
+    return (
+        ([] if prefetched else [Stage("fetch", _fetch_stage)])
+        + [Stage("checkout", _checkout_stage, requires=("fetch",))]
+        + setup_stages(execute=execute)
+        + [Stage("switch", _switch_stage, requires=("ready",) if execute else ("scripts",), cancellable=False)]
+        + ([Stage("rebalance", _rebalance_stage, requires=("switch",), critical=False)] if execute else [])
+    )
+
+
+def setup_python_project(location, execute=True, job=None):
+    """
+    We have a freshly cloned source codebase, now run it, but how?
+    :param location:
+    :type location: str
+    :param execute: launch the app when it is set up
+    :param job: job to record stage timings against
+    :return: success or not
+    :rtype: bool
+    """
+    # ACTION PLAN!
+    # 1) Detect if there's pyproject.toml or requirements.txt or something else?
+    # 2) Link the project to a virtualenv from the venv store, keyed by its requirements
+    # 3) If that venv is new, install requirements with either PIP or Poetry depending on project type
+    # 4) Install gunicorn too (we need it to serve to a unix socket file)
+    # 5) Detect if its a flask app or a sanic app (support for others to come)
+    # 6) Detect where the app entrypoint is (app.py, app.wsgi, wsgi.py, source/app.py)?
+    # 7) Create a `run_gunicorn.sh` file with shell script to run the app
+    # 8) Execute it, and wait until it is ready!
+
+    # This routine will likely need to be modified and extended going forward as
+    # we encounter more project types
+    with tracing.traced("setup_python_project", location=location):
+        tracing.save_to(path.join(location, tracing.TRACE_FILE))
+        run_pipeline(setup_stages(execute=execute), {"checkout": location}, job=job)
+    return True
+
+
+def run_pipeline(stages, ctx, job=None):
+    """
+    Run the stages with Pipeline, then give the base venvs the venv stage didn't adopt back to the pool.
+    :return: the pipeline context
+    :rtype: dict
+    """
+    base_venvs = ctx["base_venvs"] = []
+    try:
+        return Pipeline(stages, max_workers=config.PIPELINE_WORKERS).run(ctx, job=job)
+    finally:
+        for entry in base_venvs:
+            venv_pool.give_back(entry)
+
+
+def deploy_git_project(location, origin_url, job=None, execute=True, fetched=None, **kwargs):
+    """
+    Fetch, check out, set up and launch a project, running independent stages in parallel.
+    At most config.MAX_GLOBAL_DEPLOYS deploys run at once across all autopyweb workers.
+    :param location: directory where deployed projects are placed
+    :param origin_url: git url of the project
+    :param job: job to record stage timings against
+    :param fetched: the fetch plan and commit, if already fetched by fetch_git_projects
+    :param kwargs: tag, branch, commit, depth and blob_filter, see fetch_git_project. dirname and do_update,
+      see prepare_release.
+    :return: the pipeline context, with every stage result and the stage timings
+    :rtype: dict
+    """
+    fetch_keys = ("tag", "branch", "commit", "depth", "blob_filter")
+    ctx = {
+        "location": location,
+        "origin_url": origin_url,
+        "fetch_kwargs": {k: kwargs[k] for k in fetch_keys if k in kwargs},
+        "link_kwargs": {"dirname": kwargs.get("dirname", None), "do_update": kwargs.get("do_update", False)},
+        # Shared by every stage, filled in with the dirname link once it is known
+        "deployment": {"link": None, "job_id": job and job.id, "started": time.time()},
+    }
+    if fetched is not None:
+        ctx["fetch"] = fetched
+    with tracing.traced("deploy_git_project", origin=origin_url, job=job and job.id, **kwargs):
+        if job is not None:
+            tracing.prune(config.TRACE_DIR, config.JOB_HISTORY)
+            tracing.save_to(path.join(config.TRACE_DIR, "{}.json".format(job.id)))
+        slots = FileSemaphore(path.join(config.STATE_DIR, "deploy-slots"), config.MAX_GLOBAL_DEPLOYS)
+        with deploys_waiting.track_inprogress(), stage_timer("wait_for_slot"), tracing.span("wait_for_slot"):
+            if job is not None:
+                with job.run_stage("wait_for_slot"):
+                    slots.acquire()
+            else:
+                slots.acquire()
+        result = "failure"
+        try:
+            with deploys_in_flight.track_inprogress():
+                stages = deploy_stages(execute=execute, prefetched=fetched is not None)
+                ctx = run_pipeline(stages, ctx, job=job)
+            result = "success"
+            return ctx
+        except (Superseded, StaleRelease):
+            # A newer deploy of the same link took over, it keeps the registry up to date
+            result = "superseded"
+            raise
+        except Exception as e:
+            # The link still points at the release it did before, if any
+            record_deployment(ctx["deployment"]["link"], status=FAILED, error=repr(e))
+            raise
+        finally:
+            slots.release()
+            deploy_results.inc(result=result)
+
+
+def fetch_git_projects(origin_url, refs, depth=None, blob_filter=None):
+    """
+    Fetch several tags, branches or commits from one origin into its mirror, with a single git fetch.
+    :param origin_url: git url of the project
+    :param refs: dicts of the tag, branch or commit to fetch
+    :param depth: see fetch_git_project
+    :param blob_filter: see fetch_git_project
+    :return: for each ref, the fetch plan and full sha of its commit, or the exception raised fetching it
+    :rtype: list
+    """
+    plans = [plan_fetch(**{k: ref.get(k, None) for k in ("tag", "branch", "commit")}) for ref in refs]
+    cache_lookup("mirror", path.isdir(mirror_store.mirror_path(origin_url)))
+    with mirror_store.open(origin_url) as repo:
+        if not repo.remotes[REMOTE_NAME].exists():
+            error = RuntimeError("Origin does not exist: {}".format(origin_url))
+            return [error for _ in plans]
+        refspecs = [p.refspec for p in plans]
+        with tracing.span("git fetch", "git", refspecs=refspecs, depth=depth, filter=blob_filter):
+            commits = fetch_plans(repo, plans, depth=depth, blob_filter=blob_filter)
+    return [c if isinstance(c, Exception) else (plan, c.hexsha) for plan, c in zip(plans, commits)]
+
+
+def deploy_git_projects(location, specs, job=None, execute=True, max_workers=None):
+    """
+    Deploy many projects at once. The specs are grouped by origin, and each origin is fetched only once
+    for all of its refs. Then each spec is deployed from that fetch, at most `max_workers` at a time.
+    :param location: directory where deployed projects are placed
+    :param specs: dicts of the origin, and the keyword arguments of deploy_git_project
+    :param job: job to record the fetch and deploy of each spec against
+    :param max_workers: defaults to config.BATCH_WORKERS
+    :return: for each spec, its link, release or error, and timings
+    :rtype: list
+    """
+    if max_workers is None:
+        max_workers = config.BATCH_WORKERS
+    started = time.time()
+    results = [{"origin": spec["origin"], "state": "queued"} for spec in specs]
+    groups = {}
+    for i, spec in enumerate(specs):
+        key = (spec["origin"], spec.get("depth", None), spec.get("blob_filter", None))
+        groups.setdefault(key, []).append(i)
+    with tracing.traced("deploy_git_projects", count=len(specs), job=job and job.id) as trace:
+        if job is not None:
+            tracing.prune(config.TRACE_DIR, config.JOB_HISTORY)
+            tracing.save_to(path.join(config.TRACE_DIR, "{}.json".format(job.id)))
+
+        def run_stage(name):
+            return job.run_stage(name) if job is not None else tracing.span(name)
+
+        def deploy_one(i, fetched, fetch_time):
+            spec = dict(specs[i])
+            origin_url = spec.pop("origin")
+            results[i]["state"] = "running"
+            queued = time.time() - started
+            with tracing.activate(trace), run_stage("deploy {:d}".format(i)):
+                ctx = deploy_git_project(location, origin_url, execute=execute, fetched=fetched, **spec)
+            readiness = ctx.get("ready", None) or {}
+            results[i].update(
+                state="succeeded",
+                link=ctx["switch"],
+                release=ctx["checkout"],
+                sha=fetched[1],
+                time_to_ready=readiness.get("time_to_ready", None),
+                timings=dict(ctx["timings"], fetch=fetch_time, queued=queued),
+            )
+
+        with ThreadPoolExecutor(max_workers=max(1, int(max_workers))) as executor:
+
+            def fetch_group(origin_url, depth, blob_filter, indexes):
+                fetch_started = time.time()
+                with tracing.activate(trace), run_stage("fetch {}".format(origin_url)):
+                    fetched = fetch_git_projects(origin_url, [specs[i] for i in indexes], depth, blob_filter)
+                fetch_time = time.time() - fetch_started
+                deploys = []
+                for i, found in zip(indexes, fetched):
+                    if isinstance(found, Exception):
+                        results[i].update(state="failed", error=repr(found), timings={"fetch": fetch_time})
+                    else:
+                        deploys.append((i, executor.submit(deploy_one, i, found, fetch_time)))
+                return deploys
+
+            group_futures = [(indexes, executor.submit(fetch_group, *key, indexes)) for key, indexes in groups.items()]
+            deploys = []
+            for indexes, future in group_futures:
+                try:
+                    deploys.extend(future.result())
+                except Exception as e:
+                    for i in indexes:
+                        results[i].update(state="failed", error=repr(e))
+            for i, future in deploys:
+                try:
+                    future.result()
+                except Exception as e:
+                    results[i].update(state="failed", error=repr(e))
+    return results
+
+
+def rollback_project(location, link_name):
+    """
+    Point a dirname link back at the release it last replaced.
+    That is instant while the previous release is still running, otherwise it is relaunched first.
+    :param location: directory where deployed projects are placed
+    :param link_name: name of the dirname link, like "myproject-pr021"
+    :return: path of the release now live
+    """
+    linked_repo_path = path.join(path.abspath(location), path.basename(link_name))
+    if not path.islink(linked_repo_path):
+        raise RuntimeError("Not a deployed dirname: {}".format(link_name))
+
+    def relaunch(release):
+        launch(release)
+        wait_until_ready(release)
+
+    release = release_store.rollback(linked_repo_path, relaunch=relaunch)
+    process = supervisor.get(process_name(release)) or {}
+    record_deployment(
+        linked_repo_path,
+        release=release,
+        live_release=release,
+        # Releases are checked out as "<project>-<sha>"
+        sha=path.basename(release).rsplit("-", 1)[-1],
+        socket=path.join(release, "gunicorn.sock"),
+        pid=process.get("pid", None),
+        status=LIVE,
+        error=None,
+        deployed=time.time(),
+    )
+    return release
 
 
 if __name__ == "__main__":
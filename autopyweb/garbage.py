@@ -0,0 +1,257 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A background garbage collector for everything autopyweb leaves on disk: checkouts of old and failed deploys,
+venvs, mirrors, and the wheelhouse and pip caches.
+Anything still in use is kept. That is a checkout a link points at, which may be rolled back to, which is running
+or being deployed, and the venvs and mirrors such checkouts use. Everything else is evicted once it is older
+than its age limit, and the least recently used first while everything together is over GC_QUOTA_BYTES.
+Evicted trees are renamed away at once and removed at a throttled rate, so running apps keep their disk I/O.
+It runs every GC_INTERVAL seconds, in one autopyweb worker on the host at a time.
+"""
+import os
+import re
+import threading
+import time
+from os import path
+
+from . import config
+from .deployments import deployments, DEPLOYING, MAX_PAGE
+from .disk import remove_tree, trash, trashed, tree_stats
+from .locks import FileLock
+from .mirrors import mirror_store
+from .releases import release_store
+from .supervisor import supervisor, LIVE_STATES
+from .venvs import venv_store
+from .wheelhouse import wheelhouse
+
+CHECKOUT = "checkout"
+VENV = "venv"
+MIRROR = "mirror"
+WHEEL = "wheel"
+PIP_CACHE = "pip_cache"
+
+# Checkouts are named {project}-{full sha}, see functions.release_paths
+_checkout_name = re.compile(r"^.+-[0-9a-f]{40}$")
+
+
+class GarbageCollector(object):
+    def __init__(
+        self,
+        location=None,
+        quota=None,
+        max_age=None,
+        min_age=None,
+        interval=None,
+        releases=None,
+        venvs=None,
+        mirrors=None,
+        wheels=None,
+    ):
+        """
+        :param location: where deployed projects are placed
+        :param quota: bytes everything together may use before the least recently used is evicted, 0 for no quota
+        :param max_age: seconds after its last use a checkout or cached wheel is evicted, 0 for no limit.
+          Venvs and mirrors have their own limits, VENV_GC_AGE and MIRROR_MAX_AGE
+        :param min_age: seconds a checkout is kept for at least, it may still be being deployed
+        :param interval: seconds between collections
+        :param releases: ReleaseStore whose releases are kept, defaults to the one every deploy uses
+        :param venvs: VenvStore to collect, likewise
+        :param mirrors: MirrorStore to collect, likewise
+        :param wheels: Wheelhouse whose wheels and pip cache are collected, likewise
+        """
+        self.location = config.DEPLOY_LOCATION if location is None else location
+        self.quota = config.GC_QUOTA_BYTES if quota is None else quota
+        self.max_age = config.GC_MAX_AGE if max_age is None else max_age
+        self.min_age = config.GC_MIN_AGE if min_age is None else min_age
+        self.interval = config.GC_INTERVAL if interval is None else interval
+        self.releases = release_store if releases is None else releases
+        self.venvs = venv_store if venvs is None else venvs
+        self.mirrors = mirror_store if mirrors is None else mirrors
+        self.wheels = wheelhouse if wheels is None else wheels
+        self._thread = None
+        self._stop = threading.Event()
+
+    def max_ages(self):
+        return {
+            CHECKOUT: self.max_age,
+            VENV: self.venvs.gc_age,
+            MIRROR: self.mirrors.max_age,
+            WHEEL: self.max_age,
+            PIP_CACHE: self.max_age,
+        }
+
+    def live_checkouts(self):
+        """
+        Checkouts which must be kept: linked, kept for a rollback, running or being deployed.
+        :rtype: set
+        """
+        live = set(self.releases.releases())
+        try:
+            entries = os.listdir(self.location)
+        except OSError:
+            entries = []
+        for e in entries:
+            link = path.join(self.location, e)
+            if path.islink(link):
+                live.add(path.realpath(link))
+        for record in supervisor.list():
+            if record["state"] in LIVE_STATES and record.get("cwd", None):
+                live.add(path.realpath(record["cwd"]))
+        rows, _ = deployments.list(limit=MAX_PAGE, status=DEPLOYING)
+        live.update(path.realpath(r["release"]) for r in rows if r.get("release", None))
+        return live
+
+    def entries(self, now=None):
+        """
+        Everything the collector looks after, with its size and when it was last used.
+        :return: dicts with "kind", "path", "size", "last_used" and whether it is "live"
+        :rtype: list
+        """
+        now = time.time() if now is None else now
+        found = []
+        live = self.live_checkouts()
+        try:
+            names = sorted(os.listdir(self.location))
+        except OSError:
+            names = []
+        for name in names:
+            checkout = path.join(self.location, name)
+            if not _checkout_name.match(name) or path.islink(checkout) or not path.isdir(checkout):
+                continue
+            size, last_used = tree_stats(checkout)
+            in_use = path.realpath(checkout) in live or now - last_used < self.min_age
+            found.append({"kind": CHECKOUT, "path": checkout, "size": size, "last_used": last_used, "live": in_use})
+        for env in self.venvs.envs():
+            size, _ = tree_stats(env.location)
+            live_refs = bool(env.live_refs())
+            found.append(
+                {"kind": VENV, "path": env.location, "size": size, "last_used": env.last_used(), "live": live_refs}
+            )
+        for mirror_path, last_used, size in self.mirrors.mirrors():
+            # Whether its objects are still shared by checkouts is only checked when it would be evicted
+            found.append({"kind": MIRROR, "path": mirror_path, "size": size, "last_used": last_used, "live": False})
+        for wheel in self.wheels.wheels():
+            size, last_used = tree_stats(path.join(self.wheels.location, wheel))
+            found.append(
+                {
+                    "kind": WHEEL,
+                    "path": path.join(self.wheels.location, wheel),
+                    "size": size,
+                    "last_used": last_used,
+                    "live": False,
+                }
+            )
+        try:
+            caches = sorted(os.listdir(self.wheels.cache_dir))
+        except OSError:
+            caches = []
+        for cache in caches:
+            size, last_used = tree_stats(path.join(self.wheels.cache_dir, cache))
+            found.append(
+                {
+                    "kind": PIP_CACHE,
+                    "path": path.join(self.wheels.cache_dir, cache),
+                    "size": size,
+                    "last_used": last_used,
+                    "live": False,
+                }
+            )
+        return found
+
+    def _remove(self, entry):
+        kind = entry["kind"]
+        if kind == VENV:
+            return self.venvs.remove(path.basename(entry["path"]))
+        if kind == MIRROR:
+            return self.mirrors.remove(entry["path"])
+        if kind == CHECKOUT:
+            # Check again, a deploy may have started using it while the sizes were worked out
+            if path.realpath(entry["path"]) in self.live_checkouts():
+                return False
+        removing = trash(entry["path"])
+        if removing is None:
+            return False
+        remove_tree(removing)
+        return True
+
+    def collect(self, now=None, dry_run=False):
+        """
+        Evict everything past its age limit, then the least recently used until everything fits in the quota.
+        :param dry_run: only report what would be evicted
+        :return: bytes used before and after, by kind, and what was evicted
+        :rtype: dict
+        """
+        now = time.time() if now is None else now
+        if not dry_run:
+            # Mirrors have a quota of their own too
+            self.mirrors.evict(now=now)
+            # Trees renamed away by a removal which was interrupted
+            for location in (self.location, self.venvs.location, self.mirrors.location):
+                for leftover in trashed(location):
+                    remove_tree(leftover)
+        entries = self.entries(now)
+        max_ages = self.max_ages()
+        used = sum(e["size"] for e in entries)
+        by_kind = {}
+        for e in entries:
+            by_kind[e["kind"]] = by_kind.get(e["kind"], 0) + e["size"]
+        total = used
+        evicted = []
+        for entry in sorted([e for e in entries if not e["live"]], key=lambda e: e["last_used"]):
+            max_age = max_ages[entry["kind"]]
+            too_old = max_age is not None and max_age > 0 and now - entry["last_used"] > max_age
+            too_big = self.quota > 0 and total > self.quota
+            if not (too_old or too_big):
+                continue
+            if not dry_run and not self._remove(entry):
+                continue
+            total -= entry["size"]
+            evicted.append(dict(entry, reason="age" if too_old else "quota"))
+        return {
+            "quota": self.quota,
+            "used": used,
+            "used_after": total,
+            "by_kind": by_kind,
+            "evicted": evicted,
+            "dry_run": dry_run,
+        }
+
+    def _collect_logged(self):
+        try:
+            report = self.collect()
+        except Exception as e:
+            print("Garbage collection failed: {}".format(repr(e)))
+            return
+        if report["evicted"]:
+            print(
+                "Garbage collection evicted {:d} items, {:d} bytes now used".format(
+                    len(report["evicted"]), report["used_after"]
+                )
+            )
+
+    def _run(self):
+        # Only one worker on the host collects, the others take over if it goes away
+        lock = FileLock(path.join(config.STATE_DIR, "gc.lock"))
+        try:
+            while not self._stop.wait(self.interval):
+                if lock.locked or lock.acquire(blocking=False):
+                    self._collect_logged()
+        finally:
+            lock.release()
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="garbage-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+garbage_collector = GarbageCollector()
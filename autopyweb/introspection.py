@@ -0,0 +1,216 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Runs a project's setup.py and gunicorn.conf.py to find out its requirements and settings.
+That is untrusted code, so it is run in a pool of worker processes rather than in the server, each with a
+memory limit and each call with a timeout. A worker which times out or dies is killed and replaced, and every
+worker is replaced after a number of calls.
+Results are cached by a hash of the files they come from, so unchanged files are never run again. The worker
+notes which other files of the project were read, like a requirements.txt or version file read by setup.py,
+and a cached result is only used while those are unchanged too.
+"""
+import hashlib
+import json
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+from os import path
+
+from . import config, tracing
+from .environment import clean_env
+from .metrics import cache_lookup
+from .venvs import requirements_key
+
+WORKER_FILE = path.join(path.dirname(path.abspath(__file__)), "introspection_worker.py")
+
+# Bump when the results of the worker change, so results cached by an older autopyweb aren't used
+RESULT_VERSION = 2
+
+
+class IntrospectionError(RuntimeError):
+    pass
+
+
+class IntrospectionTimeout(IntrospectionError):
+    pass
+
+
+def input_digests(project_dir, inputs):
+    """
+    :param inputs: paths of files relative to the project
+    :return: the hash of each file, None for one which doesn't exist
+    :rtype: dict
+    """
+    digests = {}
+    for f in inputs:
+        try:
+            with open(path.join(project_dir, f), "rb") as fp:
+                digests[f] = hashlib.sha256(fp.read()).hexdigest()
+        except OSError:
+            digests[f] = None
+    return digests
+
+
+class IntrospectionWorker(object):
+    def __init__(self, python, memory_limit):
+        self.proc = subprocess.Popen(
+            [python, WORKER_FILE, str(int(memory_limit))],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=clean_env(),
+            cwd="/",
+        )
+        self.calls = 0
+
+    def call(self, request, timeout):
+        """
+        :return: the response of the worker
+        :rtype: dict
+        :raises IntrospectionTimeout: if there's no response within timeout seconds
+        :raises IntrospectionError: if the worker died, like when it went past its memory limit
+        """
+        self.calls += 1
+        try:
+            self.proc.stdin.write(json.dumps(request).encode("utf-8") + b"\n")
+            self.proc.stdin.flush()
+        except OSError as e:
+            raise IntrospectionError("Introspection worker is gone: {}".format(repr(e)))
+        deadline = time.time() + timeout
+        fd = self.proc.stdout.fileno()
+        received = b""
+        while not received.endswith(b"\n"):
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise IntrospectionTimeout("{} took more than {} seconds".format(request["file"], timeout))
+            ready, _, _ = select.select([fd], [], [], remaining)
+            if not ready:
+                continue
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                raise IntrospectionError("Introspection worker died running {}".format(request["file"]))
+            received += chunk
+        return json.loads(received.decode("utf-8"))
+
+    def kill(self):
+        if self.proc.poll() is None:
+            self.proc.kill()
+        self.proc.wait()
+        self.proc.stdin.close()
+        self.proc.stdout.close()
+
+
+class IntrospectionPool(object):
+    def __init__(self, size=None, timeout=None, memory_limit=None, max_calls=None, cache_dir=None, python=None):
+        """
+        :param size: most workers, and so calls running at the same time
+        :param timeout: seconds one call may take
+        :param memory_limit: bytes of address space for each worker, 0 for no limit
+        :param max_calls: calls a worker takes before it is replaced
+        :param cache_dir: where results are cached, None for no cache
+        :param python: interpreter the workers are run with, defaults to the server's own
+        """
+        self.size = config.INTROSPECTION_WORKERS if size is None else size
+        self.timeout = config.INTROSPECTION_TIMEOUT if timeout is None else timeout
+        self.memory_limit = config.INTROSPECTION_MEMORY_LIMIT if memory_limit is None else memory_limit
+        self.max_calls = config.INTROSPECTION_MAX_CALLS if max_calls is None else max_calls
+        self.cache_dir = config.INTROSPECTION_DIR if cache_dir is None else cache_dir
+        self.python = sys.executable if python is None else python
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max(1, self.size))
+
+    def _checkout(self):
+        with self._lock:
+            while self._idle:
+                worker = self._idle.pop()
+                if worker.proc.poll() is None:
+                    return worker
+                worker.kill()
+        return IntrospectionWorker(self.python, self.memory_limit)
+
+    def _checkin(self, worker, healthy):
+        if healthy and worker.calls < self.max_calls:
+            with self._lock:
+                self._idle.append(worker)
+        else:
+            worker.kill()
+
+    def call(self, kind, file_path, timeout=None):
+        """
+        Run a file in a worker, without the cache.
+        :param kind: "setup_py" or "gunicorn_conf"
+        :return: the response of the worker, with "ok" and either "result" or "error"
+        :rtype: dict
+        """
+        timeout = self.timeout if timeout is None else timeout
+        with self._slots:
+            worker = self._checkout()
+            healthy = False
+            try:
+                response = worker.call({"kind": kind, "file": path.abspath(file_path)}, timeout)
+                healthy = True
+            finally:
+                self._checkin(worker, healthy)
+        return response
+
+    def _cache_file(self, key):
+        return path.join(self.cache_dir, "{}.json".format(key))
+
+    def _read_cache(self, key, project_dir):
+        try:
+            with open(self._cache_file(key), "r", encoding="utf-8") as f:
+                cached = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if input_digests(project_dir, cached["inputs"]) != cached["inputs"]:
+            # The file is the same, but another file it read has changed
+            return None
+        return cached["response"]
+
+    def _write_cache(self, key, response, project_dir):
+        cache_file = self._cache_file(key)
+        os.makedirs(self.cache_dir, exist_ok=True)
+        tmp_file = "{}.{}-{}.tmp".format(cache_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump({"response": response, "inputs": input_digests(project_dir, response["inputs"])}, f)
+        os.replace(tmp_file, cache_file)
+
+    def introspect(self, kind, file_path, extra_files=(), with_inputs=False):
+        """
+        The result of running a file, from the cache if the file and every other file it read are unchanged.
+        Errors raised by the project code are cached too, timeouts and dead workers aren't.
+        :param kind: "setup_py" or "gunicorn_conf"
+        :param extra_files: other files the result depends on, like setup.cfg
+        :param with_inputs: also return the other files of the project it read, relative to its directory
+        :raises IntrospectionError: if the project code raised, took too long or used too much memory
+        """
+        files = [file_path] + [f for f in extra_files if path.isfile(f)]
+        project_dir = path.dirname(path.abspath(file_path))
+        key = None
+        response = None
+        if self.cache_dir:
+            key = requirements_key(files=files, texts=[kind, str(RESULT_VERSION)], python=self.python)
+            response = self._read_cache(key, project_dir)
+            cache_lookup("introspection", response is not None)
+        if response is None:
+            with tracing.span(kind, "introspection", file=file_path):
+                response = self.call(kind, file_path)
+            if key is not None:
+                self._write_cache(key, response, project_dir)
+        if not response.get("ok", False):
+            raise IntrospectionError("{} failed: {}".format(file_path, response.get("error", None)))
+        if with_inputs:
+            return response["result"], response["inputs"]
+        return response["result"]
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for worker in idle:
+            worker.kill()
+
+
+introspection_pool = IntrospectionPool()
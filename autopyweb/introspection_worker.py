@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A worker process which runs project code to introspect it, for autopyweb.introspection.
+It is run as a script and imports nothing of autopyweb, so the server's modules are never loaded into it.
+Requests and responses are JSON, one per line, on stdin and stdout. Whatever the project code prints
+goes to stderr instead.
+"""
+import builtins
+import io
+import json
+import os
+import sys
+import traceback
+from contextlib import contextmanager
+
+PLAIN = (str, int, float, bool, type(None))
+
+
+def plain_settings(settings):
+    # The same as autopyweb.plans.plain_settings, hooks and modules can't be sent back
+    found = {}
+    for k, v in settings.items():
+        if k.startswith("_"):
+            continue
+        if isinstance(v, PLAIN) or (isinstance(v, (list, tuple)) and all(isinstance(i, PLAIN) for i in v)):
+            found[k] = v
+    return found
+
+
+def setup_py(file_path):
+    import setuptools  # type: ignore  # noqa: F401 so distutils is the one setuptools provides
+    import distutils.core
+
+    # Stop once setup.py and setup.cfg are read, no command is run
+    setup = distutils.core.run_setup(file_path, script_args=[], stop_after="config")
+    return {"install_requires": [str(r) for r in (setup.install_requires or [])]}
+
+
+def gunicorn_conf(file_path):
+    g = {"__file__": file_path}
+    _locals = {}
+    with open(file_path, "r") as f:
+        exec(compile(f.read(), file_path, "exec"), g, _locals)
+    return plain_settings(_locals)
+
+
+KINDS = {"setup_py": setup_py, "gunicorn_conf": gunicorn_conf}
+
+
+@contextmanager
+def opened_files(found):
+    """
+    Note the paths of the files opened meanwhile, like a requirements.txt or version file setup.py reads.
+    """
+    real_open, real_io_open = builtins.open, io.open
+
+    def tracked_open(file, *args, **kwargs):
+        if isinstance(file, (str, bytes, os.PathLike)):
+            found.add(os.path.abspath(os.fsdecode(file)))
+        return real_open(file, *args, **kwargs)
+
+    builtins.open = io.open = tracked_open
+    try:
+        yield found
+    finally:
+        builtins.open, io.open = real_open, real_io_open
+
+
+def project_inputs(file_path, found):
+    # The files in the project besides the one run, relative to its directory
+    file_path = os.path.realpath(file_path)
+    project_dir = os.path.dirname(file_path)
+    inputs = set()
+    for f in map(os.path.realpath, found):
+        if f != file_path and os.path.commonpath([project_dir, f]) == project_dir:
+            inputs.add(os.path.relpath(f, project_dir))
+    return sorted(inputs)
+
+
+def handle(request):
+    file_path = request["file"]
+    # Put the process back as it was afterwards, the next request may be for another project
+    modules = set(sys.modules.keys())
+    sys_path = list(sys.path)
+    environ = dict(os.environ)
+    cwd = os.getcwd()
+    found = set()
+    try:
+        os.chdir(os.path.dirname(file_path))
+        sys.path.insert(0, os.path.dirname(file_path))
+        with opened_files(found):
+            response = {"ok": True, "result": KINDS[request["kind"]](file_path)}
+    except BaseException as e:
+        # Including SystemExit, which setup.py may raise
+        traceback.print_exc()
+        response = {"ok": False, "error": "{}: {}".format(type(e).__name__, str(e))}
+    finally:
+        os.chdir(cwd)
+        sys.path[:] = sys_path
+        os.environ.clear()
+        os.environ.update(environ)
+        for name in set(sys.modules.keys()) - modules:
+            # The project's own modules it imported are read too
+            module_file = getattr(sys.modules[name], "__file__", None)
+            if isinstance(module_file, str):
+                found.add(os.path.abspath(module_file))
+            del sys.modules[name]
+    response["inputs"] = project_inputs(file_path, found)
+    return response
+
+
+def limit_memory(max_bytes):
+    try:
+        import resource
+    except ImportError:
+        return
+    if max_bytes > 0:
+        resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+
+def main():
+    limit_memory(int(sys.argv[1]) if len(sys.argv) > 1 else 0)
+    # Responses go to the real stdout, anything else printed goes to stderr
+    out = os.fdopen(os.dup(1), "w", encoding="utf-8")
+    os.dup2(2, 1)
+    sys.stdout = sys.stderr
+    for line in sys.stdin:
+        if not line.strip():
+            continue
+        response = handle(json.loads(line))
+        try:
+            out.write(json.dumps(response) + "\n")
+        except (TypeError, ValueError) as e:
+            out.write(json.dumps({"ok": False, "error": "Result is not JSON: {}".format(repr(e))}) + "\n")
+        out.flush()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,464 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Background deployment jobs.
+A deployment takes minutes (git fetch, pip, poetry), so `/add` hands the work to a bounded
+thread pool and returns a job id straight away. Each job records its state and how long each stage
+took. Job records are also written to the state dir so any autopyweb worker can answer `/jobs/<id>`.
+A job can be submitted with a key, then an identical request made while it runs, to any worker,
+gets that job back instead of starting another. Or, with a debounce window, a burst of requests is
+coalesced into one job, and a job made stale by a newer request is superseded.
+"""
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
+from os import path
+
+from . import config
+from .locks import FileLock
+from .supervisor import pid_alive
+
+QUEUED = "queued"
+RUNNING = "running"
+SUCCEEDED = "succeeded"
+FAILED = "failed"
+SUPERSEDED = "superseded"
+
+FINISHED_STATES = (SUCCEEDED, FAILED, SUPERSEDED)
+
+MAX_PAGE = 500
+
+
+class Superseded(RuntimeError):
+    pass
+
+
+class Job(object):
+    def __init__(self, name, params=None, job_id=None):
+        self.id = job_id or uuid.uuid4().hex
+        self.name = name
+        self.params = dict(params or {})
+        self.state = QUEUED
+        self.active_stages = []
+        self.stages = []
+        self.result = None
+        self.error = None
+        self.created = time.time()
+        self.started = None
+        self.finished = None
+        self._lock = threading.Lock()
+        self._listeners = []
+        self._superseded = None
+
+    def add_listener(self, listener):
+        """
+        Register a callable which is called with this job every time the job record changes.
+        """
+        self._listeners.append(listener)
+
+    def _changed(self):
+        for listener in self._listeners:
+            try:
+                listener(self)
+            except Exception as e:
+                print("Job listener failed: {}".format(repr(e)))
+
+    @contextmanager
+    def run_stage(self, name):
+        """
+        Time a named stage of this job.
+        :param name: name of the stage, eg "fetch" or "install"
+        :type name: str
+        """
+        record = self.start_stage(name)
+        success = False
+        try:
+            yield record
+            success = True
+        finally:
+            self.finish_stage(record, success)
+
+    def start_stage(self, name):
+        """
+        Start timing a stage which doesn't fit in a with block, finish it with finish_stage.
+        :return: the stage record
+        :rtype: dict
+        """
+        record = {"name": name, "started": time.time(), "finished": None, "duration": None, "success": None}
+        with self._lock:
+            self.active_stages.append(name)
+            self.stages.append(record)
+        self._changed()
+        return record
+
+    def finish_stage(self, record, success):
+        with self._lock:
+            record["success"] = success
+            record["finished"] = time.time()
+            record["duration"] = record["finished"] - record["started"]
+            self.active_stages.remove(record["name"])
+        self._changed()
+
+    def mark_running(self):
+        with self._lock:
+            self.state = RUNNING
+            self.started = time.time()
+        self._changed()
+
+    def mark_finished(self, result=None, error=None, state=None):
+        with self._lock:
+            self.finished = time.time()
+            if error is None:
+                self.state = state or SUCCEEDED
+                self.result = result
+            else:
+                self.state = state or FAILED
+                self.error = error
+        self._changed()
+
+    def check_superseded(self):
+        """
+        Raise Superseded if a newer request with this job's key has replaced it. See JobQueue.submit_once.
+        """
+        if self._superseded is not None and self._superseded():
+            raise Superseded("Job {} was superseded by a newer request".format(self.id))
+
+    @property
+    def stage(self):
+        """
+        The stage running now. Stages of one job can run in parallel, then they are all listed.
+        """
+        return ", ".join(self.active_stages) or None
+
+    @property
+    def done(self):
+        return self.state in FINISHED_STATES
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "id": self.id,
+                "name": self.name,
+                "params": self.params,
+                "state": self.state,
+                "stage": self.stage,
+                "stages": [dict(s) for s in self.stages],
+                "result": self.result,
+                "error": self.error,
+                "created": self.created,
+                "started": self.started,
+                "finished": self.finished,
+            }
+
+
+class JobQueue(object):
+    """
+    Runs jobs on a bounded thread pool and remembers the most recent ones.
+    """
+
+    def __init__(self, max_workers=None, history=None, record_dir=None):
+        if max_workers is None:
+            max_workers = config.MAX_CONCURRENT_DEPLOYS
+        if history is None:
+            history = config.JOB_HISTORY
+        if record_dir is None:
+            record_dir = path.join(config.STATE_DIR, "jobs")
+        self.max_workers = max(1, int(max_workers))
+        self.history = max(1, int(history))
+        self.record_dir = record_dir
+        self._executor = None
+        self._jobs = OrderedDict()
+        # Claims on keys, when there is no record dir to keep them in
+        self._keys = {}
+        self._lock = threading.Lock()
+        self._keys_lock = threading.Lock()
+
+    @property
+    def executor(self):
+        # Created lazily, so the pool's threads are started in the worker process, not in the gunicorn master.
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def submit(self, name, func, *args, params=None, **kwargs):
+        """
+        Queue `func(job, *args, **kwargs)` to run in the background.
+        The return value of `func` becomes the job's result, an exception marks the job failed.
+        :return: the new job
+        :rtype: Job
+        """
+        job = Job(name, params=params)
+        job.add_listener(self._save_record)
+        with self._lock:
+            self._jobs[job.id] = job
+            self._trim()
+        self._save_record(job)
+        self.executor.submit(self._run, job, func, args, kwargs)
+        return job
+
+    def submit_once(self, key, name, func, *args, params=None, debounce=None, **kwargs):
+        """
+        Like submit, but while a job submitted with the same key is queued or running, in this or another
+        autopyweb worker, that job is returned instead of starting a new one.
+        With `debounce`, a new job first waits until no request with its key has come for that many seconds,
+        and requests made while it waits attach to it. A request made after that starts a new job which
+        supersedes the running one, see Job.check_superseded. The job waits on a timer, queued, so it doesn't
+        hold one of the pool's threads until it is ready to run.
+        :param key: identifies the work, like the origin, ref and dirname of a deploy
+        :type key: str
+        :param debounce: seconds, None to always attach to the running job
+        :return: the job record, and whether it is of a job which was already running
+        :rtype: tuple
+        """
+        with self._key_lock():
+            claim, record = self._find_key(key)
+            if record is not None and (debounce is None or claim["waiting"]):
+                if debounce is not None:
+                    # Restart the wait, so the job fetches the newest commit once the pushes stop
+                    claim["requested"] = time.time()
+                    self._save_key(claim)
+                return record, True
+            job = Job(name, params=params)
+            job.add_listener(self._save_record)
+            generation = claim["generation"] + 1 if claim is not None else 1
+            job._superseded = partial(self._superseded, key, generation)
+            with self._lock:
+                self._jobs[job.id] = job
+                self._trim()
+            self._save_record(job)
+            self._save_key(
+                {
+                    "key": key,
+                    "job_id": job.id,
+                    "owner": os.getpid(),
+                    "generation": generation,
+                    "requested": time.time(),
+                    "waiting": debounce is not None,
+                }
+            )
+            if debounce is None:
+                self.executor.submit(self._run, job, func, args, kwargs, key)
+            else:
+                self._wait(debounce, job.start_stage("debounce"), job, func, args, kwargs, key, debounce)
+            return job.to_dict(), False
+
+    def _wait(self, delay, stage, *args):
+        timer = threading.Timer(delay, self._debounce, args=(stage,) + args)
+        timer.daemon = True
+        timer.start()
+
+    def _debounce(self, stage, job, func, args, kwargs, key, debounce):
+        try:
+            remaining = self._settle(key, job, debounce)
+        except Exception as e:
+            job.finish_stage(stage, False)
+            if isinstance(e, Superseded):
+                job.mark_finished(error=str(e), state=SUPERSEDED)
+            else:
+                job.mark_finished(error=repr(e))
+            self._release_key(key, job.id)
+            return
+        if remaining > 0:
+            # Another request came meanwhile
+            self._wait(remaining, stage, job, func, args, kwargs, key, debounce)
+            return
+        job.finish_stage(stage, True)
+        self.executor.submit(self._run, job, func, args, kwargs, key)
+
+    def _run(self, job, func, args, kwargs, key=None):
+        job.mark_running()
+        try:
+            result = func(job, *args, **kwargs)
+        except Superseded as e:
+            job.mark_finished(error=str(e), state=SUPERSEDED)
+        except Exception as e:
+            job.mark_finished(error=repr(e))
+        else:
+            job.mark_finished(result=result)
+        finally:
+            if key is not None:
+                self._release_key(key, job.id)
+
+    def _settle(self, key, job, debounce):
+        """
+        Once no request with this key has come for `debounce` seconds, stop requests attaching to the job.
+        :return: seconds left to wait, 0 once settled
+        :rtype: float
+        """
+        with self._key_lock():
+            claim = self._load_key(key)
+            if claim is None or claim["job_id"] != job.id:
+                raise Superseded("Job {} was superseded while it waited".format(job.id))
+            remaining = claim["requested"] + debounce - time.time()
+            if remaining <= 0:
+                claim["waiting"] = False
+                self._save_key(claim)
+                return 0
+            return remaining
+
+    @contextmanager
+    def _key_lock(self):
+        # Held only while a key is looked up or changed, so different deploys are never held up
+        with self._keys_lock:
+            if self.record_dir is False:
+                yield
+                return
+            with FileLock(path.join(self.record_dir, "keys", "keys.lock")):
+                yield
+
+    def _key_file(self, key):
+        digest = hashlib.sha1(key.encode("utf-8")).hexdigest()
+        return path.join(self.record_dir, "keys", "{}.json".format(digest))
+
+    def _load_key(self, key):
+        if self.record_dir is False:
+            claim = self._keys.get(key, None)
+            return None if claim is None else dict(claim)
+        try:
+            with open(self._key_file(key), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _save_key(self, claim):
+        if self.record_dir is False:
+            self._keys[claim["key"]] = claim
+            return
+        key_file = self._key_file(claim["key"])
+        tmp_file = "{}.{}-{}.tmp".format(key_file, os.getpid(), threading.get_ident())
+        try:
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(claim, f)
+            os.replace(tmp_file, key_file)
+        except OSError as e:
+            print("Cannot save job key {}: {}".format(claim["job_id"], repr(e)))
+
+    def _find_key(self, key):
+        """
+        :return: the claim on a key, and the record of its job if that is still queued or running
+        """
+        claim = self._load_key(key)
+        if claim is None:
+            return None, None
+        if claim["owner"] == os.getpid():
+            with self._lock:
+                job = self._jobs.get(claim["job_id"], None)
+            record = None if job is None else job.to_dict()
+        elif pid_alive(claim["owner"]):
+            record = self._load_record(claim["job_id"])
+        else:
+            # Of a worker which died before finishing the job
+            record = None
+        if record is None or record["state"] in FINISHED_STATES:
+            return claim, None
+        return claim, record
+
+    def _superseded(self, key, generation):
+        claim = self._load_key(key)
+        return claim is not None and claim["generation"] > generation
+
+    def _release_key(self, key, job_id):
+        with self._key_lock():
+            claim = self._load_key(key)
+            if claim is None or claim["job_id"] != job_id:
+                # Already claimed by the job which superseded this one
+                return
+            if self.record_dir is False:
+                self._keys.pop(key, None)
+                return
+            try:
+                os.unlink(self._key_file(key))
+            except OSError:
+                pass
+
+    def _trim(self):
+        # Forget the oldest finished jobs. Never forget a job which is still queued or running.
+        excess = len(self._jobs) - self.history
+        if excess <= 0:
+            return
+        for job_id in list(self._jobs.keys()):
+            if excess <= 0:
+                break
+            if self._jobs[job_id].done:
+                del self._jobs[job_id]
+                self._remove_record(job_id)
+                excess -= 1
+
+    def _record_file(self, job_id):
+        return path.join(self.record_dir, "{}.json".format(path.basename(job_id)))
+
+    def _save_record(self, job):
+        if self.record_dir is False:
+            return
+        try:
+            os.makedirs(self.record_dir, exist_ok=True)
+            record_file = self._record_file(job.id)
+            tmp_file = "{}.{}-{}.tmp".format(record_file, os.getpid(), threading.get_ident())
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(job.to_dict(), f)
+            os.replace(tmp_file, record_file)
+        except OSError as e:
+            print("Cannot save job record {}: {}".format(job.id, repr(e)))
+
+    def _remove_record(self, job_id):
+        if self.record_dir is False:
+            return
+        try:
+            os.unlink(self._record_file(job_id))
+        except OSError:
+            pass
+
+    def _load_record(self, job_id):
+        if self.record_dir is False:
+            return None
+        try:
+            with open(self._record_file(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def get(self, job_id):
+        """
+        Get a job record by id, including jobs started by another autopyweb worker.
+        :return: job record, or None if not found
+        :rtype: dict | None
+        """
+        with self._lock:
+            job = self._jobs.get(job_id, None)
+        if job is not None:
+            return job.to_dict()
+        return self._load_record(job_id)
+
+    def list(self, limit=50, offset=0):
+        """
+        Known job records, newest first.
+        :param limit: records in a page, at most MAX_PAGE
+        :return: one page of records, and the number of records known
+        :rtype: tuple
+        """
+        records = {}
+        if self.record_dir is not False and path.isdir(self.record_dir):
+            for f in os.listdir(self.record_dir):
+                if not f.endswith(".json"):
+                    continue
+                record = self._load_record(f[:-5])
+                if record is not None:
+                    records[record["id"]] = record
+        with self._lock:
+            jobs = list(self._jobs.values())
+        for job in jobs:
+            records[job.id] = job.to_dict()
+        limit = max(0, min(int(limit), MAX_PAGE))
+        offset = max(0, int(offset))
+        found = sorted(records.values(), key=lambda r: r["created"], reverse=True)
+        return found[offset : offset + limit], len(found)
+
+
+job_queue = JobQueue()
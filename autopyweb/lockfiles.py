@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Reads pyproject.toml and poetry.lock directly, without installing poetry.
+A poetry.lock pins every package of a project and the hashes of its files, so the locked requirement set
+can be installed with a single `pip install --require-hashes --no-deps`, which checks every file and never
+resolves anything. Environment markers and `python` constraints are evaluated for the interpreter the project
+is installed with, so the set only holds what that interpreter needs.
+"""
+import re
+
+from packaging.markers import Marker
+from packaging.specifiers import SpecifierSet
+
+try:
+    import tomllib as _toml  # type: ignore  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import toml as _toml  # type: ignore
+
+_name = re.compile(r"^\s*([A-Za-z0-9][A-Za-z0-9._-]*)\s*(?:\[([^\]]*)\])?")
+
+# Packages from these sources have no file hashes, and pip can't install them from a hash-checked list
+UNLOCKABLE_SOURCES = ("git", "directory", "file", "url")
+
+
+class Unlockable(ValueError):
+    pass
+
+
+def read_toml(file_path):
+    """
+    :rtype: dict
+    :raises ValueError: if the file isn't valid TOML
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        return _toml.loads(f.read())
+
+
+def canonical_name(name):
+    # PEP 503
+    return re.sub(r"[-_.]+", "-", str(name)).lower()
+
+
+def _parse_requirement(requirement):
+    """
+    :return: canonical name, extras and environment marker of a PEP 508 requirement, or None
+    """
+    requirement, _, marker = str(requirement).partition(";")
+    match = _name.match(requirement)
+    if match is None:
+        return None
+    extras = [e.strip() for e in (match.group(2) or "").split(",") if e.strip()]
+    return canonical_name(match.group(1)), extras, marker.strip() or None
+
+
+_constraint = re.compile(r"(\^|~=|~|==|!=|<=|>=|<|>|=)?\s*(\*|[0-9]+(?:\.[0-9]+)*(?:\.\*)?)")
+
+
+def python_specifiers(constraint):
+    """
+    Translate a poetry version constraint, like "^3.6" or ">=2.7,<3.0 || >=3.5", into PEP 440.
+    Like poetry, a bare version of Python means that minor version, "3.6" is any 3.6.
+    :return: the alternatives, any of which must match
+    :rtype: list
+    """
+    alternatives = []
+    for alternative in str(constraint).split("||"):
+        specs = []
+        for op, version in _constraint.findall(alternative):
+            if version == "*":
+                continue
+            parts = version.split(".")
+            if op in ("^", "~"):
+                numbers = [int(p) for p in parts]
+                if op == "^":
+                    # Up to the next change of the first number which isn't zero
+                    upto = next((i for i, n in enumerate(numbers) if n != 0), len(numbers) - 1)
+                else:
+                    upto = min(1, len(numbers) - 1)
+                upper = numbers[:upto] + [numbers[upto] + 1]
+                specs += [">={}".format(version), "<{}".format(".".join(str(n) for n in upper))]
+            elif op in ("", "=", "=="):
+                if "*" not in version and len(parts) < 3:
+                    version += ".*"
+                specs.append("=={}".format(version))
+            else:
+                specs.append(op + version)
+        alternatives.append(SpecifierSet(",".join(specs)))
+    return alternatives
+
+
+def applies(environment, marker=None, python=None):
+    """
+    :param environment: marker environment of the interpreter, see autopyweb.venvs.marker_environment
+    :param marker: PEP 508 environment marker
+    :param python: poetry constraint on the Python version
+    :return: whether a dependency with this marker and constraint is needed there
+    :raises ValueError: if either can't be parsed
+    """
+    if marker and not Marker(marker).evaluate(dict(environment, extra="")):
+        return False
+    if python:
+        version = environment["python_full_version"]
+        return any(s.contains(version, prereleases=True) for s in python_specifiers(python))
+    return True
+
+
+def is_poetry_project(pyproject):
+    return "poetry" in pyproject.get("tool", {})
+
+
+def pep621_requirements(pyproject):
+    """
+    The dependencies in the [project] table of PEP 621, or None if there are none or they are dynamic.
+    :rtype: list | None
+    """
+    project = pyproject.get("project", None)
+    if not project or "dependencies" in project.get("dynamic", []):
+        return None
+    return list(project.get("dependencies", []))
+
+
+def root_requirements(pyproject, environment):
+    """
+    The main dependencies declared in pyproject.toml, in poetry's table or in PEP 621's.
+    Optional dependencies are left out, dev dependencies are in tables of their own, and so are those
+    whose marker or Python constraint rules them out.
+    :param environment: marker environment of the interpreter, see autopyweb.venvs.marker_environment
+    :return: canonical name and extras of each, or None if none are declared at all
+    :rtype: list | None
+    """
+    declared = False
+    roots = []
+    poetry = pyproject.get("tool", {}).get("poetry", {})
+    for name, spec in (poetry.get("dependencies", None) or {}).items():
+        if canonical_name(name) == "python":
+            continue
+        declared = True
+        specs = spec if isinstance(spec, list) else [spec]
+        for s in specs:
+            if isinstance(s, dict):
+                if s.get("optional", False) or not applies(environment, s.get("markers", None), s.get("python", None)):
+                    continue
+                roots.append((canonical_name(name), list(s.get("extras", []))))
+            else:
+                roots.append((canonical_name(name), []))
+    for requirement in pep621_requirements(pyproject) or []:
+        declared = True
+        parsed = _parse_requirement(requirement)
+        if parsed is not None and applies(environment, parsed[2]):
+            roots.append(parsed[:2])
+    return roots if declared else None
+
+
+def _dependencies(package, environment):
+    # Yield the canonical name and extras of each dependency a locked package needs in this environment
+    for name, spec in (package.get("dependencies", None) or {}).items():
+        specs = spec if isinstance(spec, list) else [spec]
+        needed = False
+        extras = []
+        for s in specs:
+            if isinstance(s, dict):
+                if s.get("optional", False) or not applies(environment, s.get("markers", None), s.get("python", None)):
+                    continue
+                extras.extend(s.get("extras", []))
+            needed = True
+        if needed:
+            yield canonical_name(name), extras
+
+
+def _walk(packages, roots, environment):
+    # Every package needed by the roots in this environment
+    extras_seen = {}
+    stack = list(roots)
+    while stack:
+        name, extras = stack.pop()
+        package = packages.get(name, None)
+        if package is None:
+            raise Unlockable("{} is not in poetry.lock, it is out of date".format(name))
+        if name in extras_seen and extras_seen[name].issuperset(extras):
+            continue
+        extras_seen.setdefault(name, set()).update(extras)
+        stack.extend(_dependencies(package, environment))
+        for extra in extras:
+            for requirement in (package.get("extras", None) or {}).get(extra, []):
+                # Like "httptools (>=0.5.0)", or a PEP 508 requirement
+                parsed = _parse_requirement(str(requirement).split("(", 1)[0])
+                if parsed is not None and applies(environment, parsed[2]):
+                    stack.append(parsed[:2])
+    return set(extras_seen.keys())
+
+
+def locked_requirements(lock, pyproject, environment):
+    """
+    The pinned and hashed requirement set of a project's main dependencies, from its poetry.lock.
+    Reads the lock files of poetry 1.0 and 1.1, which keep hashes under [metadata.files], and of later
+    versions, which keep them with each package.
+    A package with only an sdist is locked by the hash of the sdist, pip builds it after checking that.
+    :param lock: the parsed poetry.lock
+    :param pyproject: the parsed pyproject.toml
+    :param environment: marker environment of the interpreter, see autopyweb.venvs.marker_environment
+    :return: requirement lines for `pip install --require-hashes --no-deps`
+    :rtype: list
+    :raises Unlockable: if some package can't be installed that way, like one from a git repo
+    """
+    packages = {canonical_name(p["name"]): p for p in lock.get("package", [])}
+    metadata_files = lock.get("metadata", {}).get("files", None) or {}
+    metadata_files = {canonical_name(k): v for k, v in metadata_files.items()}
+    roots = root_requirements(pyproject, environment)
+    if roots is not None:
+        needed = _walk(packages, roots, environment)
+    else:
+        # Older locks mark the category of each package instead
+        needed = set(
+            n
+            for n, p in packages.items()
+            if p.get("category", "main") == "main"
+            and not p.get("optional", False)
+            and applies(environment, p.get("marker", None))
+        )
+    lines = []
+    for name in sorted(needed):
+        package = packages[name]
+        source = package.get("source", None) or {}
+        if source.get("type", None) in UNLOCKABLE_SOURCES:
+            raise Unlockable("{} is installed from a {} source".format(name, source["type"]))
+        files = package.get("files", None) or metadata_files.get(name, [])
+        hashes = sorted(f["hash"] for f in files if f.get("hash", None))
+        if not hashes:
+            raise Unlockable("{} has no file hashes in poetry.lock".format(name))
+        line = "{}=={}".format(package["name"], package["version"])
+        lines.append(line + "".join(" --hash={}".format(h) for h in hashes))
+    return lines
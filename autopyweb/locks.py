@@ -0,0 +1,119 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Advisory file locks, shared between threads and between autopyweb worker processes.
+"""
+import fcntl
+import os
+import time
+from os import path
+
+
+class LockTimeout(RuntimeError):
+    pass
+
+
+class FileLock(object):
+    """
+    An exclusive `flock` on a lock file.
+    Every FileLock opens its own file description, so two FileLocks on the same path exclude each other
+    whether they are in different threads or different processes.
+    """
+
+    poll_interval = 0.1
+
+    def __init__(self, lock_path, timeout=None):
+        self.lock_path = lock_path
+        self.timeout = timeout
+        self._fd = None
+
+    @property
+    def locked(self):
+        return self._fd is not None
+
+    def acquire(self, blocking=True, timeout=None):
+        """
+        :param blocking: wait for the lock if somebody else holds it
+        :param timeout: maximum seconds to wait, None waits forever
+        :return: True if the lock was acquired
+        :rtype: bool
+        """
+        if self._fd is not None:
+            raise RuntimeError("Lock already held: {}".format(self.lock_path))
+        if timeout is None:
+            timeout = self.timeout
+        lock_dir = path.dirname(self.lock_path)
+        if lock_dir:
+            os.makedirs(lock_dir, exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o666)
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (BlockingIOError, PermissionError):
+                if not blocking or (end is not None and time.time() >= end):
+                    os.close(fd)
+                    return False
+                time.sleep(self.poll_interval)
+                continue
+            except Exception:
+                os.close(fd)
+                raise
+            self._fd = fd
+            return True
+
+    def release(self):
+        fd = self._fd
+        if fd is None:
+            return
+        self._fd = None
+        try:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            os.close(fd)
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout("Timed out waiting for lock: {}".format(self.lock_path))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+
+class FileSemaphore(object):
+    """
+    At most `count` holders at once, across threads and processes. Each slot is a FileLock.
+    """
+
+    def __init__(self, lock_dir, count):
+        self.lock_dir = lock_dir
+        self.count = max(1, int(count))
+        self._held = None
+
+    def acquire(self, blocking=True, timeout=None):
+        if self._held is not None:
+            raise RuntimeError("Semaphore slot already held: {}".format(self._held.lock_path))
+        end = None if timeout is None else time.time() + timeout
+        while True:
+            for i in range(self.count):
+                lock = FileLock(path.join(self.lock_dir, "slot-{:d}.lock".format(i)))
+                if lock.acquire(blocking=False):
+                    self._held = lock
+                    return True
+            if not blocking or (end is not None and time.time() >= end):
+                return False
+            time.sleep(FileLock.poll_interval)
+
+    def release(self):
+        held, self._held = self._held, None
+        if held is not None:
+            held.release()
+
+    def __enter__(self):
+        if not self.acquire():
+            raise LockTimeout("Timed out waiting for a slot: {}".format(self.lock_dir))
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
@@ -0,0 +1,426 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Deployment metrics, rendered in the Prometheus text exposition format.
+Every autopyweb worker keeps its own metrics and saves them to the state dir whenever they change,
+so `/metrics` on any worker can report the totals for the whole host.
+Counters and histograms of workers which have exited are kept, gauges only count live workers.
+The snapshots of exited workers are folded into one, so they don't pile up with every restart.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from os import path
+from typing import Optional
+
+from . import config
+from .locks import FileLock
+
+# The counters and histograms of every worker which has exited, summed
+RETIRED = "retired"
+
+# Seconds. Deploy stages take anything from milliseconds (linking) to many minutes (building wheels)
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200, float("inf"))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labelnames, labelvalues, extra=()):
+    pairs = list(zip(labelnames, labelvalues)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in pairs) + "}"
+
+
+def labels(**values):
+    """
+    Format the labels of a sample returned by a function registered with Registry.derive.
+    """
+    names = sorted(values.keys())
+    return _format_labels(names, [values[k] for k in names])
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class Metric(object):
+    kind = None  # type: Optional[str]
+
+    def __init__(self, name, documentation, labelnames=(), registry=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._registry = registry
+        if registry is not None:
+            registry.register(self)
+
+    def _key(self, labels):
+        if set(labels.keys()) != set(self.labelnames):
+            raise ValueError("{} takes labels {}, not {}".format(self.name, self.labelnames, tuple(labels.keys())))
+        return tuple(str(labels[k]) for k in self.labelnames)
+
+    def _changed(self):
+        if self._registry is not None:
+            self._registry.changed()
+
+    def _lock(self):
+        if self._registry is not None:
+            return self._registry.lock
+        return threading.Lock()
+
+    def snapshot(self):
+        with self._lock():
+            return [
+                [list(k), dict(v, buckets=list(v["buckets"])) if isinstance(v, dict) else v]
+                for k, v in self._values.items()
+            ]
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock():
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+    def get(self, **labels):
+        return self._values.get(self._key(labels), 0)
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, values):
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock():
+            self._values[key] = self._values.get(key, 0) + amount
+        self._changed()
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock():
+            self._values[key] = value
+        self._changed()
+
+    @contextmanager
+    def track_inprogress(self, **labels):
+        self.inc(**labels)
+        try:
+            yield
+        finally:
+            self.dec(**labels)
+
+    @staticmethod
+    def merge(a, b):
+        return a + b
+
+    def samples(self, values):
+        for key, value in values:
+            yield self.name, _format_labels(self.labelnames, key), value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), registry=None, buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames=labelnames, registry=registry)
+        buckets = sorted(float(b) for b in buckets)
+        if buckets[-1] != float("inf"):
+            buckets.append(float("inf"))
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock():
+            found = self._values.get(key, None)
+            if found is None:
+                found = self._values[key] = {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0}
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    found["buckets"][i] += 1
+                    break
+            found["sum"] += value
+            found["count"] += 1
+        self._changed()
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    @staticmethod
+    def merge(a, b):
+        return {
+            "buckets": [x + y for x, y in zip(a["buckets"], b["buckets"])],
+            "sum": a["sum"] + b["sum"],
+            "count": a["count"] + b["count"],
+        }
+
+    def samples(self, values):
+        for key, value in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets, value["buckets"]):
+                cumulative += count
+                le = (("le", _format_value(bound)),)
+                yield self.name + "_bucket", _format_labels(self.labelnames, key, le), cumulative
+            yield self.name + "_sum", _format_labels(self.labelnames, key), value["sum"]
+            yield self.name + "_count", _format_labels(self.labelnames, key), value["count"]
+
+
+class Registry(object):
+    def __init__(self, record_dir=None):
+        """
+        :param record_dir: where each worker saves its metrics, False to report only this worker's metrics
+        """
+        if record_dir is None:
+            record_dir = config.METRICS_DIR
+        self.record_dir = record_dir
+        self.lock = threading.RLock()
+        self._metrics = []
+        self._instance = "{:d}-{:s}".format(os.getpid(), uuid.uuid4().hex[:8])
+        self._derived = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def derive(self, func):
+        """
+        Register a function which adds gauges computed from the merged values at render time.
+        It is called with the merged values by metric name, and returns (name, documentation, samples).
+        """
+        self._derived.append(func)
+        return func
+
+    def _record_file(self, instance):
+        return path.join(self.record_dir, "{}.json".format(instance))
+
+    def snapshot(self):
+        return {"pid": os.getpid(), "metrics": {m.name: m.snapshot() for m in self._metrics}}
+
+    def changed(self):
+        if self.record_dir is False:
+            return
+        if self._instance.split("-", 1)[0] != str(os.getpid()):
+            # Forked since this registry was made, this is another worker
+            self._instance = "{:d}-{:s}".format(os.getpid(), uuid.uuid4().hex[:8])
+        try:
+            os.makedirs(self.record_dir, exist_ok=True)
+            record_file = self._record_file(self._instance)
+            tmp_file = "{}.{}.tmp".format(record_file, threading.get_ident())
+            with self.lock:
+                snapshot = self.snapshot()
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(snapshot, f)
+            os.replace(tmp_file, record_file)
+        except OSError as e:
+            print("Cannot save metrics: {}".format(repr(e)))
+
+    def _read(self, instance):
+        try:
+            with open(self._record_file(instance), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, instance, snapshot):
+        record_file = self._record_file(instance)
+        tmp_file = "{}.{}-{}.tmp".format(record_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(snapshot, f)
+        os.replace(tmp_file, record_file)
+
+    def fold(self, snapshots):
+        """
+        Add the counters and histograms of exited workers to the retired snapshot, and remove their own.
+        Their gauges are dropped, those only count live workers.
+        :param snapshots: the snapshots of exited workers, by instance
+        :return: the retired snapshot, holding them
+        :rtype: dict
+        """
+        with FileLock(self._record_file(RETIRED) + ".lock"):
+            retired = self._read(RETIRED) or {"pid": None, "metrics": {}}
+            # Folded, but maybe not yet removed when the worker folding them died
+            folded = [i for i in retired.get("folded", []) if path.exists(self._record_file(i))]
+            kinds = {m.name: m for m in self._metrics}
+            for instance, snapshot in snapshots.items():
+                if not path.exists(self._record_file(instance)) or instance in folded:
+                    # Folded by another worker meanwhile
+                    continue
+                for name, values in snapshot["metrics"].items():
+                    metric = kinds.get(name, None)
+                    if metric is None or metric.kind == "gauge":
+                        continue
+                    merged = {tuple(k): v for k, v in retired["metrics"].get(name, [])}
+                    for key, value in values:
+                        found = merged.get(tuple(key), None)
+                        merged[tuple(key)] = value if found is None else metric.merge(found, value)
+                    retired["metrics"][name] = [[list(k), v] for k, v in merged.items()]
+                folded.append(instance)
+            retired["folded"] = folded
+            self._write(RETIRED, retired)
+            for instance in folded:
+                try:
+                    os.unlink(self._record_file(instance))
+                except OSError:
+                    pass
+            return retired
+
+    def _snapshots(self):
+        snapshots = [self.snapshot()]
+        if self.record_dir is False or not path.isdir(self.record_dir):
+            return snapshots
+        exited = {}
+        for f in os.listdir(self.record_dir):
+            instance = f[: -len(".json")]
+            if not f.endswith(".json") or instance in (self._instance, RETIRED):
+                continue
+            snapshot = self._read(instance)
+            if snapshot is None:
+                continue
+            if _pid_alive(snapshot["pid"]):
+                snapshots.append(snapshot)
+            else:
+                exited[instance] = snapshot
+        # Read after the others, a snapshot folded meanwhile is either still listed or in here
+        retired = self._read(RETIRED)
+        if exited:
+            try:
+                retired = self.fold(exited)
+            except OSError as e:
+                print("Cannot fold metrics: {}".format(repr(e)))
+                snapshots.extend(exited.values())
+        if retired is not None:
+            snapshots.append(retired)
+        return snapshots
+
+    def collect(self):
+        """
+        The values of every metric, summed over every worker.
+        :return: values by metric name, each a dict of label values to value
+        :rtype: dict
+        """
+        merged = {m.name: {} for m in self._metrics}
+        kinds = {m.name: m for m in self._metrics}
+        for snapshot in self._snapshots():
+            alive = snapshot["pid"] is not None and _pid_alive(snapshot["pid"])
+            for name, values in snapshot["metrics"].items():
+                metric = kinds.get(name, None)
+                if metric is None or (metric.kind == "gauge" and not alive):
+                    continue
+                for key, value in values:
+                    key = tuple(key)
+                    found = merged[name].get(key, None)
+                    merged[name][key] = value if found is None else metric.merge(found, value)
+        return merged
+
+    def render(self):
+        """
+        :return: every metric in the Prometheus text format
+        :rtype: str
+        """
+        merged = self.collect()
+        lines = []
+        for m in self._metrics:
+            lines.append("# HELP {} {}".format(m.name, m.documentation))
+            lines.append("# TYPE {} {}".format(m.name, m.kind))
+            for name, labels, value in m.samples(sorted(merged[m.name].items())):
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        for func in self._derived:
+            name, documentation, samples = func(merged)
+            lines.append("# HELP {} {}".format(name, documentation))
+            lines.append("# TYPE {} gauge".format(name))
+            for labels, value in samples:
+                lines.append("{}{} {}".format(name, labels, _format_value(value)))
+        return "\n".join(lines) + "\n"
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+registry = Registry()
+
+stage_duration = Histogram(
+    "autopyweb_stage_duration_seconds", "Time taken by each deploy stage.", ("stage",), registry=registry
+)
+stage_results = Counter(
+    "autopyweb_stage_results_total",
+    "Deploy stages finished, by stage and result.",
+    ("stage", "result"),
+    registry=registry,
+)
+time_to_ready = Histogram(
+    "autopyweb_time_to_ready_seconds", "Time from launching an app until it is warmed up.", registry=registry
+)
+deploy_results = Counter("autopyweb_deploys_total", "Deploys finished, by result.", ("result",), registry=registry)
+deploys_in_flight = Gauge("autopyweb_deploys_in_flight", "Deploys running now.", registry=registry)
+deploys_waiting = Gauge("autopyweb_deploys_waiting", "Deploys waiting for a free deploy slot.", registry=registry)
+cache_requests = Counter(
+    "autopyweb_cache_requests_total",
+    "Lookups in autopyweb's caches (introspection, mirror, plan, venv, venv_pool, wheelhouse), by result.",
+    ("cache", "result"),
+    registry=registry,
+)
+
+
+@registry.derive
+def _cache_hit_ratio(merged):
+    totals = {}
+    for (cache, result), count in merged[cache_requests.name].items():
+        hits, total = totals.get(cache, (0, 0))
+        totals[cache] = (hits + (count if result == "hit" else 0), total + count)
+    samples = [(_format_labels(("cache",), (cache,)), hits / total) for cache, (hits, total) in sorted(totals.items())]
+    return "autopyweb_cache_hit_ratio", "Share of cache lookups which were hits.", samples
+
+
+@contextmanager
+def stage_timer(stage):
+    """
+    Time a deploy stage, and count whether it succeeded.
+    """
+    started = time.time()
+    result = "failure"
+    try:
+        yield
+        result = "success"
+    finally:
+        stage_duration.observe(time.time() - started, stage=stage)
+        stage_results.inc(stage=stage, result=result)
+
+
+def cache_lookup(cache, hit):
+    cache_requests.inc(cache=cache, result="hit" if hit else "miss")
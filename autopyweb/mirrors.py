@@ -0,0 +1,365 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A long-lived store of bare mirror repositories, one per origin.
+Deploying from an origin we have seen before only fetches the objects that are new since last time.
+"""
+import hashlib
+import os
+import re
+import time
+from contextlib import contextmanager
+from os import path
+from shutil import rmtree
+from urllib.parse import urlsplit
+
+from git import Repo  # type: ignore
+from git.exc import BadName, GitCommandError  # type: ignore
+
+from . import config
+from .disk import dir_size, remove_tree, trash
+from .locks import FileLock
+
+REMOTE_NAME = "origin"
+LAST_USED_FILE = "autopyweb-last-used"
+
+_scp_like = re.compile(r"^(?:[^@/]+@)?([^:/]+):(?!//)(.+)$")
+_full_sha = re.compile(r"^[0-9a-f]{40}$")
+
+
+def normalise_origin(origin_url):
+    """
+    Reduce an origin url to a canonical form, so different spellings of the same origin share one mirror.
+    `git@github.com:a/b.git`, `ssh://git@github.com/a/b` and `https://user:pw@GitHub.com/a/b/` all
+    normalise to `github.com/a/b`.
+    :param origin_url:
+    :type origin_url: str
+    :return: normalised origin
+    :rtype: str
+    """
+    origin_url = origin_url.strip()
+    if path.isabs(origin_url):
+        host, repo_path = "", path.normpath(origin_url)
+    else:
+        match = _scp_like.match(origin_url)
+        if match and "://" not in origin_url:
+            host, repo_path = match.group(1), match.group(2)
+        else:
+            parts = urlsplit(origin_url)
+            if parts.scheme == "file":
+                host, repo_path = "", path.normpath(parts.path)
+            else:
+                host, repo_path = parts.hostname or "", parts.path
+    repo_path = repo_path.strip("/")
+    if repo_path.endswith(".git"):
+        repo_path = repo_path[:-4]
+    if host:
+        return "{}/{}".format(host.lower(), repo_path)
+    return "/" + repo_path
+
+
+class FetchPlan(object):
+    """
+    What to fetch from an origin for one deploy: exactly one ref, or one commit.
+    """
+
+    def __init__(self, kind, name, refspec, local_ref):
+        self.kind = kind
+        self.name = name
+        self.refspec = refspec
+        self.local_ref = local_ref
+
+    def __repr__(self):
+        return "FetchPlan({}={})".format(self.kind, self.name)
+
+
+def plan_fetch(tag=None, branch=None, commit=None):
+    """
+    Work out the narrowest fetch which gets the requested tag, branch or commit.
+    With none of them, plans a fetch of the master branch.
+    :rtype: FetchPlan
+    """
+    if tag is not None:
+        tag = str(tag)
+        local_ref = "refs/tags/{:s}".format(tag)
+        return FetchPlan("tag", tag, "+refs/tags/{:s}:{:s}".format(tag, local_ref), local_ref)
+    if commit is not None:
+        commit = str(commit).strip().lower()
+        if _full_sha.match(commit):
+            # Keep a ref to every commit we fetched by sha, so it isn't garbage collected from the mirror
+            local_ref = "refs/autopyweb/commits/{:s}".format(commit)
+            return FetchPlan("commit", commit, "+{:s}:{:s}".format(commit, local_ref), local_ref)
+        # An abbreviated sha can't be fetched directly, it can only be found amongst fetched branches
+        return FetchPlan("commit", commit, "+refs/heads/*:refs/remotes/{:s}/*".format(REMOTE_NAME), None)
+    if branch is None:
+        branch = "master"
+    local_ref = "refs/remotes/{r:s}/{b:s}".format(r=REMOTE_NAME, b=str(branch))
+    return FetchPlan("branch", str(branch), "+refs/heads/{:s}:{:s}".format(str(branch), local_ref), local_ref)
+
+
+def _resolve(repo, rev):
+    try:
+        return repo.commit(rev)
+    except (BadName, ValueError, GitCommandError):
+        return None
+
+
+def fetch_plan(repo, plan, depth=None, blob_filter=None):
+    """
+    Fetch one planned ref into a mirror, and resolve it to a commit.
+    A commit which is already in the mirror is not fetched again.
+    :param repo: the bare mirror, as yielded by MirrorStore.open
+    :param plan:
+    :type plan: FetchPlan
+    :param depth: history depth to fetch, 0 for full history. Defaults to config.FETCH_DEPTH
+    :param blob_filter: partial clone filter like "blob:none", or None. Defaults to config.FETCH_FILTER
+    :return: the commit
+    :rtype: git.Commit
+    """
+    if plan.kind == "commit":
+        found = _resolve(repo, plan.name)
+        if found is not None:
+            return found
+    try:
+        _fetch(repo, [plan.refspec], depth, blob_filter)
+    except GitCommandError as e:
+        raise RuntimeError("{} not found on that origin: {}\n{}".format(plan.kind.title(), plan.name, str(e)))
+    found = _resolve(repo, plan.local_ref or plan.name)
+    if found is None:
+        raise RuntimeError("{} not found on that origin: {}".format(plan.kind.title(), plan.name))
+    print("Fetched {} {} at {}".format(plan.kind, plan.name, found.hexsha))
+    return found
+
+
+def fetch_plans(repo, plans, depth=None, blob_filter=None):
+    """
+    Fetch several planned refs into a mirror with a single fetch, and resolve each of them to a commit.
+    If that fetch fails, say because one of the refs doesn't exist, each ref is fetched on its own
+    so the others are still found.
+    See fetch_plan for the parameters.
+    :return: for each plan, its commit or the exception raised fetching it
+    :rtype: list
+    """
+    results = [None] * len(plans)
+    missing = []
+    for i, plan in enumerate(plans):
+        found = _resolve(repo, plan.name) if plan.kind == "commit" else None
+        if found is not None:
+            results[i] = found
+        else:
+            missing.append(i)
+    refspecs = []
+    for i in missing:
+        if plans[i].refspec not in refspecs:
+            refspecs.append(plans[i].refspec)
+    if not refspecs:
+        return results
+    try:
+        _fetch(repo, refspecs, depth, blob_filter)
+    except GitCommandError:
+        for i in missing:
+            try:
+                results[i] = fetch_plan(repo, plans[i], depth=depth, blob_filter=blob_filter)
+            except RuntimeError as e:
+                results[i] = e
+        return results
+    for i in missing:
+        plan = plans[i]
+        found = _resolve(repo, plan.local_ref or plan.name)
+        if found is None:
+            found = RuntimeError("{} not found on that origin: {}".format(plan.kind.title(), plan.name))
+        else:
+            print("Fetched {} {} at {}".format(plan.kind, plan.name, found.hexsha))
+        results[i] = found
+    return results
+
+
+def _fetch(repo, refspecs, depth=None, blob_filter=None):
+    # Run git fetch itself rather than Remote.fetch, whose parsing of the fetched refs fails
+    # with a TypeError on a refspec whose source is a commit sha
+    repo.git.fetch(REMOTE_NAME, *refspecs, **_fetch_kwargs(repo, depth, blob_filter))
+
+
+def _fetch_kwargs(repo, depth=None, blob_filter=None):
+    if depth is None:
+        depth = config.FETCH_DEPTH
+    if blob_filter is None:
+        blob_filter = config.FETCH_FILTER or None
+    fetch_kwargs = {}
+    if depth:
+        fetch_kwargs["depth"] = int(depth)
+    if blob_filter:
+        _enable_partial_clone(repo, blob_filter)
+        fetch_kwargs["filter"] = blob_filter
+    return fetch_kwargs
+
+
+def _enable_partial_clone(repo, blob_filter):
+    with repo.config_writer() as cw:
+        cw.set_value("core", "repositoryformatversion", 1)
+        cw.set_value("extensions", "partialclone", REMOTE_NAME)
+        cw.set_value('remote "{}"'.format(REMOTE_NAME), "promisor", "true")
+        cw.set_value('remote "{}"'.format(REMOTE_NAME), "partialclonefilter", blob_filter)
+
+
+class MirrorStore(object):
+    def __init__(self, location=None, max_bytes=None, max_age=None, lock_timeout=None):
+        if location is None:
+            location = config.MIRROR_DIR
+        if max_bytes is None:
+            max_bytes = config.MIRROR_MAX_BYTES
+        if max_age is None:
+            max_age = config.MIRROR_MAX_AGE
+        if lock_timeout is None:
+            lock_timeout = config.MIRROR_LOCK_TIMEOUT
+        self.location = location
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.lock_timeout = lock_timeout
+
+    def mirror_path(self, origin_url):
+        normalised = normalise_origin(origin_url)
+        digest = hashlib.sha1(normalised.encode("utf-8")).hexdigest()[:16]
+        name = re.sub(r"[^a-z0-9]+", "-", normalised.rsplit("/", 1)[-1].lower()).strip("-") or "repo"
+        return path.join(self.location, "{}-{}.git".format(name, digest))
+
+    def _lock(self, mirror_path, timeout=None):
+        if timeout is None:
+            timeout = self.lock_timeout
+        return FileLock(mirror_path + ".lock", timeout=timeout)
+
+    @contextmanager
+    def open(self, origin_url):
+        """
+        Lock the mirror for an origin and yield it as a bare Repo, creating it if it doesn't exist yet.
+        The `origin` remote always points at the url given here.
+        """
+        mirror_path = self.mirror_path(origin_url)
+        with self._lock(mirror_path):
+            if path.isdir(mirror_path):
+                try:
+                    repo = Repo(mirror_path)
+                except Exception as e:
+                    print("Discarding broken mirror {}: {}".format(mirror_path, repr(e)))
+                    rmtree(mirror_path, ignore_errors=True)
+                    repo = Repo.init(mirror_path, bare=True)
+            else:
+                repo = Repo.init(mirror_path, bare=True)
+            try:
+                remote = repo.remotes[REMOTE_NAME]
+                if remote.url != origin_url:
+                    with remote.config_writer as cw:
+                        cw.set("url", origin_url)
+            except IndexError:
+                repo.create_remote(REMOTE_NAME, origin_url)
+            self._touch(mirror_path)
+            try:
+                yield repo
+            finally:
+                repo.close()
+
+    def live_worktrees(self, mirror_path):
+        """
+        Checkouts which were made as worktrees of this mirror and still exist on disk.
+        Worktrees which have been deleted are pruned from the mirror first.
+        :return: list of worktree paths
+        :rtype: list
+        """
+        try:
+            repo = Repo(mirror_path)
+        except Exception:
+            return []
+        try:
+            repo.git.worktree("prune")
+            listing = repo.git.worktree("list", "--porcelain")
+        finally:
+            repo.close()
+        worktrees = []
+        for line in listing.splitlines():
+            if not line.startswith("worktree "):
+                continue
+            worktree = line[9:]
+            if path.normpath(worktree) != path.normpath(mirror_path):
+                worktrees.append(worktree)
+        return worktrees
+
+    def _touch(self, mirror_path):
+        last_used = path.join(mirror_path, LAST_USED_FILE)
+        with open(last_used, "a"):
+            pass
+        os.utime(last_used, None)
+
+    def _last_used(self, mirror_path):
+        try:
+            return os.stat(path.join(mirror_path, LAST_USED_FILE)).st_mtime
+        except OSError:
+            try:
+                return os.stat(mirror_path).st_mtime
+            except OSError:
+                return 0
+
+    def mirrors(self):
+        """
+        :return: list of (mirror_path, last_used, size_in_bytes), least recently used first
+        :rtype: list
+        """
+        if not path.isdir(self.location):
+            return []
+        found = []
+        for d in os.listdir(self.location):
+            mirror_path = path.join(self.location, d)
+            if not d.endswith(".git") or not path.isdir(mirror_path):
+                continue
+            found.append((mirror_path, self._last_used(mirror_path), dir_size(mirror_path)))
+        return sorted(found, key=lambda m: m[1])
+
+    def evict(self, max_bytes=None, max_age=None, now=None):
+        """
+        Remove mirrors not used in `max_age` seconds, then the least recently used ones until the whole
+        store fits in `max_bytes`. Mirrors which are currently locked by a deploy are never removed.
+        :return: list of removed mirror paths
+        :rtype: list
+        """
+        if max_bytes is None:
+            max_bytes = self.max_bytes
+        if max_age is None:
+            max_age = self.max_age
+        if now is None:
+            now = time.time()
+        mirrors = self.mirrors()
+        total = sum(m[2] for m in mirrors)
+        removed = []
+        for mirror_path, last_used, size in mirrors:
+            too_old = max_age is not None and max_age > 0 and (now - last_used) > max_age
+            too_big = max_bytes is not None and max_bytes > 0 and total > max_bytes
+            if not (too_old or too_big):
+                continue
+            if not self.remove(mirror_path):
+                continue
+            total -= size
+            removed.append(mirror_path)
+        return removed
+
+    def remove(self, mirror_path):
+        """
+        Remove a mirror, unless a deploy has it locked or deployed checkouts still share its objects.
+        It is renamed away at once, then its files are removed at the throttled rate of autopyweb.disk.
+        :return: True if it was removed
+        :rtype: bool
+        """
+        lock = self._lock(mirror_path)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            if self.live_worktrees(mirror_path):
+                return False
+            trashed = trash(mirror_path)
+        finally:
+            lock.release()
+        if trashed is None:
+            return False
+        remove_tree(trashed)
+        return True
+
+
+mirror_store = MirrorStore()
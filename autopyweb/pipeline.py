@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A small dependency-graph runner for deployment stages.
+Each stage names the stages it requires. A stage starts as soon as everything it requires has finished,
+so stages which don't depend on each other run at the same time.
+"""
+import time
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from . import tracing
+from .metrics import stage_timer
+
+
+class Stage(object):
+    def __init__(self, name, func, requires=(), critical=True, cancellable=True):
+        """
+        :param name: name of the stage. Its result is stored in the pipeline context under this name.
+        :param func: called with the pipeline context dict, returns the stage result
+        :param requires: names of stages (or seeded context keys) which must be finished first
+        :param critical: if False, a failure of this stage is logged and doesn't fail the pipeline
+        :param cancellable: if False, the stage is started even once the pipeline's job has been superseded,
+          for stages which must finish what an earlier stage started
+        """
+        self.name = name
+        self.func = func
+        self.requires = tuple(requires)
+        self.critical = critical
+        self.cancellable = cancellable
+
+    def __repr__(self):
+        return "Stage({})".format(self.name)
+
+
+class Pipeline(object):
+    def __init__(self, stages, max_workers=4):
+        self.stages = list(stages)
+        self.max_workers = max_workers
+        names = [s.name for s in self.stages]
+        if len(set(names)) != len(names):
+            raise RuntimeError("Duplicate stage names in pipeline: {}".format(names))
+
+    def _check(self, ctx):
+        # Every requirement must be a stage or a seeded context key, and the graph must be acyclic
+        available = set(ctx.keys())
+        remaining = list(self.stages)
+        while remaining:
+            ready = [s for s in remaining if all(r in available for r in s.requires)]
+            if not ready:
+                raise RuntimeError("Pipeline stages can never run: {}".format(remaining))
+            for s in ready:
+                available.add(s.name)
+                remaining.remove(s)
+
+    def _run_stage(self, stage, ctx, job, trace):
+        with stage_timer(stage.name), tracing.activate(trace), tracing.span(stage.name, "stage"):
+            if job is not None:
+                with job.run_stage(stage.name):
+                    return stage.func(ctx)
+            return stage.func(ctx)
+
+    def run(self, ctx=None, job=None):
+        """
+        Run every stage, as parallel as the dependencies allow.
+        The first critical stage to fail stops any more stages from starting, and its exception is raised
+        once the stages already running have finished. Once the job is superseded by a newer one, which is
+        checked before each cancellable stage starts, no more cancellable stages start, nor any stage which
+        requires one of those. Superseded is raised if any stage skipped this way was critical.
+        :param ctx: seed values for the pipeline context
+        :param job: job to record stage timings against
+        :type job: autopyweb.jobs.Job
+        :return: the pipeline context, holding every stage result under its stage name
+        :rtype: dict
+        """
+        ctx = dict(ctx or {})
+        self._check(ctx)
+        timings = ctx.setdefault("timings", {})
+        pending = list(self.stages)
+        running = {}
+        failure = None
+        superseded = None
+        # Stages run in other threads, take the trace of this deploy along
+        trace = tracing.current()
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while pending or running:
+                if failure is None:
+                    for stage in [s for s in pending if all(r in ctx for r in s.requires)]:
+                        if stage.cancellable and job is not None and superseded is None:
+                            try:
+                                job.check_superseded()
+                            except Exception as e:
+                                superseded = e
+                        pending.remove(stage)
+                        if superseded is not None and stage.cancellable:
+                            if stage.critical and failure is None:
+                                failure = superseded
+                            continue
+                        future = executor.submit(self._run_stage, stage, ctx, job, trace)
+                        running[future] = (stage, time.time())
+                if failure is not None:
+                    pending = []
+                if not running:
+                    break
+                finished, _ = wait(list(running.keys()), return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage, started = running.pop(future)
+                    timings[stage.name] = time.time() - started
+                    exc = future.exception()
+                    if exc is None:
+                        ctx[stage.name] = future.result()
+                    elif stage.critical:
+                        if failure is None:
+                            failure = exc
+                    else:
+                        print("Non-critical stage {} failed: {}".format(stage.name, repr(exc)))
+                        ctx[stage.name] = None
+        # Stages left pending required a skipped one, so were skipped too
+        if failure is None and any(s.critical for s in pending):
+            failure = superseded
+        if failure is not None:
+            raise failure
+        return ctx
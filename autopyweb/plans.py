@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A cache of deployment plans: everything worked out about a checkout before it can be launched.
+That is its project type, requirements, venv key, framework and gunicorn settings.
+Working it out can run setup.py, `poetry export` and gunicorn.conf.py, so a redeploy of a commit we have seen,
+or of any commit whose manifests are unchanged, reuses the plan instead.
+Plans are keyed by a hash of the manifests of the checkout, and each deployed commit is indexed to its key.
+A plan is only used while the other files its setup.py read are unchanged too.
+"""
+import json
+import os
+import threading
+from os import path
+
+from . import config
+from .introspection import input_digests
+from .requirements import read_requirements
+from .venvs import requirements_key, interpreter_id
+
+# The files a plan is worked out from
+MANIFESTS = ("pyproject.toml", "poetry.lock", "setup.py", "setup.cfg", "requirements.txt", "gunicorn.conf.py")
+
+# Bump when the contents of a plan change, so plans saved by an older autopyweb aren't used
+PLAN_VERSION = 6
+
+
+def manifest_key(project_dir):
+    """
+    Hash the manifests of a checkout, together with the interpreter its venv is built with.
+    :rtype: str
+    """
+    files = [path.join(project_dir, f) for f in MANIFESTS if path.isfile(path.join(project_dir, f))]
+    requirements_txt = path.join(project_dir, "requirements.txt")
+    if path.isfile(requirements_txt):
+        # And the files it includes
+        files.extend(f for f in read_requirements(requirements_txt)[0][1:] if path.isfile(f))
+    return requirements_key(files=files, texts=["plan-{:d}".format(PLAN_VERSION)])
+
+
+def plain_settings(settings):
+    """
+    The settings which can be saved in a plan. gunicorn.conf.py can also hold hooks and modules,
+    gunicorn loads those itself when it runs the app.
+    :rtype: dict
+    """
+    plain = (str, int, float, bool, type(None))
+    found = {}
+    for k, v in settings.items():
+        if k.startswith("_"):
+            continue
+        if isinstance(v, plain) or (isinstance(v, (list, tuple)) and all(isinstance(i, plain) for i in v)):
+            found[k] = v
+    return found
+
+
+class PlanStore(object):
+    def __init__(self, location=None, history=None):
+        """
+        :param location: where plans are kept
+        :param history: number of plans and commits to keep, the oldest are forgotten
+        """
+        if location is None:
+            location = config.PLAN_DIR
+        if history is None:
+            history = config.PLAN_HISTORY
+        self.location = location
+        self.history = history
+
+    def _plan_file(self, key):
+        return path.join(self.location, "{}.json".format(path.basename(key)))
+
+    def _commit_file(self, commit):
+        return path.join(self.location, "commits", "{}.json".format(path.basename(commit)))
+
+    def _read(self, file_path):
+        try:
+            with open(file_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _write(self, file_path, content):
+        os.makedirs(path.dirname(file_path), exist_ok=True)
+        tmp_file = "{}.{}-{}.tmp".format(file_path, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            # Requirements from setup.py may be Requirement objects rather than strings
+            json.dump(content, f, default=str)
+        os.replace(tmp_file, file_path)
+
+    def lookup(self, project_dir, commit=None):
+        """
+        Find the plan of a checkout. By its commit if that was deployed before, else by its manifests.
+        :param commit: full sha of the checkout, if known
+        :return: the plan or None, and the manifest key to save a new plan under
+        :rtype: tuple
+        """
+        if commit is not None:
+            indexed = self._read(self._commit_file(commit))
+            if indexed is not None and indexed.get("python", None) == interpreter_id():
+                plan = self._read(self._plan_file(indexed["key"]))
+                if self._valid(plan, project_dir):
+                    return plan, indexed["key"]
+        key = manifest_key(project_dir)
+        plan = self._read(self._plan_file(key))
+        if not self._valid(plan, project_dir):
+            return None, key
+        if commit is not None:
+            self._index(commit, key)
+        return plan, key
+
+    def _valid(self, plan, project_dir):
+        # Another plan with the same manifests may have been saved since, from a checkout whose setup.py
+        # read different files
+        inputs = plan.get("inputs", {}) if plan is not None else None
+        return plan is not None and (not inputs or input_digests(project_dir, inputs) == inputs)
+
+    def save(self, key, plan, commit=None, project_dir=None):
+        """
+        :param key: manifest key, from lookup
+        :param plan: dict of JSON values
+        :param commit: full sha of the checkout the plan was worked out from
+        :param project_dir: that checkout, to note the other files its project's setup.py read
+        """
+        inputs = plan.get("project", {}).get("inputs", None)
+        if project_dir is not None and inputs:
+            plan = dict(plan, inputs=input_digests(project_dir, inputs))
+        self._write(self._plan_file(key), dict(plan, key=key))
+        if commit is not None:
+            self._index(commit, key)
+        self.prune()
+
+    def _index(self, commit, key):
+        # The manifest key already covers the interpreter, the commit alone doesn't
+        self._write(self._commit_file(commit), {"key": key, "python": interpreter_id()})
+
+    def prune(self):
+        """
+        Forget all but the newest `history` plans, and commits.
+        """
+        for location in (self.location, path.join(self.location, "commits")):
+            try:
+                files = [path.join(location, f) for f in os.listdir(location) if f.endswith(".json")]
+                files.sort(key=lambda f: os.stat(f).st_mtime, reverse=True)
+            except OSError:
+                continue
+            for f in files[self.history :]:
+                try:
+                    os.unlink(f)
+                except OSError:
+                    pass
+
+
+plan_store = PlanStore()
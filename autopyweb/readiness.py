@@ -0,0 +1,127 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Checks that a launched app is ready to take requests.
+An app is ready once its unix socket accepts connections and it has answered a few warm-up HTTP requests,
+so the cost of its cold start is paid here rather than by its first real users.
+"""
+import http.client
+import socket
+import time
+
+from .supervisor import supervisor, FATAL, STOPPED
+
+POLL_INTERVAL = 0.05
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    An HTTP connection to a server listening on a unix socket.
+    """
+
+    def __init__(self, sock_path, timeout=10):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.sock_path = sock_path
+
+    def connect(self):
+        s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        s.settimeout(self.timeout)
+        try:
+            s.connect(self.sock_path)
+        except OSError:
+            s.close()
+            raise
+        self.sock = s
+
+
+def socket_accepts(sock_path):
+    """
+    :return: True if something is accepting connections on the unix socket
+    :rtype: bool
+    """
+    s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        s.settimeout(1.0)
+        s.connect(sock_path)
+    except OSError:
+        return False
+    finally:
+        s.close()
+    return True
+
+
+def _check_alive(process_name):
+    if process_name is None:
+        return
+    record = supervisor.get(process_name)
+    if record is None or record["state"] in (FATAL, STOPPED):
+        raise RuntimeError("App stopped before it was ready: {}".format(process_name))
+
+
+def wait_for_socket(sock_path, timeout, process_name=None):
+    """
+    Wait until the app accepts connections on its unix socket.
+    :param process_name: name of the supervised process serving the socket, stop waiting if it gives up
+    :return: seconds it took
+    :rtype: float
+    """
+    started = time.time()
+    end = started + timeout
+    while not socket_accepts(sock_path):
+        _check_alive(process_name)
+        if time.time() >= end:
+            raise RuntimeError("App not ready after {}s: {}".format(timeout, sock_path))
+        time.sleep(POLL_INTERVAL)
+    return time.time() - started
+
+
+def warm_up(sock_path, url_path, deadline, process_name=None):
+    """
+    Send one GET request through the unix socket, retrying until the app answers without a server error.
+    :param deadline: give up at this time
+    :return: the status code and how long the successful request took
+    :rtype: tuple
+    """
+    while True:
+        started = time.time()
+        conn = UnixHTTPConnection(sock_path, timeout=max(0.1, deadline - started))
+        try:
+            conn.request("GET", url_path, headers={"User-Agent": "autopyweb-warmup"})
+            resp = conn.getresponse()
+            resp.read()
+            if resp.status < 500:
+                return resp.status, time.time() - started
+            error = "HTTP {}".format(resp.status)
+        except (OSError, http.client.HTTPException) as e:
+            error = repr(e)
+        finally:
+            conn.close()
+        _check_alive(process_name)
+        if time.time() >= deadline:
+            raise RuntimeError("App not ready, warm-up request to {} failed: {}".format(url_path, error))
+        time.sleep(POLL_INTERVAL)
+
+
+def probe(sock_path, timeout, process_name=None, warmup_paths=(), warmup_rounds=1, launched=None):
+    """
+    Wait until the app is ready: its socket accepts connections, and every warm-up path has answered
+    `warmup_rounds` times. All of that must happen within `timeout` seconds.
+    :param launched: when the app was started, to measure its time to ready from
+    :return: timings of the probe
+    :rtype: dict
+    """
+    started = time.time()
+    deadline = started + timeout
+    socket_wait = wait_for_socket(sock_path, timeout, process_name=process_name)
+    requests = []
+    for url_path in warmup_paths:
+        for _ in range(max(1, warmup_rounds)):
+            status, duration = warm_up(sock_path, url_path, deadline, process_name=process_name)
+            requests.append({"path": url_path, "status": status, "duration": duration})
+    finished = time.time()
+    return {
+        "socket_wait": socket_wait,
+        "warmup": finished - started - socket_wait,
+        "warmup_requests": requests,
+        "time_to_ready": finished - (started if launched is None else launched),
+    }
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Blue/green releases behind a dirname link.
+Each deployed commit is a release in its own checkout directory, serving its own socket. A dirname link like
+`{project}-pr021` points at the live release, and is switched from one release to the next with an atomic rename.
+The release it replaced is kept running for a while, so rolling back is just switching the link back.
+After that it is stopped and removed in the background.
+"""
+import json
+import os
+import threading
+import time
+import uuid
+from os import path
+
+from . import config
+from .disk import discard
+from .locks import FileLock
+from .supervisor import supervisor, RUNNING
+
+
+def release_in_use(release_path):
+    """
+    :return: True if any dirname link next to the release points at it
+    :rtype: bool
+    """
+    release_path = path.realpath(release_path)
+    location = path.dirname(release_path)
+    try:
+        entries = os.listdir(location)
+    except OSError:
+        return False
+    for e in entries:
+        link = path.join(location, e)
+        if path.islink(link) and path.realpath(link) == release_path:
+            return True
+    return False
+
+
+def release_warm(release_path):
+    """
+    :return: True if the release's app is running
+    :rtype: bool
+    """
+    record = supervisor.get(path.basename(release_path))
+    return record is not None and record["state"] == RUNNING
+
+
+def stop_release(release_path, wait=True):
+    pid_file = path.join(release_path, "gunicorn.pid")
+    return supervisor.stop(path.basename(release_path), wait=wait, pid_file=pid_file)
+
+
+def replace_link(link_path, target):
+    """
+    Point `link_path` at `target` in one atomic rename, so there is never a moment without the link.
+    """
+    tmp_link = path.join(path.dirname(link_path), ".{}.{}.tmp".format(path.basename(link_path), uuid.uuid4().hex))
+    os.symlink(target, tmp_link)
+    try:
+        os.replace(tmp_link, link_path)
+    except BaseException:
+        os.unlink(tmp_link)
+        raise
+
+
+class StaleRelease(RuntimeError):
+    pass
+
+
+class ReleaseStore(object):
+    def __init__(self, record_dir=None, keep_warm=None):
+        """
+        :param record_dir: where the release history of each link is kept
+        :param keep_warm: seconds to keep a replaced release running before it is removed
+        """
+        if record_dir is None:
+            record_dir = config.RELEASE_DIR
+        if keep_warm is None:
+            keep_warm = config.RELEASE_KEEP_WARM
+        self.record_dir = record_dir
+        self.keep_warm = keep_warm
+
+    def _record_file(self, link_path):
+        return path.join(self.record_dir, "{}.json".format(path.basename(link_path)))
+
+    def _lock(self, link_path):
+        return FileLock(path.join(self.record_dir, "{}.lock".format(path.basename(link_path))))
+
+    def _load(self, link_path):
+        try:
+            with open(self._record_file(link_path), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {"link": link_path, "current": None, "previous": None, "switched": None, "retiring": {}}
+
+    def _save(self, record):
+        os.makedirs(self.record_dir, exist_ok=True)
+        record_file = self._record_file(record["link"])
+        tmp_file = "{}.{}-{}.tmp".format(record_file, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(record, f)
+        os.replace(tmp_file, record_file)
+
+    def get(self, link_path):
+        """
+        The release history of a link, with whether each release is still running.
+        :rtype: dict
+        """
+        record = self._load(link_path)
+        for k in ("current", "previous"):
+            record["{}_warm".format(k)] = bool(record[k]) and release_warm(record[k])
+        return record
+
+    def switch(self, link_path, release_path, since=None):
+        """
+        Point the link at a release. The release it replaces becomes the rollback target,
+        and is retired once it has been kept warm for `keep_warm` seconds.
+        :param since: when the deploy of this release started. If the link was switched after that,
+          by a newer deploy or a rollback, StaleRelease is raised rather than undoing that switch.
+        :return: the replaced release, or None
+        """
+        release_path = path.realpath(release_path)
+        with self._lock(link_path):
+            record = self._load(link_path)
+            if since is not None and record["switched"] is not None and record["switched"] > since:
+                if record["current"] != release_path:
+                    raise StaleRelease(
+                        "{} was switched to a newer release while this one was deployed".format(
+                            path.basename(link_path)
+                        )
+                    )
+            old = path.realpath(link_path) if path.islink(link_path) else None
+            if old == release_path:
+                return None
+            replace_link(link_path, release_path)
+            record.update(current=release_path, switched=time.time())
+            record["retiring"].pop(release_path, None)
+            if old is not None and path.isdir(old):
+                record["previous"] = old
+                record["retiring"][old] = time.time() + self.keep_warm
+            self._save(record)
+        self.retire_later(self.keep_warm)
+        return old
+
+    def rollback(self, link_path, relaunch=None):
+        """
+        Point the link back at the release it replaced.
+        :param relaunch: called with the previous release if its app isn't running any more.
+          It must start the app and return once the app is ready.
+        :return: the release now live
+        """
+        record = self._load(link_path)
+        previous = record["previous"]
+        if not previous or not path.isdir(previous):
+            raise RuntimeError("No previous release to roll back to: {}".format(path.basename(link_path)))
+        if not release_warm(previous):
+            if relaunch is None:
+                raise RuntimeError("Previous release is not running: {}".format(path.basename(previous)))
+            relaunch(previous)
+        self.switch(link_path, previous)
+        return previous
+
+    def releases(self):
+        """
+        Every release some link points at, may be rolled back to, or is being kept warm.
+        :rtype: set
+        """
+        found = set()
+        if not path.isdir(self.record_dir):
+            return found
+        for f in os.listdir(self.record_dir):
+            if not f.endswith(".json"):
+                continue
+            record = self._load(path.join(self.record_dir, f[:-5]))
+            found.update(r for r in (record["current"], record["previous"]) if r)
+            found.update(record["retiring"].keys())
+        return found
+
+    def retire_later(self, delay):
+        timer = threading.Timer(max(0, delay) + 0.1, self._sweep_logged)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def _sweep_logged(self):
+        try:
+            self.sweep()
+        except Exception as e:
+            print("Retiring old releases failed: {}".format(repr(e)))
+
+    def sweep(self, now=None):
+        """
+        Stop and remove replaced releases whose keep-warm time is over.
+        A release which a link points at again is kept.
+        :return: list of removed releases
+        :rtype: list
+        """
+        if now is None:
+            now = time.time()
+        if not path.isdir(self.record_dir):
+            return []
+        removed = []
+        for f in os.listdir(self.record_dir):
+            if not f.endswith(".json"):
+                continue
+            link_path = self._load(path.join(self.record_dir, f[:-5]))["link"]
+            with self._lock(link_path):
+                record = self._load(link_path)
+                due = [r for r, at in record["retiring"].items() if at <= now]
+                for release in due:
+                    del record["retiring"][release]
+                    if release_in_use(release):
+                        continue
+                    stop_release(release)
+                    # Renamed away at once, its files are removed at a throttled rate in the background
+                    discard(release)
+                    removed.append(release)
+                if due:
+                    self._save(record)
+        return removed
+
+
+release_store = ReleaseStore()
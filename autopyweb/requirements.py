@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Reads requirements.txt files the way pip does, following the files they include with -r and -c.
+A venv shared by deployments is keyed by every file its requirement set is read from, so a change to an
+included file gets a new venv. Editable and local path requirements name something in the checkout itself,
+they are kept apart to be installed for that checkout alone.
+"""
+import re
+from os import path
+
+_include = re.compile(r"^(-r|--requirement|-c|--constraint)(?:\s*=\s*|\s+)(\S+)$")
+_editable = re.compile(r"^(-e|--editable)(?:\s*=\s*|\s+|(?=[.~/]))")
+
+
+def requirement_lines(file_path):
+    """
+    The lines of a requirements file, with continuations joined and comments dropped.
+    :rtype: generator
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        text = f.read().replace("\\\n", " ")
+    for line in text.splitlines():
+        line = line.split(" #", 1)[0].strip()
+        if line and not line.startswith("#"):
+            yield line
+
+
+def is_local(line):
+    """
+    :return: whether a requirement line is editable or names a local path, like `-e .` or `./libs/foo`
+    :rtype: bool
+    """
+    if _editable.match(line):
+        return True
+    if line.startswith("-"):
+        # Other options, like --index-url or --find-links
+        return False
+    spec = line.split(";", 1)[0].strip()
+    if "@" in spec and not spec.startswith(("@", ".", "/")):
+        return spec.split("@", 1)[1].strip().startswith("file:")
+    first = spec.split(None, 1)[0] if spec else ""
+    return first.startswith((".", "/", "~", "file:")) or ("/" in first and "://" not in first)
+
+
+def read_requirements(file_path):
+    """
+    Read a requirements file and the files it includes.
+    Requirements of included files are inlined, constraint files are referred to by their absolute path.
+    Relative paths in the lines themselves are left alone, pip reads those relative to where it runs.
+    An included file which can't be read is left to pip to complain about.
+    :return: the files read, the lines for a shared venv and the editable and local lines
+    :rtype: tuple
+    """
+    files, shared, local = [], [], []
+    _read(path.abspath(file_path), files, shared, local, constraint=False)
+    return files, shared, local
+
+
+def _read(file_path, files, shared, local, constraint):
+    if file_path in files:
+        return
+    files.append(file_path)
+    try:
+        lines = list(requirement_lines(file_path))
+    except OSError:
+        return
+    for line in lines:
+        match = _include.match(line)
+        if match is not None and "://" not in match.group(2):
+            included = path.join(path.dirname(file_path), match.group(2))
+            is_constraint = match.group(1) in ("-c", "--constraint")
+            if is_constraint and not constraint:
+                shared.append("-c {}".format(included))
+            _read(included, files, shared, local, constraint or is_constraint)
+        elif not constraint:
+            (local if is_local(line) else shared).append(line)
@@ -0,0 +1,533 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Supervises the gunicorn processes of deployed apps.
+Each app is a child of this autopyweb worker, started and watched from an asyncio loop running in its own thread.
+Stopping an app waits for the process to really exit, escalating from SIGTERM to SIGINT to SIGKILL,
+and an app which crashes is restarted with exponential backoff.
+Process records are also written to the state dir so any autopyweb worker can report on and stop every app.
+"""
+import asyncio
+import json
+import os
+import signal
+import sys
+import threading
+import time
+from os import path
+
+from . import config
+from .locks import FileLock
+
+STARTING = "starting"
+RUNNING = "running"
+BACKOFF = "backoff"
+STOPPING = "stopping"
+STOPPED = "stopped"
+FATAL = "fatal"
+
+LIVE_STATES = (STARTING, RUNNING, BACKOFF, STOPPING)
+
+# Seconds between checks on a process this worker can't wait on, because it is not our child
+POLL_INTERVAL = 0.05
+# Seconds between checks on an adopted process, which is watched for as long as it runs
+ADOPTED_POLL_INTERVAL = 1.0
+
+
+if sys.version_info < (3, 8):
+
+    class _ThreadedChildWatcher(asyncio.AbstractChildWatcher):
+        """
+        Waits for each child in a thread of its own, like the ThreadedChildWatcher of Python 3.8.
+        The watchers before it only work once attached to a loop in the main thread, the supervisor's loop isn't.
+        """
+
+        def add_child_handler(self, pid, callback, *args):
+            thread = threading.Thread(
+                target=self._wait, args=(pid, callback, args), name="autopyweb-waitpid-{:d}".format(pid), daemon=True
+            )
+            thread.start()
+
+        def _wait(self, pid, callback, args):
+            try:
+                _, status = os.waitpid(pid, 0)
+            except ChildProcessError:
+                # Reaped by somebody else, its exit status is lost
+                returncode = 255
+            else:
+                if os.WIFSIGNALED(status):
+                    returncode = -os.WTERMSIG(status)
+                elif os.WIFEXITED(status):
+                    returncode = os.WEXITSTATUS(status)
+                else:
+                    returncode = status
+            # The loop's own callback, which hands the exit over with call_soon_threadsafe
+            callback(pid, returncode, *args)
+
+        def remove_child_handler(self, pid):
+            return False
+
+        def attach_loop(self, loop):
+            pass
+
+        def close(self):
+            pass
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc_info):
+            pass
+
+
+def _watch_children():
+    # Python 3.8 and later watch children from any thread already, and so does uvloop
+    if sys.version_info >= (3, 8):
+        return
+    policy = asyncio.get_event_loop_policy()
+    if isinstance(policy, asyncio.DefaultEventLoopPolicy) and policy._watcher is None:
+        asyncio.set_child_watcher(_ThreadedChildWatcher())
+
+
+def pid_alive(pid, cwd=None):
+    """
+    :param cwd: if given, the process must also be running in this directory, so a reused pid isn't mistaken for it
+    :rtype: bool
+    """
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    if cwd is not None:
+        try:
+            return path.realpath(os.readlink("/proc/{:d}/cwd".format(pid))) == path.realpath(cwd)
+        except OSError:
+            pass
+    return True
+
+
+def _signal(pid, sig):
+    try:
+        if sig == signal.SIGKILL:
+            # Take the app's workers down with it, it was started in its own session
+            os.killpg(pid, sig)
+        else:
+            os.kill(pid, sig)
+    except (ProcessLookupError, PermissionError):
+        return False
+    return True
+
+
+class Process(object):
+    def __init__(self, name, argv, cwd, env=None, log_file=None, cleanup=()):
+        self.name = name
+        self.argv = list(argv)
+        self.cwd = cwd
+        self.env = env
+        self.log_file = log_file
+        self.cleanup = tuple(cleanup)
+        self.state = STARTING
+        self.pid = None
+        self.started = None
+        self.exit_code = None
+        self.exited = None
+        self.restarts = 0
+        self.crashes = 0
+        self.stop_requested = False
+        self._proc = None
+        self._task = None
+        self._stop_event = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "argv": self.argv,
+            "cwd": self.cwd,
+            "state": self.state,
+            "pid": self.pid,
+            "started": self.started,
+            "exit_code": self.exit_code,
+            "exited": self.exited,
+            "restarts": self.restarts,
+            "crashes": self.crashes,
+            "owner": os.getpid(),
+        }
+
+    def remove_leftovers(self):
+        for f in self.cleanup:
+            try:
+                os.unlink(path.join(self.cwd, f))
+            except OSError:
+                pass
+
+
+class Supervisor(object):
+    def __init__(
+        self,
+        record_dir=None,
+        stop_timeouts=None,
+        backoff=None,
+        backoff_max=None,
+        stable_after=None,
+        start_retries=None,
+    ):
+        """
+        :param record_dir: where process records are kept, False to keep none
+        :param stop_timeouts: seconds to wait after SIGTERM and after SIGINT before escalating
+        :param backoff: seconds before the first restart of a crashed app, doubled for each crash in a row
+        :param backoff_max: most seconds to wait before a restart
+        :param stable_after: an app which stays up this long has its crash count reset
+        :param start_retries: give up on an app after this many crashes in a row, 0 to never give up
+        """
+        if record_dir is None:
+            record_dir = config.PROCESS_DIR
+        if stop_timeouts is None:
+            stop_timeouts = (config.PROCESS_STOP_TIMEOUT, config.PROCESS_KILL_TIMEOUT)
+        if backoff is None:
+            backoff = config.PROCESS_RESTART_BACKOFF
+        if backoff_max is None:
+            backoff_max = config.PROCESS_RESTART_BACKOFF_MAX
+        if stable_after is None:
+            stable_after = config.PROCESS_STABLE_AFTER
+        if start_retries is None:
+            start_retries = config.PROCESS_START_RETRIES
+        self.record_dir = record_dir
+        term_timeout, int_timeout = stop_timeouts
+        # Signals sent in turn to stop an app, with how long to wait for it to exit after each one
+        self.escalation = ((signal.SIGTERM, term_timeout), (signal.SIGINT, int_timeout), (signal.SIGKILL, 5))
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.stable_after = stable_after
+        self.start_retries = start_retries
+        self._procs = {}
+        self._lock = threading.Lock()
+        self._loop = None
+
+    @property
+    def loop(self):
+        # Started lazily, so the loop's thread is started in the worker process, not in the gunicorn master.
+        with self._lock:
+            if self._loop is None:
+                _watch_children()
+                loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=loop.run_forever, name="autopyweb-supervisor", daemon=True)
+                thread.start()
+                self._loop = loop
+            return self._loop
+
+    def _call(self, coro, wait=True):
+        future = asyncio.run_coroutine_threadsafe(coro, self.loop)
+        if wait:
+            return future.result()
+        return future
+
+    def start(self, name, argv, cwd, env=None, log_file=None, cleanup=()):
+        """
+        Start a process and keep it running until it is stopped.
+        If a process of that name is already supervised, by this or another autopyweb worker, it is left alone.
+        If the worker which supervised it has died but the process still runs, this worker adopts it,
+        instead of starting a second one beside it.
+        :param name: unique name of the process
+        :param argv: command to run
+        :param cwd: directory to run it in
+        :param env: environment for the process
+        :param log_file: append the process's stdout and stderr to this file
+        :param cleanup: files in `cwd` to remove once the process has stopped, like its pid file and socket
+        :return: the process record
+        :rtype: dict
+        """
+        proc = Process(name, argv, cwd, env=env, log_file=log_file, cleanup=cleanup)
+        if self.record_dir is False:
+            return self._call(self._start(proc))
+        # Two autopyweb workers may be deploying the same release at once, only one of them launches it
+        with FileLock(self._record_file(name, ".lock")):
+            record = self._load_record(name)
+            if (
+                record is not None
+                and record["owner"] not in (None, os.getpid())
+                and record["state"] in LIVE_STATES
+                and pid_alive(record["owner"])
+            ):
+                return dict(record, supervised=True)
+            if (
+                record is not None
+                and record["state"] in LIVE_STATES
+                and record.get("pid", None)
+                and pid_alive(record["pid"], record["cwd"])
+            ):
+                return self._call(self._adopt(proc, record))
+            return self._call(self._start(proc))
+
+    def stop(self, name, wait=True, pid_file=None):
+        """
+        Stop a process and wait until it has exited.
+        Processes started by another autopyweb worker are stopped through their pid.
+        :param pid_file: pid file to fall back to when no record of the process exists
+        :param wait: wait for the process to exit
+        :return: the final process record, or None if there was no such process.
+          A future of that if not waiting.
+        """
+        return self._call(self._stop(name, pid_file), wait=wait)
+
+    def get(self, name):
+        """
+        :return: process record, or None if not found
+        :rtype: dict | None
+        """
+        with self._lock:
+            proc = self._procs.get(name, None)
+        if proc is not None:
+            return dict(proc.to_dict(), supervised=True)
+        record = self._load_record(name)
+        if record is not None:
+            record["supervised"] = pid_alive(record["owner"])
+        return record
+
+    def list(self):
+        """
+        Every known process record, including those of other autopyweb workers.
+        :rtype: list
+        """
+        records = {}
+        if self.record_dir is not False and path.isdir(self.record_dir):
+            for f in os.listdir(self.record_dir):
+                if f.endswith(".json"):
+                    record = self.get(f[:-5])
+                    if record is not None:
+                        records[record["name"]] = record
+        with self._lock:
+            procs = list(self._procs.values())
+        for proc in procs:
+            records[proc.name] = dict(proc.to_dict(), supervised=True)
+        return sorted(records.values(), key=lambda r: r["name"])
+
+    async def _start(self, proc):
+        with self._lock:
+            current = self._procs.get(proc.name, None)
+            if current is not None and current.state in LIVE_STATES:
+                return current.to_dict()
+            self._procs[proc.name] = proc
+        self._clear_stop_request(proc.name)
+        proc._stop_event = asyncio.Event()
+        try:
+            await self._spawn(proc)
+        except BaseException:
+            proc.state = FATAL
+            self._save_record(proc)
+            with self._lock:
+                del self._procs[proc.name]
+            raise
+        proc._task = asyncio.ensure_future(self._supervise(proc))
+        return proc.to_dict()
+
+    async def _adopt(self, proc, record):
+        # Not our child, so it is watched by polling until it exits, then restarted as our own
+        with self._lock:
+            current = self._procs.get(proc.name, None)
+            if current is not None and current.state in LIVE_STATES:
+                return current.to_dict()
+            self._procs[proc.name] = proc
+        self._clear_stop_request(proc.name)
+        proc._stop_event = asyncio.Event()
+        proc.pid = record["pid"]
+        proc.started = record.get("started", None) or time.time()
+        proc.restarts = record.get("restarts", 0)
+        proc.crashes = record.get("crashes", 0)
+        proc.state = RUNNING
+        self._save_record(proc)
+        print("Adopted process {} ({:d}), its supervisor has exited".format(proc.name, proc.pid))
+        proc._task = asyncio.ensure_future(self._supervise(proc))
+        return proc.to_dict()
+
+    async def _wait(self, proc):
+        if proc._proc is not None:
+            return await proc._proc.wait()
+        while pid_alive(proc.pid, proc.cwd):
+            await asyncio.sleep(POLL_INTERVAL if proc.stop_requested else ADOPTED_POLL_INTERVAL)
+        # The exit code of a process which isn't our child is lost
+        return None
+
+    async def _spawn(self, proc):
+        proc.state = STARTING
+        proc.exit_code = None
+        log = open(proc.log_file, "ab") if proc.log_file else asyncio.subprocess.DEVNULL
+        try:
+            proc._proc = await asyncio.create_subprocess_exec(
+                *proc.argv,
+                cwd=proc.cwd,
+                env=proc.env,
+                stdin=asyncio.subprocess.DEVNULL,
+                stdout=log,
+                stderr=asyncio.subprocess.STDOUT,
+                start_new_session=True,
+            )
+        finally:
+            if proc.log_file:
+                log.close()
+        proc.pid = proc._proc.pid
+        proc.started = time.time()
+        proc.state = RUNNING
+        self._save_record(proc)
+
+    async def _supervise(self, proc):
+        while True:
+            proc.exit_code = await self._wait(proc)
+            proc.exited = time.time()
+            if proc.stop_requested or self._stop_requested(proc.name):
+                break
+            if proc.exited - proc.started >= self.stable_after:
+                proc.crashes = 0
+            proc.crashes += 1
+            print("Process {} exited with {}".format(proc.name, proc.exit_code))
+            if self.start_retries and proc.crashes > self.start_retries:
+                proc.state = FATAL
+                self._save_record(proc)
+                proc.remove_leftovers()
+                return
+            proc.state = BACKOFF
+            self._save_record(proc)
+            delay = min(self.backoff * 2 ** (proc.crashes - 1), self.backoff_max)
+            try:
+                await asyncio.wait_for(proc._stop_event.wait(), delay)
+                break
+            except asyncio.TimeoutError:
+                pass
+            proc.restarts += 1
+            try:
+                await self._spawn(proc)
+            except OSError as e:
+                print("Cannot restart process {}: {}".format(proc.name, repr(e)))
+                proc.state = FATAL
+                self._save_record(proc)
+                return
+        proc.state = STOPPED
+        self._clear_stop_request(proc.name)
+        proc.remove_leftovers()
+        self._save_record(proc)
+
+    async def _stop(self, name, pid_file=None):
+        with self._lock:
+            proc = self._procs.get(name, None)
+        if proc is not None:
+            return await self._stop_own(proc)
+        record = self._load_record(name)
+        if record is not None and record["state"] in LIVE_STATES:
+            return await self._stop_other(record)
+        if pid_file is not None and path.isfile(pid_file):
+            # An app started before autopyweb supervised its apps
+            try:
+                with open(pid_file, "r") as f:
+                    pid = int(f.read().strip())
+            except (OSError, ValueError):
+                return None
+            cwd = path.dirname(path.abspath(pid_file))
+            record = {"name": name, "pid": pid, "cwd": cwd, "state": RUNNING, "owner": None}
+            record = await self._stop_other(record, save=False)
+            for f in (pid_file, path.join(cwd, "gunicorn.sock")):
+                try:
+                    os.unlink(f)
+                except OSError:
+                    pass
+            return record
+        return record
+
+    async def _stop_own(self, proc):
+        proc.stop_requested = True
+        proc._stop_event.set()
+        p = proc._proc
+        if p is not None and p.returncode is None:
+            proc.state = STOPPING
+            self._save_record(proc)
+            for sig, timeout in self.escalation:
+                if not _signal(p.pid, sig):
+                    break
+                try:
+                    await asyncio.wait_for(p.wait(), timeout)
+                    break
+                except asyncio.TimeoutError:
+                    print("Process {} still running after {}".format(proc.name, signal.Signals(sig).name))
+        elif p is None and pid_alive(proc.pid, proc.cwd):
+            # Adopted, not our child
+            proc.state = STOPPING
+            self._save_record(proc)
+            for sig, timeout in self.escalation:
+                if not pid_alive(proc.pid, proc.cwd) or not _signal(proc.pid, sig):
+                    break
+                end = time.time() + timeout
+                while time.time() < end and pid_alive(proc.pid, proc.cwd):
+                    await asyncio.sleep(POLL_INTERVAL)
+        if proc._task is not None:
+            await proc._task
+        with self._lock:
+            if self._procs.get(proc.name, None) is proc:
+                del self._procs[proc.name]
+        return proc.to_dict()
+
+    async def _stop_other(self, record, save=True):
+        # Not our child, so we can't wait on it. Tell its owner not to restart it, then poll until it is gone.
+        pid, cwd = record["pid"], record["cwd"]
+        if save:
+            self._request_stop(record["name"])
+        for sig, timeout in self.escalation:
+            if not pid_alive(pid, cwd) or not _signal(pid, sig):
+                break
+            end = time.time() + timeout
+            while time.time() < end and pid_alive(pid, cwd):
+                await asyncio.sleep(POLL_INTERVAL)
+        record = dict(record, state=STOPPED, exited=time.time())
+        if save and not (record["owner"] and pid_alive(record["owner"])):
+            # The owner is gone, so nobody else will record that the process stopped
+            self._clear_stop_request(record["name"])
+            self._write_record(record)
+        return record
+
+    def _record_file(self, name, suffix=".json"):
+        return path.join(self.record_dir, "{}{}".format(path.basename(name), suffix))
+
+    def _save_record(self, proc):
+        self._write_record(proc.to_dict())
+
+    def _write_record(self, record):
+        if self.record_dir is False:
+            return
+        try:
+            os.makedirs(self.record_dir, exist_ok=True)
+            record_file = self._record_file(record["name"])
+            tmp_file = "{}.{}-{}.tmp".format(record_file, os.getpid(), threading.get_ident())
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(record, f)
+            os.replace(tmp_file, record_file)
+        except OSError as e:
+            print("Cannot save process record {}: {}".format(record["name"], repr(e)))
+
+    def _load_record(self, name):
+        if self.record_dir is False:
+            return None
+        try:
+            with open(self._record_file(name), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _request_stop(self, name):
+        if self.record_dir is False:
+            return
+        os.makedirs(self.record_dir, exist_ok=True)
+        with open(self._record_file(name, ".stop"), "w") as f:
+            f.write(str(os.getpid()))
+
+    def _stop_requested(self, name):
+        return self.record_dir is not False and path.exists(self._record_file(name, ".stop"))
+
+    def _clear_stop_request(self, name):
+        if self.record_dir is False:
+            return
+        try:
+            os.unlink(self._record_file(name, ".stop"))
+        except OSError:
+            pass
+
+
+supervisor = Supervisor()
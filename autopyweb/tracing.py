@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Per-deploy traces in the Chrome trace event format, which chrome://tracing and Perfetto can load.
+A trace is a list of nested timing spans. Every subprocess run during a deploy is a span of its own,
+recording its argv, exit code, and its wall and CPU time.
+The active trace is kept per thread. Pipeline stages are run with the trace of the deploy they belong to.
+"""
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from os import path
+
+# Written into each release, next to its run.sh and gunicorn.log
+TRACE_FILE = "autopyweb-trace.json"
+
+_active = threading.local()
+
+_thread_time = getattr(time, "thread_time", None)
+
+
+class Trace(object):
+    def __init__(self):
+        self.started = time.time()
+        self.events = []
+        self.targets = []
+        self._threads = {}
+        self._lock = threading.Lock()
+
+    def _tid(self):
+        ident = threading.get_ident()
+        with self._lock:
+            tid = self._threads.get(ident, None)
+            if tid is None:
+                tid = self._threads[ident] = len(self._threads) + 1
+                self.events.append(
+                    {
+                        "name": "thread_name",
+                        "ph": "M",
+                        "pid": os.getpid(),
+                        "tid": tid,
+                        "args": {"name": threading.current_thread().name},
+                    }
+                )
+        return tid
+
+    def add(self, name, cat, started, duration, args=None):
+        """
+        Record a finished span.
+        :param started: time.time() when the span started
+        :param duration: seconds
+        """
+        event = {
+            "name": name,
+            "cat": cat,
+            "ph": "X",
+            "ts": int((started - self.started) * 1000000),
+            "dur": int(duration * 1000000),
+            "pid": os.getpid(),
+            "tid": self._tid(),
+            "args": args or {},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def to_dict(self):
+        with self._lock:
+            events = list(self.events)
+        return {"traceEvents": events, "displayTimeUnit": "ms", "otherData": {"started": self.started}}
+
+    def save(self, file_path):
+        os.makedirs(path.dirname(file_path), exist_ok=True)
+        tmp_file = "{}.{}-{}.tmp".format(file_path, os.getpid(), threading.get_ident())
+        with open(tmp_file, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+        os.replace(tmp_file, file_path)
+
+
+def current():
+    """
+    :return: the trace active in this thread, or None
+    :rtype: Trace | None
+    """
+    return getattr(_active, "trace", None)
+
+
+@contextmanager
+def activate(trace):
+    """
+    Make `trace` the active trace of this thread.
+    """
+    previous = current()
+    _active.trace = trace
+    try:
+        yield trace
+    finally:
+        _active.trace = previous
+
+
+@contextmanager
+def span(name, cat="autopyweb", **args):
+    """
+    Time a block as a span of the active trace. Does nothing if there is no active trace.
+    """
+    trace = current()
+    if trace is None:
+        yield args
+        return
+    started = time.time()
+    cpu_started = _thread_time() if _thread_time else None
+    try:
+        yield args
+    except BaseException as e:
+        args["error"] = repr(e)
+        raise
+    finally:
+        if cpu_started is not None:
+            args["thread_cpu"] = _thread_time() - cpu_started
+        trace.add(name, cat, started, time.time() - started, args)
+
+
+@contextmanager
+def traced(name, cat="deploy", **args):
+    """
+    Time a block as a span. If no trace is active, a new trace is started for it,
+    and saved to every file given to `save_to` when the block ends.
+    """
+    trace = current()
+    if trace is not None:
+        with span(name, cat, **args):
+            yield trace
+        return
+    trace = Trace()
+    try:
+        with activate(trace), span(name, cat, **args):
+            yield trace
+    finally:
+        for target in trace.targets:
+            try:
+                trace.save(target)
+            except OSError as e:
+                print("Cannot save trace {}: {}".format(target, repr(e)))
+
+
+def save_to(file_path):
+    """
+    Save the active trace to this file too once it is finished.
+    """
+    trace = current()
+    if trace is not None and file_path not in trace.targets:
+        trace.targets.append(file_path)
+
+
+def prune(trace_dir, keep):
+    """
+    Remove all but the newest `keep` traces in a directory.
+    """
+    if not path.isdir(trace_dir):
+        return
+    traces = [path.join(trace_dir, f) for f in os.listdir(trace_dir) if f.endswith(".json")]
+    traces.sort(key=lambda f: os.stat(f).st_mtime, reverse=True)
+    for f in traces[keep:]:
+        try:
+            os.unlink(f)
+        except OSError:
+            pass
+
+
+def _exit_code(status):
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def run(args, input=None, **kwargs):
+    """
+    `subprocess.run`, recorded as a span of the active trace with the process's argv, exit code,
+    wall time and CPU time.
+    :rtype: subprocess.CompletedProcess
+    """
+    trace = current()
+    both_piped = kwargs.get("stdout", None) == subprocess.PIPE and kwargs.get("stderr", None) == subprocess.PIPE
+    if trace is None or input is not None or both_piped:
+        # Untraced, or needs communicate(), which reaps the process itself so its CPU time can't be read
+        started = time.time()
+        resp = subprocess.run(args, input=input, **kwargs)
+        if trace is not None:
+            trace.add(_span_name(args), "subprocess", started, time.time() - started, _args(args, kwargs, resp))
+        return resp
+    started = time.time()
+    with subprocess.Popen(args, **kwargs) as proc:
+        stdout = stderr = None
+        try:
+            if proc.stdout is not None:
+                stdout = proc.stdout.read()
+            if proc.stderr is not None:
+                stderr = proc.stderr.read()
+            # wait4 gives the resource usage of this process alone, even while other threads run subprocesses
+            _, status, usage = os.wait4(proc.pid, 0)
+        except BaseException:
+            proc.kill()
+            proc.wait()
+            raise
+        proc.returncode = _exit_code(status)
+    resp = subprocess.CompletedProcess(proc.args, proc.returncode, stdout, stderr)
+    span_args = _args(args, kwargs, resp)
+    span_args.update(cpu_user=usage.ru_utime, cpu_system=usage.ru_stime, max_rss_kb=usage.ru_maxrss)
+    trace.add(_span_name(args), "subprocess", started, time.time() - started, span_args)
+    return resp
+
+
+def _span_name(args):
+    if isinstance(args, (str, bytes)):
+        return str(args).split(" ", 1)[0]
+    args = [str(a) for a in args]
+    # Like "pip3 install" or "python3 -m venv"
+    words = 3 if len(args) > 2 and args[1] == "-m" else 2
+    return " ".join([path.basename(args[0])] + args[1:words])
+
+
+def _args(args, kwargs, resp):
+    argv = args if isinstance(args, (str, bytes)) else [str(a) for a in args]
+    return {"argv": argv, "cwd": kwargs.get("cwd", None), "exit_code": resp.returncode}
@@ -0,0 +1,304 @@
+# -*- coding: utf-8 -*-
+#
+"""
+Resource usage of every deployed app: the CPU, memory, open files and threads of its gunicorn process tree.
+One collector thread samples every app at once. Each sample is a single pass over /proc, which reads each
+process on the host once however many apps there are, and each app's tree is found from that.
+Samples go into a fixed size ring buffer file for each app, written in place through mmap. Any autopyweb
+worker can read them, and only one worker on the host collects at a time.
+"""
+import mmap
+import os
+import struct
+import threading
+import time
+from os import path
+
+from . import config
+from .locks import FileLock
+from .supervisor import supervisor, LIVE_STATES
+
+# Fields of each sample. cpu is in cores, used since the sample before
+FIELDS = ("time", "cpu", "rss", "fds", "threads", "processes")
+
+_HEADER = struct.Struct("<4sIIQ")
+_MAGIC = b"APWU"
+_DATA_OFFSET = 24
+
+_clock_ticks = os.sysconf("SC_CLK_TCK") if hasattr(os, "sysconf") else 100
+_page_size = mmap.PAGESIZE
+
+
+class RingBuffer(object):
+    """
+    The newest `size` samples of one app, in a file of fixed size. The header holds the number of samples ever
+    written, which is updated after each sample, so a reader never sees a sample half written.
+    """
+
+    def __init__(self, file_path, size=None, fields=FIELDS):
+        self.file_path = file_path
+        self.fields = tuple(fields)
+        self._sample = struct.Struct("<{:d}d".format(len(self.fields)))
+        exists = path.isfile(file_path)
+        if size is None:
+            if not exists:
+                raise FileNotFoundError(file_path)
+            with open(file_path, "rb") as f:
+                magic, size, nfields, _ = _HEADER.unpack(f.read(_HEADER.size))
+            if magic != _MAGIC or nfields != len(self.fields):
+                raise ValueError("Not a usage ring buffer: {}".format(file_path))
+        self.size = int(size)
+        length = _DATA_OFFSET + self.size * self._sample.size
+        if not exists or path.getsize(file_path) != length:
+            os.makedirs(path.dirname(file_path), exist_ok=True)
+            tmp_file = "{}.{}-{}.tmp".format(file_path, os.getpid(), threading.get_ident())
+            with open(tmp_file, "wb") as f:
+                f.write(_HEADER.pack(_MAGIC, self.size, len(self.fields), 0))
+                f.truncate(length)
+            os.replace(tmp_file, file_path)
+        self._file = open(file_path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), length)
+
+    @property
+    def count(self):
+        return _HEADER.unpack_from(self._map, 0)[3]
+
+    def append(self, sample):
+        """
+        :param sample: dict with a value for each field
+        """
+        count = self.count
+        offset = _DATA_OFFSET + (count % self.size) * self._sample.size
+        self._sample.pack_into(self._map, offset, *(float(sample.get(f, 0) or 0) for f in self.fields))
+        _HEADER.pack_into(self._map, 0, _MAGIC, self.size, len(self.fields), count + 1)
+
+    def samples(self, limit=None):
+        """
+        :param limit: only the newest this many
+        :return: samples, oldest first
+        :rtype: list
+        """
+        count = self.count
+        n = min(count, self.size) if limit is None else min(count, self.size, limit)
+        found = []
+        for i in range(count - n, count):
+            values = self._sample.unpack_from(self._map, _DATA_OFFSET + (i % self.size) * self._sample.size)
+            found.append(dict(zip(self.fields, values)))
+        return found
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def read_processes():
+    """
+    One pass over /proc.
+    :return: dict of pid to its parent pid, CPU seconds, resident bytes and threads
+    :rtype: dict
+    """
+    processes = {}
+    for entry in os.listdir("/proc"):
+        if not entry.isdigit():
+            continue
+        try:
+            with open("/proc/{}/stat".format(entry), "rb") as f:
+                # The command name is in brackets and may contain spaces
+                fields = f.read().rsplit(b")", 1)[1].split()
+            processes[int(entry)] = (
+                int(fields[1]),
+                (int(fields[11]) + int(fields[12])) / float(_clock_ticks),
+                int(fields[21]) * _page_size,
+                int(fields[17]),
+            )
+        except (OSError, IndexError, ValueError):
+            continue
+    return processes
+
+
+def open_files(pid):
+    try:
+        return len(os.listdir("/proc/{:d}/fd".format(pid)))
+    except OSError:
+        return 0
+
+
+def process_trees(processes, roots):
+    """
+    :param processes: from read_processes
+    :param roots: pids
+    :return: dict of each root pid to the pids of its tree, itself included
+    :rtype: dict
+    """
+    children = {}
+    for pid, info in processes.items():
+        children.setdefault(info[0], []).append(pid)
+    trees = {}
+    for root in roots:
+        if root not in processes:
+            continue
+        tree = []
+        stack = [root]
+        while stack:
+            pid = stack.pop()
+            tree.append(pid)
+            stack.extend(children.get(pid, ()))
+        trees[root] = tree
+    return trees
+
+
+class UsageCollector(object):
+    def __init__(self, location=None, interval=None, history=None):
+        """
+        :param location: where the ring buffers are kept
+        :param interval: seconds between samples
+        :param history: samples kept for each app
+        """
+        self.location = config.USAGE_DIR if location is None else location
+        self.interval = config.USAGE_INTERVAL if interval is None else interval
+        self.history = config.USAGE_HISTORY if history is None else history
+        self._buffers = {}
+        self._cpu = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def _buffer_file(self, name):
+        return path.join(self.location, "{}.usage".format(path.basename(name)))
+
+    def _buffer(self, name):
+        buffer = self._buffers.get(name, None)
+        if buffer is None:
+            buffer = self._buffers[name] = RingBuffer(self._buffer_file(name), size=self.history)
+        return buffer
+
+    def collect(self, apps=None, now=None):
+        """
+        Take one sample of every app.
+        :param apps: dict of app name to the pid of its gunicorn master, defaults to every live supervised app
+        :return: the samples taken, by app name
+        :rtype: dict
+        """
+        if apps is None:
+            apps = {r["name"]: r["pid"] for r in supervisor.list() if r["state"] in LIVE_STATES and r.get("pid", None)}
+        now = time.time() if now is None else now
+        processes = read_processes()
+        trees = process_trees(processes, apps.values())
+        taken = {}
+        with self._lock:
+            for name, pid in sorted(apps.items()):
+                tree = trees.get(pid, None)
+                if tree is None:
+                    continue
+                cpu_seconds = sum(processes[p][1] for p in tree)
+                last = self._cpu.get(name, None)
+                cpu = 0.0
+                if last is not None and now > last[0]:
+                    # Workers which exited take their CPU time with them
+                    cpu = max(0.0, (cpu_seconds - last[1]) / (now - last[0]))
+                self._cpu[name] = (now, cpu_seconds)
+                sample = {
+                    "time": now,
+                    "cpu": round(cpu, 4),
+                    "rss": sum(processes[p][2] for p in tree),
+                    "fds": sum(open_files(p) for p in tree),
+                    "threads": sum(processes[p][3] for p in tree),
+                    "processes": len(tree),
+                }
+                self._buffer(name).append(sample)
+                taken[name] = sample
+            for name in [n for n in self._cpu.keys() if n not in apps]:
+                del self._cpu[name]
+                buffer = self._buffers.pop(name, None)
+                if buffer is not None:
+                    buffer.close()
+            self.prune(now)
+        return taken
+
+    def prune(self, now=None):
+        """
+        Remove the buffers of apps which haven't been sampled for as long as a buffer covers.
+        """
+        now = time.time() if now is None else now
+        try:
+            names = [f[: -len(".usage")] for f in os.listdir(self.location) if f.endswith(".usage")]
+        except OSError:
+            return
+        for name in names:
+            if name in self._buffers:
+                continue
+            # Writes through mmap don't reliably touch the file's mtime, go by its newest sample
+            samples = self.samples(name, limit=1)
+            if not samples or now - samples[-1]["time"] > self.history * self.interval:
+                try:
+                    os.unlink(self._buffer_file(name))
+                except OSError:
+                    pass
+
+    def samples(self, name, limit=None):
+        """
+        :param name: app process name
+        :return: its samples, oldest first, or None if it was never sampled
+        :rtype: list | None
+        """
+        try:
+            buffer = RingBuffer(self._buffer_file(name))
+        except (OSError, ValueError):
+            return None
+        try:
+            return buffer.samples(limit=limit)
+        finally:
+            buffer.close()
+
+    def latest(self):
+        """
+        The newest sample of every app, and their totals.
+        :rtype: dict
+        """
+        apps = []
+        try:
+            names = sorted(f[: -len(".usage")] for f in os.listdir(self.location) if f.endswith(".usage"))
+        except OSError:
+            names = []
+        cutoff = time.time() - 2 * self.interval
+        for name in names:
+            samples = self.samples(name, limit=1)
+            # Apps no longer sampled keep their history for a while, but aren't counted
+            if samples and samples[0]["time"] >= cutoff:
+                apps.append(dict(samples[0], name=name))
+        apps.sort(key=lambda a: a["cpu"], reverse=True)
+        totals = {f: sum(a[f] for a in apps) for f in FIELDS if f != "time"}
+        return {"apps": apps, "totals": dict(totals, apps=len(apps))}
+
+    def _run(self):
+        # Only one worker on the host collects, the others take over if it goes away
+        lock = FileLock(path.join(self.location, "collector.lock"))
+        try:
+            while not self._stop.is_set():
+                if lock.locked or lock.acquire(blocking=False):
+                    started = time.time()
+                    try:
+                        self.collect()
+                    except Exception as e:
+                        print("Usage collection failed: {}".format(repr(e)))
+                    self._stop.wait(max(0.0, self.interval - (time.time() - started)))
+                else:
+                    self._stop.wait(self.interval)
+        finally:
+            lock.release()
+
+    def start(self):
+        if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="usage-collector", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+usage_collector = UsageCollector()
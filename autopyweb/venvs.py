@@ -0,0 +1,557 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A content-addressed store of virtualenvs.
+Each environment is keyed by a hash of the project's resolved requirements and the interpreter that builds it,
+so a deploy whose dependencies haven't changed links to an existing environment instead of running pip again.
+Checkouts link to their environment, and each environment keeps back-references to the checkouts using it.
+Environments which no checkout uses any more are garbage collected.
+"""
+import glob
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from os import path
+from shutil import rmtree
+from typing import Dict
+
+from . import config, tracing
+from .disk import remove_tree, trash, TRASH_PREFIX
+from .environment import clean_env
+from .locks import FileLock
+from .metrics import cache_lookup, labels, registry
+from .wheelhouse import wheelhouse
+
+READY_FILE = "autopyweb-ready"
+LAST_USED_FILE = "autopyweb-last-used"
+CLAIMED_FILE = "autopyweb-claimed"
+# Inside a pool entry a stored venv links to
+ADOPTED_FILE = "autopyweb-adopted"
+PYTHON_FILE = "autopyweb-python"
+# Inside a venv, once its site-packages have been compiled to bytecode
+COMPILED_FILE = "autopyweb-compiled"
+# Inside a venv layer, the path of the venv it is layered over
+BASE_FILE = "autopyweb-base"
+
+# Base venvs kept ready in the pool, by flavor.
+# Poetry is installed on demand, only a poetry project without a usable poetry.lock needs it
+POOL_FLAVORS = {
+    "pip": ("setuptools", "wheel", "gunicorn>=20.0.1,<20.99"),
+}
+
+_interpreter_ids = {}  # type: Dict[str, str]
+
+
+def interpreter_id(python=None):
+    """
+    Identify an interpreter by its real path and full version string.
+    :rtype: str
+    """
+    if python is None:
+        python = config.PYTHON
+    python = path.realpath(python)
+    found = _interpreter_ids.get(python, None)
+    if found is None:
+        resp = subprocess.run(
+            [python, "-c", "import sys; print(sys.version)"], stdout=subprocess.PIPE, env={"PATH": "/usr/bin:/bin"}
+        )
+        found = "{}\n{}".format(python, resp.stdout.decode("utf-8").strip())
+        _interpreter_ids[python] = found
+    return found
+
+
+# The PEP 508 marker environment of an interpreter, which needn't have packaging installed
+_ENVIRONMENT_SCRIPT = """
+import json, os, platform, sys
+v = sys.implementation.version
+impl = "{0.major}.{0.minor}.{0.micro}".format(v)
+if v.releaselevel != "final":
+    impl += v.releaselevel[0] + str(v.serial)
+print(json.dumps({
+    "implementation_name": sys.implementation.name,
+    "implementation_version": impl,
+    "os_name": os.name,
+    "platform_machine": platform.machine(),
+    "platform_release": platform.release(),
+    "platform_system": platform.system(),
+    "platform_version": platform.version(),
+    "python_full_version": platform.python_version(),
+    "platform_python_implementation": platform.python_implementation(),
+    "python_version": ".".join(platform.python_version_tuple()[:2]),
+    "sys_platform": sys.platform,
+}))
+"""
+_marker_environments = {}  # type: Dict[str, Dict[str, str]]
+
+
+def marker_environment(python=None):
+    """
+    The values environment markers are evaluated with, for the interpreter which builds the venvs.
+    :rtype: dict
+    """
+    if python is None:
+        python = config.PYTHON
+    python = path.realpath(python)
+    found = _marker_environments.get(python, None)
+    if found is None:
+        resp = subprocess.run(
+            [python, "-c", _ENVIRONMENT_SCRIPT], stdout=subprocess.PIPE, env={"PATH": "/usr/bin:/bin"}, check=True
+        )
+        found = _marker_environments[python] = json.loads(resp.stdout.decode("utf-8"))
+    return dict(found)
+
+
+def requirements_key(files=(), texts=(), python=None):
+    """
+    Hash a requirement set together with the interpreter which will run it.
+    :param files: manifest files whose content defines the requirement set, eg poetry.lock or requirements.txt
+    :param texts: other strings which define the requirement set, eg a list of install_requires
+    :param python: interpreter the environment is built with. Defaults to config.PYTHON
+    :return: hex digest
+    :rtype: str
+    """
+    h = hashlib.sha256()
+    h.update(interpreter_id(python).encode("utf-8"))
+    for f in files:
+        h.update(b"\0file\0")
+        h.update(path.basename(f).encode("utf-8"))
+        h.update(b"\0")
+        with open(f, "rb") as fp:
+            h.update(fp.read())
+    for t in texts:
+        h.update(b"\0text\0")
+        h.update(str(t).encode("utf-8"))
+    return h.hexdigest()[:32]
+
+
+def site_packages(venv):
+    found = sorted(glob.glob(path.join(venv, "lib", "python*", "site-packages")))
+    if not found:
+        raise RuntimeError("No site-packages in {}".format(venv))
+    return found[0]
+
+
+def _is_python_script(file_path):
+    try:
+        with open(file_path, "rb") as f:
+            first_line = f.readline()
+    except OSError:
+        return False
+    return first_line.startswith(b"#!") and b"python" in first_line
+
+
+def make_layer(base, layer, python=None):
+    """
+    Make a venv at `layer` over the venv `base`. Packages installed into the layer come first, and everything
+    installed in `base` is seen beneath them, so a checkout can install its own packages over a venv it shares
+    with other checkouts without changing that venv. The scripts of `base`, like pip and gunicorn, run in the
+    layer too.
+    :param base: the venv to layer over, built with the same interpreter
+    :param python: interpreter to build the layer with. Defaults to config.PYTHON
+    :return: path of the layer
+    :rtype: str
+    """
+    if python is None:
+        python = config.PYTHON
+    resp = tracing.run([python, "-m", "venv", "--symlinks", "--without-pip", layer], env=clean_env())
+    if resp.returncode != 0:
+        raise RuntimeError("Cannot make a venv layer at {}".format(layer))
+    with open(path.join(site_packages(layer), "autopyweb-base.pth"), "w", encoding="utf-8") as f:
+        # addsitedir runs the .pth files of the base too, like those of its editable installs
+        f.write("import site; site.addsitedir({!r})\n".format(site_packages(base)))
+    layer_python = path.join(layer, "bin", "python")
+    for name in sorted(os.listdir(path.join(base, "bin"))):
+        script = path.join(base, "bin", name)
+        wrapper = path.join(layer, "bin", name)
+        if path.lexists(wrapper) or not _is_python_script(script):
+            continue
+        with open(wrapper, "w", encoding="utf-8") as f:
+            f.write('#!/bin/sh\nexec {} {} "$@"\n'.format(shlex.quote(layer_python), shlex.quote(script)))
+        os.chmod(wrapper, 0o755)
+    with open(path.join(layer, BASE_FILE), "w", encoding="utf-8") as f:
+        f.write(base)
+    return layer
+
+
+def layer_base(venv):
+    """
+    :return: the venv which `venv` is layered over, None if it isn't a layer
+    :rtype: str
+    """
+    try:
+        with open(path.join(venv, BASE_FILE), "r", encoding="utf-8") as f:
+            return f.read()
+    except OSError:
+        return None
+
+
+class StoredEnv(object):
+    def __init__(self, store, key):
+        self.store = store
+        self.key = key
+        self.location = path.join(store.location, key)
+        self.venv_path = path.join(self.location, "venv")
+        self.refs_dir = path.join(self.location, "refs")
+
+    @property
+    def ready(self):
+        return path.isfile(path.join(self.location, READY_FILE))
+
+    def mark_ready(self):
+        with open(path.join(self.location, READY_FILE), "w") as f:
+            f.write(str(time.time()))
+
+    def discard_venv(self):
+        """
+        Remove the venv itself. A venv claimed from the pool is a link to the pool entry, remove that too.
+        """
+        if path.islink(self.venv_path):
+            target = path.realpath(self.venv_path)
+            os.unlink(self.venv_path)
+            if target.startswith(path.join(config.VENV_POOL_DIR, "")):
+                remove_tree(path.dirname(target))
+        elif path.exists(self.venv_path):
+            remove_tree(self.venv_path)
+
+    def touch(self):
+        os.makedirs(self.location, exist_ok=True)
+        last_used = path.join(self.location, LAST_USED_FILE)
+        with open(last_used, "a"):
+            pass
+        os.utime(last_used, None)
+
+    def last_used(self):
+        try:
+            return os.stat(path.join(self.location, LAST_USED_FILE)).st_mtime
+        except OSError:
+            return 0
+
+    def live_refs(self):
+        """
+        Checkouts which still link to this environment.
+        A back-reference is live while its checkout exists and the checkout's venv link still points here.
+        :rtype: list
+        """
+        if not path.isdir(self.refs_dir):
+            return []
+        live = []
+        for r in os.listdir(self.refs_dir):
+            ref_file = path.join(self.refs_dir, r)
+            try:
+                with open(ref_file, "r", encoding="utf-8") as f:
+                    venv_link = f.read().strip()
+            except OSError:
+                continue
+            if path.realpath(venv_link) == path.realpath(self.venv_path):
+                live.append(path.dirname(venv_link))
+            else:
+                try:
+                    os.unlink(ref_file)
+                except OSError:
+                    pass
+        return live
+
+
+class VenvStore(object):
+    def __init__(self, location=None, gc_age=None, lock_timeout=None):
+        if location is None:
+            location = config.VENV_DIR
+        if gc_age is None:
+            gc_age = config.VENV_GC_AGE
+        if lock_timeout is None:
+            lock_timeout = config.VENV_LOCK_TIMEOUT
+        self.location = location
+        self.gc_age = gc_age
+        self.lock_timeout = lock_timeout
+
+    def get(self, key):
+        return StoredEnv(self, key)
+
+    def _lock(self, key, timeout=None):
+        if timeout is None:
+            timeout = self.lock_timeout
+        return FileLock(path.join(self.location, "{}.lock".format(key)), timeout=timeout)
+
+    @contextmanager
+    def provision(self, key):
+        """
+        Lock the environment for a key and yield it.
+        If `env.ready` is False the caller must build the environment at `env.venv_path` and then call
+        `env.mark_ready()`. A half-built environment left by a failed build is thrown away first.
+        :rtype: StoredEnv
+        """
+        env = self.get(key)
+        with self._lock(key):
+            if not env.ready and path.lexists(env.venv_path):
+                env.discard_venv()
+            env.touch()
+            yield env
+
+    def link(self, key, project_dir, venv_name):
+        """
+        Link `project_dir/venv_name` to the stored environment and record the back-reference.
+        :return: path of the link inside the project
+        :rtype: str
+        """
+        env = self.get(key)
+        venv_link = path.join(path.realpath(project_dir), venv_name)
+        if path.islink(venv_link):
+            os.unlink(venv_link)
+        elif path.isdir(venv_link):
+            rmtree(venv_link)
+        os.symlink(env.venv_path, venv_link)
+        os.makedirs(env.refs_dir, exist_ok=True)
+        ref_name = hashlib.sha1(venv_link.encode("utf-8")).hexdigest()[:16]
+        with open(path.join(env.refs_dir, ref_name), "w", encoding="utf-8") as f:
+            f.write(venv_link)
+        env.touch()
+        return venv_link
+
+    def envs(self):
+        if not path.isdir(self.location):
+            return []
+        return [
+            self.get(k)
+            for k in os.listdir(self.location)
+            if path.isdir(path.join(self.location, k)) and not k.startswith(TRASH_PREFIX)
+        ]
+
+    def collect(self, min_age=None, now=None):
+        """
+        Remove environments which no checkout links to, and which haven't been used for `min_age` seconds.
+        Environments being built or linked right now are never removed.
+        :return: list of removed keys
+        :rtype: list
+        """
+        if min_age is None:
+            min_age = self.gc_age
+        if now is None:
+            now = time.time()
+        removed = []
+        for env in self.envs():
+            if (now - env.last_used()) < min_age or env.live_refs():
+                continue
+            if self.remove(env.key):
+                removed.append(env.key)
+        return removed
+
+    def remove(self, key):
+        """
+        Remove an environment, unless a checkout links to it or it is being built or linked right now.
+        It is renamed away at once, then its files are removed at the throttled rate of autopyweb.disk.
+        :return: True if it was removed
+        :rtype: bool
+        """
+        env = self.get(key)
+        lock = self._lock(key)
+        if not lock.acquire(blocking=False):
+            return False
+        try:
+            if env.live_refs() or not path.isdir(env.location):
+                return False
+            trashed = trash(env.location)
+        finally:
+            lock.release()
+        if trashed is None:
+            return False
+        StoredEnv(self, path.basename(trashed)).discard_venv()
+        remove_tree(trashed)
+        return True
+
+
+class VenvPool(object):
+    """
+    Keeps a few base venvs, with the toolchain already installed, ready to hand out.
+    A deploy which needs a new venv claims one instead of building it, and the pool is refilled in the background.
+    Pool entries are claimed by atomically renaming their ready marker, so a claim is safe between processes.
+    """
+
+    def __init__(self, location=None, size=None):
+        if location is None:
+            location = config.VENV_POOL_DIR
+        if size is None:
+            size = config.VENV_POOL_SIZE
+        self.location = location
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._stats_lock = threading.Lock()
+        self._executor = None
+
+    @property
+    def executor(self):
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+        return self._executor
+
+    def _entries(self):
+        if not path.isdir(self.location):
+            return []
+        return [
+            path.join(self.location, e) for e in os.listdir(self.location) if path.isdir(path.join(self.location, e))
+        ]
+
+    def ready_entries(self, flavor, python=None):
+        wanted = interpreter_id(python)
+        found = []
+        for entry in self._entries():
+            if not path.basename(entry).startswith(flavor + "-"):
+                continue
+            if not path.isfile(path.join(entry, READY_FILE)):
+                continue
+            try:
+                with open(path.join(entry, PYTHON_FILE), "r", encoding="utf-8") as f:
+                    if f.read() != wanted:
+                        continue
+            except OSError:
+                continue
+            found.append(entry)
+        return found
+
+    def claim(self, flavor, venv_link, python=None):
+        """
+        Take a ready venv from the pool and link `venv_link` to it.
+        :return: True if a venv was claimed, False if the pool had none ready
+        :rtype: bool
+        """
+        entry = self.take(flavor, python)
+        if entry is None:
+            return False
+        self.adopt(entry, venv_link)
+        return True
+
+    def take(self, flavor, python=None):
+        """
+        Take a ready entry from the pool, to adopt or give back later.
+        :return: path of the entry, None if the pool had none ready
+        """
+        claimed = None
+        for entry in self.ready_entries(flavor, python):
+            try:
+                os.rename(path.join(entry, READY_FILE), path.join(entry, CLAIMED_FILE))
+            except OSError:
+                # Somebody else claimed it first
+                continue
+            claimed = entry
+            break
+        with self._stats_lock:
+            if claimed is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        cache_lookup("venv_pool", claimed is not None)
+        self.refill_async()
+        return claimed
+
+    def adopt(self, entry, venv_link):
+        """
+        Link `venv_link` to the venv of an entry taken from the pool. It can't be given back any more.
+        """
+        os.rename(path.join(entry, CLAIMED_FILE), path.join(entry, ADOPTED_FILE))
+        os.makedirs(path.dirname(venv_link), exist_ok=True)
+        os.symlink(path.join(entry, "venv"), venv_link)
+
+    def give_back(self, entry):
+        """
+        Put an entry which was taken but not adopted back in the pool, ready for the next claim.
+        """
+        try:
+            os.rename(path.join(entry, CLAIMED_FILE), path.join(entry, READY_FILE))
+        except OSError:
+            pass
+
+    def build_entry(self, flavor, python=None, claimed=False):
+        """
+        :param claimed: build it taken already, rather than ready for anybody to claim
+        :return: path of the entry
+        :rtype: str
+        """
+        if python is None:
+            python = config.PYTHON
+        entry = path.join(self.location, "{}-{}".format(flavor, uuid.uuid4().hex))
+        venv_path = path.join(entry, "venv")
+        os.makedirs(entry)
+        env = clean_env()
+        try:
+            resp = tracing.run([python, "-m", "venv", "--symlinks", venv_path], env=env)
+            if resp.returncode == 0:
+                resp = wheelhouse.install(path.join(venv_path, "bin", "pip3"), POOL_FLAVORS[flavor], env=env)
+            if resp.returncode != 0:
+                raise RuntimeError("Cannot build a {} venv for the pool".format(flavor))
+            with open(path.join(entry, PYTHON_FILE), "w", encoding="utf-8") as f:
+                f.write(interpreter_id(python))
+            with open(path.join(entry, CLAIMED_FILE if claimed else READY_FILE), "w") as f:
+                f.write(str(time.time()))
+        except BaseException:
+            rmtree(entry, ignore_errors=True)
+            raise
+        return entry
+
+    def refill(self):
+        """
+        Build venvs until every flavor has `size` ready. Only one process refills at a time.
+        """
+        if self.size <= 0:
+            return []
+        os.makedirs(self.location, exist_ok=True)
+        refill_lock = FileLock(path.join(self.location, "refill.lock"))
+        if not refill_lock.acquire(blocking=False):
+            return []
+        built = []
+        try:
+            for entry in self._entries():
+                marked = any(path.isfile(path.join(entry, m)) for m in (READY_FILE, CLAIMED_FILE, ADOPTED_FILE))
+                pooled = path.basename(entry).split("-", 1)[0] in POOL_FLAVORS
+                if not marked or (not pooled and path.isfile(path.join(entry, READY_FILE))):
+                    # Left behind by a build which crashed, or of a flavor no longer kept ready
+                    rmtree(entry, ignore_errors=True)
+            for flavor in POOL_FLAVORS:
+                while len(self.ready_entries(flavor)) < self.size:
+                    built.append(self.build_entry(flavor))
+        finally:
+            refill_lock.release()
+        return built
+
+    def refill_async(self):
+        if self.size <= 0:
+            return None
+        return self.executor.submit(self._refill_logged)
+
+    def _refill_logged(self):
+        try:
+            return self.refill()
+        except Exception as e:
+            print("Venv pool refill failed: {}".format(repr(e)))
+
+    def stats(self):
+        with self._stats_lock:
+            hits, misses = self.hits, self.misses
+        return {
+            "size": self.size,
+            "ready": {flavor: len(self.ready_entries(flavor)) for flavor in POOL_FLAVORS},
+            "hits": hits,
+            "misses": misses,
+        }
+
+
+venv_store = VenvStore()
+venv_pool = VenvPool()
+
+
+@registry.derive
+def _venv_pool_ready(merged):
+    # Counted from the pool on disk, so every worker reports the same for the host
+    samples = [(labels(flavor=flavor), ready) for flavor, ready in sorted(venv_pool.stats()["ready"].items())]
+    return "autopyweb_venv_pool_ready", "Venvs ready in the pool, by flavor.", samples
+
+
+@registry.derive
+def _venv_pool_size(merged):
+    return "autopyweb_venv_pool_size", "Venvs the pool keeps ready for each flavor.", [("", venv_pool.size)]
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+#
+"""
+A host-wide wheelhouse shared by every deployment.
+Installs of exact pins are tried from the wheelhouse alone first. Anything missing is downloaded or built into
+wheels once, saved to the wheelhouse under its project name and version, and installed from there. When every
+wheel is already present such an install needs no network at all.
+Any other install also looks at the package index, so a range is satisfied by its newest release, not by
+whatever older wheel happens to be in the wheelhouse.
+"""
+import os
+import re
+import tempfile
+from os import path
+from shutil import rmtree
+
+from . import config, tracing
+from .metrics import cache_lookup
+from .requirements import requirement_lines
+
+# Packages installed into nearly every project venv
+TOOLCHAIN = ("setuptools", "wheel", "gunicorn>=20.0.1,<20.99")
+
+# Options of `pip install` which don't change what is installed
+_NEUTRAL_OPTIONS = ("--require-hashes", "--no-deps")
+_exact_pin = re.compile(r"^[A-Za-z0-9][A-Za-z0-9._-]*(\[[^\]]*\])?\s*===?\s*[^\s,;*<>!=~]+$")
+
+
+def pinned(args, cwd=None):
+    """
+    :param args: requirement specs, or `-r file`, for `pip install`
+    :return: whether every requirement is pinned to one exact version, so no newer release can satisfy it
+    :rtype: bool
+    """
+    args = list(args)
+    specs = []
+    while args:
+        arg = args.pop(0)
+        if arg in ("-r", "--requirement") and args:
+            file_path = args.pop(0)
+            try:
+                lines = list(requirement_lines(path.join(cwd or "", file_path)))
+            except OSError:
+                return False
+            # Drop hashes and environment markers, anything else with options isn't a plain pin
+            specs.extend(line.split(" --hash", 1)[0].split(";", 1)[0].strip() for line in lines)
+        elif arg.startswith("-"):
+            if arg not in _NEUTRAL_OPTIONS:
+                return False
+        else:
+            specs.append(arg.split(";", 1)[0].strip())
+    return bool(specs) and all(_exact_pin.match(s) for s in specs)
+
+
+class Wheelhouse(object):
+    def __init__(self, location=None, cache_dir=None, offline=None):
+        if location is None:
+            location = config.WHEELHOUSE_DIR
+        if cache_dir is None:
+            cache_dir = config.PIP_CACHE_DIR
+        if offline is None:
+            offline = bool(config.WHEELHOUSE_OFFLINE)
+        self.location = location
+        self.cache_dir = cache_dir
+        self.offline = offline
+
+    def pip_env(self, env=None):
+        """
+        Environment for tools which run pip themselves (like poetry), so they use the wheelhouse too.
+        :param env: base environment, defaults to os.environ
+        :rtype: dict
+        """
+        env = dict(os.environ if env is None else env)
+        env["PIP_FIND_LINKS"] = self.location
+        env["PIP_CACHE_DIR"] = self.cache_dir
+        if self.offline:
+            env["PIP_NO_INDEX"] = "1"
+        return env
+
+    def wheels(self):
+        if not path.isdir(self.location):
+            return []
+        return sorted(f for f in os.listdir(self.location) if f.endswith(".whl"))
+
+    def _run_pip(self, pip3_path, args, cwd, env=None):
+        os.makedirs(self.location, exist_ok=True)
+        return tracing.run([pip3_path] + list(args), cwd=cwd, shell=False, env=self.pip_env(env))
+
+    def _build_wheels(self, pip_command, args, cwd, env):
+        # Wheels are built in a scratch directory and moved in one by one,
+        # so concurrent installs never see a partly written wheel.
+        os.makedirs(self.location, exist_ok=True)
+        scratch = tempfile.mkdtemp(prefix=".build-", dir=self.location)
+        try:
+            resp = tracing.run(
+                list(pip_command) + ["wheel", "--wheel-dir", scratch] + list(args),
+                cwd=cwd,
+                shell=False,
+                env=self.pip_env(env),
+            )
+            for f in os.listdir(scratch):
+                if f.endswith(".whl") and not path.exists(path.join(self.location, f)):
+                    os.replace(path.join(scratch, f), path.join(self.location, f))
+        finally:
+            rmtree(scratch, ignore_errors=True)
+        return resp
+
+    def build(self, pip3_path, args, cwd=None, env=None):
+        """
+        Download or build wheels for `args` (requirement specs, or `-r file`) into the wheelhouse.
+        """
+        return self._build_wheels([pip3_path], args, cwd, env)
+
+    def install(self, pip3_path, args, cwd=None, env=None):
+        """
+        `pip install args` through the wheelhouse.
+        Only exact pins, or anything when offline, are installed from the wheelhouse alone. Otherwise pip picks
+        from the wheelhouse and the index together.
+        :param pip3_path: pip of the venv to install into
+        :param args: requirement specs, or `-r file`
+        :return: the completed pip process
+        :rtype: subprocess.CompletedProcess
+        """
+        args = list(args)
+        if not self.offline and not pinned(args, cwd):
+            return self._run_pip(pip3_path, ["install", "--find-links", self.location] + args, cwd, env)
+        local_install = ["install", "--no-index", "--find-links", self.location] + args
+        resp = self._run_pip(pip3_path, local_install, cwd, env)
+        cache_lookup("wheelhouse", resp.returncode == 0)
+        if resp.returncode == 0 or self.offline:
+            return resp
+        # A wheel built here from an sdist never has the hash locked for the sdist, so a hash-checked install
+        # goes to the index, where pip checks the sdist and builds it itself
+        if "--require-hashes" not in args:
+            built = self.build(pip3_path, args, cwd, env)
+            if built.returncode == 0:
+                resp = self._run_pip(pip3_path, local_install, cwd, env)
+                if resp.returncode == 0:
+                    return resp
+        # Something can't be made into a wheel, let pip install it the usual way.
+        return self._run_pip(pip3_path, ["install", "--find-links", self.location] + args, cwd, env)
+
+    def prepopulate(self, python=None, packages=TOOLCHAIN):
+        """
+        Fill the wheelhouse with the toolchain packages every deployment installs.
+        """
+        if python is None:
+            python = config.PYTHON
+        if self.offline:
+            return None
+        return self._build_wheels([python, "-m", "pip"], packages, None, None)
+
+
+wheelhouse = Wheelhouse()
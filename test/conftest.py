@@ -0,0 +1,15 @@
+import atexit
+import os
+import shutil
+import tempfile
+
+# Before autopyweb.config is imported, so the tests never touch the state of a real autopyweb on this host,
+# and starting the app doesn't download the toolchain, build pool venvs or start background threads
+_state = tempfile.mkdtemp(prefix="autopyweb-test-")
+atexit.register(shutil.rmtree, _state, True)
+os.environ["AUTOPYWEB_LOCATION"] = os.path.join(_state, "deploy")
+os.environ["AUTOPYWEB_STATE_DIR"] = os.path.join(_state, "state")
+os.environ["AUTOPYWEB_WHEELHOUSE_PREPOPULATE"] = "0"
+os.environ["AUTOPYWEB_VENV_POOL_SIZE"] = "0"
+os.environ["AUTOPYWEB_GC_INTERVAL"] = "0"
+os.environ["AUTOPYWEB_USAGE_INTERVAL"] = "0"
@@ -0,0 +1,52 @@
+import os
+import tempfile
+import unittest
+from os import path
+from autopyweb.capacity import ASYNC, SYNC, CapacityScheduler, cpu_seconds, read_workers, worker_kind
+
+
+def scheduler(cores=4, memory_budget=0):
+    state_file = path.join(tempfile.mkdtemp(), "capacity.json")
+    return CapacityScheduler(state_file=state_file, cores=cores, memory_budget=memory_budget, workers_per_core=2)
+
+
+class TestCapacity(unittest.TestCase):
+    def test_worker_kind(self):
+        assert worker_kind(None) == SYNC and worker_kind("gthread") == SYNC
+        assert worker_kind("sanic.worker.GunicornWorker") == ASYNC and worker_kind("tornado") == ASYNC
+
+    def test_targets_share_the_budget(self):
+        s = scheduler(cores=4)
+        assert s.budget() == 8
+        apps = {
+            "a": {"kind": SYNC, "priority": 1},
+            "b": {"kind": SYNC, "priority": 3},
+            "c": {"kind": ASYNC, "priority": 1, "pinned": 2},
+        }
+        targets = s.targets(apps)
+        assert targets["c"] == 2 and sum(targets.values()) == 8
+        assert targets["b"] > targets["a"] >= 1
+        # A busy app gets a bigger share
+        apps["a"]["load"] = 6.0
+        assert s.targets(apps)["a"] > targets["a"]
+        # Async apps gain nothing from more workers than cores
+        assert scheduler(cores=2).targets({"x": {"kind": ASYNC}}) == {"x": 2}
+        # Memory is a limit too, but every app still gets a worker
+        small = scheduler(cores=16, memory_budget=3 * 128 * 1024 * 1024)
+        assert small.budget() == 3
+        assert sum(small.targets({n: {"kind": SYNC} for n in "abcde"}).values()) == 5
+
+    def test_assign(self):
+        s = scheduler(cores=2)
+        first, second = tempfile.mkdtemp(), tempfile.mkdtemp()
+        assert s.assign("first", first, SYNC) == (4, 4)
+        assert read_workers(first) == 4
+        # Not yet running, but sized, so the next app shares the host with it
+        workers, threads = s.assign("second", second, ASYNC)
+        assert threads == 1 and workers == 2
+        assert s.assign("pinned", tempfile.mkdtemp(), SYNC, pinned=3)[0] == 3
+        assert [a["name"] for a in s.status()["apps"]] == ["first", "pinned", "second"]
+
+    def test_cpu_seconds(self):
+        assert cpu_seconds(os.getpid()) > 0
+        assert cpu_seconds(2**22 + 1) is None
@@ -0,0 +1,80 @@
+import os
+import tempfile
+import unittest
+from os import path
+from shutil import rmtree
+from git import Repo
+from autopyweb.functions import checkout_commit, fetch_git_project, prepare_release, release_paths
+from autopyweb.mirrors import mirror_store
+
+
+def make_origin():
+    origin = tempfile.mkdtemp()
+    repo = Repo.init(origin)
+    with repo.config_writer() as cw:
+        cw.set_value("user", "name", "test")
+        cw.set_value("user", "email", "test@example.com")
+    with open(path.join(origin, "app.py"), "w", encoding="utf-8") as f:
+        f.write("VERSION = 1\n")
+    repo.index.add(["app.py"])
+    repo.index.commit("first")
+    repo.git.branch("-M", "master")
+    return repo
+
+
+def commit_version(repo, version):
+    with open(path.join(repo.working_tree_dir, "app.py"), "w", encoding="utf-8") as f:
+        f.write("VERSION = {:d}\n".format(version))
+    repo.index.add(["app.py"])
+    return repo.index.commit("version {:d}".format(version)).hexsha
+
+
+def read_app(checkout):
+    with open(path.join(checkout, "app.py"), "r", encoding="utf-8") as f:
+        return f.read()
+
+
+class TestCheckout(unittest.TestCase):
+    def setUp(self):
+        self.location = path.realpath(tempfile.mkdtemp())
+        self.origin = make_origin()
+        self.origin_url = self.origin.working_tree_dir
+        self.mirror_path = mirror_store.mirror_path(self.origin_url)
+
+    def test_worktree_of_the_mirror(self):
+        plan, sha = fetch_git_project(self.origin_url, depth=0)
+        checkout = prepare_release(self.location, self.origin_url, plan, sha)
+        assert checkout == release_paths(self.location, self.origin_url, plan, sha)[1]
+        assert read_app(checkout) == "VERSION = 1\n"
+        # Checked out as a worktree, with a .git file and no objects of its own
+        assert path.isfile(path.join(checkout, ".git"))
+        assert Repo(checkout).head.commit.hexsha == sha and Repo(checkout).head.is_detached
+        assert checkout in mirror_store.live_worktrees(self.mirror_path)
+
+    def test_check_out_again_into_existing_worktree(self):
+        plan, sha = fetch_git_project(self.origin_url, depth=0)
+        checkout = prepare_release(self.location, self.origin_url, plan, sha)
+        with open(path.join(checkout, "local.txt"), "w", encoding="utf-8") as f:
+            f.write("kept")
+        # The same commit is already checked out, it is used as it is
+        assert prepare_release(self.location, self.origin_url, plan, sha) == checkout
+        assert path.isfile(path.join(checkout, "local.txt"))
+        # A worktree removed without git knowing is pruned, so its path can be checked out again
+        rmtree(checkout)
+        with mirror_store.open(self.origin_url) as repo:
+            assert checkout_commit(repo, checkout, sha, mode="worktree") == checkout
+        assert read_app(checkout) == "VERSION = 1\n" and not path.exists(path.join(checkout, "local.txt"))
+        assert mirror_store.live_worktrees(self.mirror_path) == [checkout]
+
+    def test_second_deployment_of_same_origin(self):
+        plan, first = fetch_git_project(self.origin_url, depth=0)
+        first_checkout = prepare_release(self.location, self.origin_url, plan, first)
+        second = commit_version(self.origin, 2)
+        plan, fetched = fetch_git_project(self.origin_url, depth=0)
+        assert fetched == second
+        second_checkout = prepare_release(self.location, self.origin_url, plan, second, dirname="pr2")
+        # Both are worktrees of the one mirror, each at its own commit
+        assert second_checkout != first_checkout
+        assert read_app(first_checkout) == "VERSION = 1\n" and read_app(second_checkout) == "VERSION = 2\n"
+        assert sorted(mirror_store.live_worktrees(self.mirror_path)) == sorted([first_checkout, second_checkout])
+        assert os.listdir(mirror_store.location).count(path.basename(self.mirror_path)) == 1
@@ -0,0 +1,48 @@
+import tempfile
+import unittest
+from os import path
+from autopyweb.deployments import DeploymentRegistry, DEPLOYING, LIVE, FAILED
+
+
+def deploy(registry, name, project, status=DEPLOYING):
+    return registry.record(
+        name,
+        link=path.join("/srv", name),
+        project=project,
+        origin="https://example.com/{}.git".format(project),
+        ref_kind="branch",
+        ref="master",
+        status=status,
+    )
+
+
+class TestDeployments(unittest.TestCase):
+    def setUp(self):
+        self.registry = DeploymentRegistry(path.join(tempfile.mkdtemp(), "state", "deployments.sqlite3"))
+
+    def test_record_updates_only_given_fields(self):
+        row = deploy(self.registry, "proj-pr1", "proj")
+        assert row["status"] == DEPLOYING
+        row = self.registry.record("proj-pr1", status=LIVE, pid=1234, sha="abc")
+        assert row["status"] == LIVE
+        assert row["pid"] == 1234
+        assert row["origin"] == "https://example.com/proj.git"
+        assert row["updated"] >= row["created"]
+        with self.assertRaises(ValueError):
+            self.registry.record("proj-pr1", colour="blue")
+
+    def test_list_filters_and_pages(self):
+        for i in range(5):
+            deploy(self.registry, "proj-pr{}".format(i), "proj", status=LIVE)
+        deploy(self.registry, "other-m", "other", status=FAILED)
+        rows, total = self.registry.list()
+        assert total == 6
+        # Most recently updated first
+        assert rows[0]["name"] == "other-m"
+        rows, total = self.registry.list(project="proj", limit=2, offset=2)
+        assert total == 5
+        assert [r["name"] for r in rows] == ["proj-pr2", "proj-pr1"]
+        rows, total = self.registry.list(status=FAILED, origin="https://example.com/other.git")
+        assert [r["name"] for r in rows] == ["other-m"]
+        with self.assertRaises(ValueError):
+            self.registry.list(pid=1)
@@ -0,0 +1,22 @@
+import os
+import unittest
+from os import path
+from autopyweb.environment import clean_env, venv_env
+
+
+class TestEnvironment(unittest.TestCase):
+    def test_venv_env(self):
+        base = {"PATH": "/usr/local/bin:/usr/bin", "PYTHONPATH": "/somewhere", "HOME": "/root"}
+        before = dict(os.environ)
+        env = venv_env("/srv/project/dynvenv", base=base)
+        assert env["VIRTUAL_ENV"] == "/srv/project/dynvenv"
+        assert env["PATH"].split(os.pathsep)[0] == path.join("/srv/project/dynvenv", "bin")
+        assert "PYTHONPATH" not in env
+        assert env["HOME"] == "/root"
+        assert dict(os.environ) == before
+
+    def test_clean_env_drops_active_venv(self):
+        base = {"PATH": "/srv/other/venv/bin:/usr/bin", "VIRTUAL_ENV": "/srv/other/venv"}
+        env = clean_env(base=base)
+        assert "VIRTUAL_ENV" not in env
+        assert env["PATH"].split(os.pathsep) == ["/usr/bin"]
@@ -0,0 +1,78 @@
+import hashlib
+import os
+import tempfile
+import unittest
+from os import path
+from autopyweb.disk import remove_tree, trash
+from autopyweb.garbage import CHECKOUT, GarbageCollector
+from autopyweb.mirrors import MirrorStore
+from autopyweb.releases import ReleaseStore
+from autopyweb.venvs import VenvStore
+from autopyweb.wheelhouse import Wheelhouse
+
+
+def make_checkout(location, name, size, last_used):
+    checkout = path.join(location, "{}-{}".format(name, hashlib.sha1(name.encode()).hexdigest()))
+    os.makedirs(checkout)
+    with open(path.join(checkout, "app.py"), "wb") as f:
+        f.write(b"x" * size)
+    os.utime(path.join(checkout, "app.py"), (last_used, last_used))
+    os.utime(checkout, (last_used, last_used))
+    return checkout
+
+
+class TestGarbageCollector(unittest.TestCase):
+    def setUp(self):
+        self.location = path.realpath(tempfile.mkdtemp())
+
+    def collector(self, **kwargs):
+        return GarbageCollector(
+            location=self.location,
+            min_age=60,
+            releases=ReleaseStore(record_dir=tempfile.mkdtemp()),
+            venvs=VenvStore(location=tempfile.mkdtemp(), gc_age=0),
+            mirrors=MirrorStore(location=tempfile.mkdtemp(), max_bytes=0, max_age=0),
+            wheels=Wheelhouse(location=tempfile.mkdtemp(), cache_dir=tempfile.mkdtemp()),
+            **kwargs,
+        )
+
+    def test_quota_evicts_least_recently_used(self):
+        old = make_checkout(self.location, "old", 1000, 1000)
+        newer = make_checkout(self.location, "newer", 1000, 2000)
+        linked = make_checkout(self.location, "linked", 1000, 500)
+        os.symlink(linked, path.join(self.location, "proj-pr1"))
+        # Too new to tell whether a deploy is still setting it up
+        deploying = make_checkout(self.location, "deploying", 1000, 9990)
+        gc = self.collector(quota=2500, max_age=0)
+        report = gc.collect(now=10000, dry_run=True)
+        assert report["used"] == 4000 and report["by_kind"] == {CHECKOUT: 4000}
+        assert [e["path"] for e in report["evicted"]] == [old, newer]
+        assert path.isdir(old)
+        report = gc.collect(now=10000)
+        assert [e["path"] for e in report["evicted"]] == [old, newer] and report["used_after"] == 2000
+        assert not path.exists(old) and not path.exists(newer)
+        assert path.isdir(linked) and path.isdir(deploying)
+        assert sorted(os.listdir(self.location)) == sorted(
+            ["proj-pr1", path.basename(linked), path.basename(deploying)]
+        )
+
+    def test_age_limit(self):
+        old = make_checkout(self.location, "old", 10, 1000)
+        recent = make_checkout(self.location, "recent", 10, 9000)
+        report = self.collector(quota=0, max_age=5000).collect(now=10000)
+        assert [(e["path"], e["reason"]) for e in report["evicted"]] == [(old, "age")]
+        assert not path.exists(old) and path.isdir(recent)
+
+    def test_remove_tree_does_not_follow_symlinks(self):
+        outside = tempfile.mkdtemp()
+        with open(path.join(outside, "keep.txt"), "w") as f:
+            f.write("keep")
+        tree = path.join(self.location, "tree")
+        os.makedirs(path.join(tree, "a", "b"))
+        os.symlink(outside, path.join(tree, "a", "linked"))
+        trashed = trash(tree)
+        assert not path.exists(tree) and path.basename(trashed).startswith(".gc-tree-")
+        assert remove_tree(trashed, rate=0) == 4
+        assert not path.exists(trashed)
+        assert os.listdir(outside) == ["keep.txt"]
+        assert trash(tree) is None
@@ -0,0 +1,79 @@
+import sys
+import tempfile
+import unittest
+from os import path
+from autopyweb.introspection import IntrospectionError, IntrospectionPool, IntrospectionTimeout
+
+
+def project_file(name, content):
+    file_path = path.join(tempfile.mkdtemp(), name)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return file_path
+
+
+class TestIntrospection(unittest.TestCase):
+    def setUp(self):
+        self.pool = IntrospectionPool(size=1, timeout=10, memory_limit=0, max_calls=10, cache_dir=tempfile.mkdtemp())
+        self.addCleanup(self.pool.close)
+
+    def test_setup_py(self):
+        setup_py = project_file(
+            "setup.py",
+            "from setuptools import setup\nimport helper\nprint('noise')\n"
+            "setup(name='x', version='1', install_requires=['flask>=1.0', helper.REQUIREMENT])\n",
+        )
+        with open(path.join(path.dirname(setup_py), "helper.py"), "w", encoding="utf-8") as f:
+            f.write("REQUIREMENT = 'gunicorn'\n")
+        result = self.pool.introspect("setup_py", setup_py)
+        # Printing didn't break the worker's responses, and its import of the project's module stayed in the worker
+        assert result == {"install_requires": ["flask>=1.0", "gunicorn"]}
+        assert "helper" not in sys.modules
+        assert len(self.pool._idle) == 1 and self.pool._idle[0].calls == 1
+
+    def test_gunicorn_conf_cached_by_content(self):
+        conf_file = project_file("gunicorn.conf.py", "import os\nworkers = 3\ndef on_starting(s):\n    pass\n")
+        assert self.pool.introspect("gunicorn_conf", conf_file) == {"workers": 3}
+
+        def call(*args, **kwargs):
+            raise AssertionError("The file is unchanged, it shouldn't be run again")
+
+        self.pool.call = call
+        assert self.pool.introspect("gunicorn_conf", conf_file) == {"workers": 3}
+        with open(conf_file, "a", encoding="utf-8") as f:
+            f.write("threads = 2\n")
+        with self.assertRaises(AssertionError):
+            self.pool.introspect("gunicorn_conf", conf_file)
+
+    def test_setup_py_cached_by_the_files_it_read(self):
+        setup_py = project_file(
+            "setup.py",
+            "from setuptools import setup\nimport helper\n"
+            "setup(name='x', version='1', install_requires=open('requirements.txt').read().split())\n",
+        )
+        project_dir = path.dirname(setup_py)
+        with open(path.join(project_dir, "helper.py"), "w", encoding="utf-8") as f:
+            f.write("\n")
+        with open(path.join(project_dir, "requirements.txt"), "w", encoding="utf-8") as f:
+            f.write("flask\n")
+        result, inputs = self.pool.introspect("setup_py", setup_py, with_inputs=True)
+        assert result == {"install_requires": ["flask"]} and inputs == ["helper.py", "requirements.txt"]
+        with open(path.join(project_dir, "requirements.txt"), "w", encoding="utf-8") as f:
+            f.write("flask\ngunicorn\n")
+        # setup.py itself is unchanged, but it is run again
+        assert self.pool.introspect("setup_py", setup_py) == {"install_requires": ["flask", "gunicorn"]}
+        assert self.pool._idle[0].calls == 2
+        assert self.pool.introspect("setup_py", setup_py) == {"install_requires": ["flask", "gunicorn"]}
+        assert self.pool._idle[0].calls == 2
+
+    def test_errors_and_timeouts(self):
+        conf_file = project_file("gunicorn.conf.py", "raise ValueError('bad conf')\n")
+        with self.assertRaises(IntrospectionError):
+            self.pool.introspect("gunicorn_conf", conf_file)
+        conf_file = project_file("gunicorn.conf.py", "import time\ntime.sleep(30)\n")
+        with self.assertRaises(IntrospectionTimeout):
+            self.pool.call("gunicorn_conf", conf_file, timeout=0.5)
+        # The stuck worker was killed and replaced
+        assert not self.pool._idle
+        conf_file = project_file("gunicorn.conf.py", "workers = 2\n")
+        assert self.pool.call("gunicorn_conf", conf_file) == {"ok": True, "result": {"workers": 2}, "inputs": []}
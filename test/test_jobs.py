@@ -0,0 +1,131 @@
+import json
+import os
+import tempfile
+import threading
+import time
+import unittest
+from autopyweb.jobs import JobQueue, SUCCEEDED, FAILED, SUPERSEDED
+
+
+def wait_for(queue, job_id, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        record = queue.get(job_id)
+        if record["state"] in (SUCCEEDED, FAILED, SUPERSEDED):
+            return record
+        time.sleep(0.01)
+    raise AssertionError("Job did not finish")
+
+
+class TestJobs(unittest.TestCase):
+    def test_job_records_stages(self):
+        queue = JobQueue(max_workers=1, record_dir=tempfile.mkdtemp())
+
+        def work(job, value):
+            with job.run_stage("one"):
+                pass
+            with job.run_stage("two"):
+                pass
+            return value
+
+        job = queue.submit("test", work, 42)
+        record = wait_for(queue, job.id)
+        assert record["state"] == SUCCEEDED
+        assert record["result"] == 42
+        assert [s["name"] for s in record["stages"]] == ["one", "two"]
+        assert all(s["duration"] is not None for s in record["stages"])
+
+    def test_job_failure_is_recorded(self):
+        queue = JobQueue(max_workers=1, record_dir=tempfile.mkdtemp())
+
+        def work(job):
+            with job.run_stage("broken"):
+                raise RuntimeError("boom")
+
+        job = queue.submit("test", work)
+        record = wait_for(queue, job.id)
+        assert record["state"] == FAILED
+        assert "boom" in record["error"]
+        assert record["stages"][0]["success"] is False
+
+    def test_records_shared_between_queues(self):
+        record_dir = tempfile.mkdtemp()
+        queue = JobQueue(max_workers=1, record_dir=record_dir)
+        other = JobQueue(max_workers=1, record_dir=record_dir)
+        job = queue.submit("test", lambda job: True)
+        wait_for(queue, job.id)
+        assert other.get(job.id)["state"] == SUCCEEDED
+        assert other.list() == ([other.get(job.id)], 1)
+        assert other.list(offset=1) == ([], 1)
+
+    def test_submit_once_attaches_to_running_job(self):
+        record_dir = tempfile.mkdtemp()
+        queue = JobQueue(max_workers=2, record_dir=record_dir)
+        release = threading.Event()
+
+        def work(job, value):
+            release.wait(5)
+            return value
+
+        first, attached = queue.submit_once("origin\nmaster", "test", work, 1)
+        assert not attached
+        again, attached = queue.submit_once("origin\nmaster", "test", work, 2)
+        assert attached and again["id"] == first["id"]
+        other, attached = queue.submit_once("origin\ndevelop", "test", work, 3)
+        assert not attached and other["id"] != first["id"]
+
+        # Another worker sharing the state dir attaches to the same job, while the worker running it lives
+        key_file = queue._key_file("origin\nmaster")
+        with open(key_file, "r", encoding="utf-8") as f:
+            claim = json.load(f)
+        with open(key_file, "w", encoding="utf-8") as f:
+            json.dump(dict(claim, owner=os.getppid()), f)
+        again, attached = JobQueue(record_dir=record_dir).submit_once("origin\nmaster", "test", work, 4)
+        assert attached and again["id"] == first["id"]
+
+        release.set()
+        assert wait_for(queue, first["id"])["result"] == 1
+        # The key is released just after the job finishes
+        end = time.time() + 5
+        while os.path.exists(key_file) and time.time() < end:
+            time.sleep(0.01)
+        assert not os.path.exists(key_file)
+        after, attached = queue.submit_once("origin\nmaster", "test", work, 5)
+        assert not attached and after["id"] != first["id"]
+        assert wait_for(queue, after["id"])["result"] == 5
+
+    def test_debounce_coalesces_and_supersedes(self):
+        queue = JobQueue(max_workers=3, record_dir=tempfile.mkdtemp())
+        started = threading.Event()
+        release = threading.Event()
+
+        def work(job, value):
+            started.set()
+            release.wait(5)
+            job.check_superseded()
+            return value
+
+        first, _ = queue.submit_once("origin\nmaster", "test", work, 1, debounce=0.2)
+        # Requests within the window attach to the job still waiting, and restart its wait
+        again, attached = queue.submit_once("origin\nmaster", "test", work, 2, debounce=0.2)
+        assert attached and again["id"] == first["id"]
+        assert started.wait(5)
+        record = queue.get(first["id"])
+        assert [s["name"] for s in record["stages"]] == ["debounce"]
+        assert record["stages"][0]["duration"] >= 0.2
+
+        # A request once the job is past its wait starts a newer job, which supersedes it
+        newer, attached = queue.submit_once("origin\nmaster", "test", work, 3, debounce=0)
+        assert not attached
+        release.set()
+        assert wait_for(queue, first["id"])["state"] == SUPERSEDED
+        assert wait_for(queue, newer["id"])["result"] == 3
+
+    def test_debounce_does_not_hold_a_worker(self):
+        queue = JobQueue(max_workers=1, record_dir=tempfile.mkdtemp())
+        waiting, _ = queue.submit_once("origin\nmaster", "test", lambda job: 1, debounce=0.5)
+        # The only worker is free while the debounced job waits
+        job = queue.submit("test", lambda job: 2)
+        assert wait_for(queue, job.id, timeout=0.4)["result"] == 2
+        assert queue.get(waiting["id"])["stage"] == "debounce"
+        assert wait_for(queue, waiting["id"])["result"] == 1
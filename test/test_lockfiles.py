@@ -0,0 +1,89 @@
+import sys
+import unittest
+from os import path
+from autopyweb.lockfiles import Unlockable, applies, locked_requirements, read_toml
+from autopyweb.venvs import marker_environment
+
+REPO_DIR = path.dirname(path.dirname(path.abspath(__file__)))
+
+NEW_LOCK = {
+    "package": [
+        {
+            "name": "Flask",
+            "version": "2.0.1",
+            "dependencies": {
+                "click": {"version": ">=7.1", "markers": 'python_version >= "3.6"'},
+                "itsdangerous": "*",
+                "colorama": {"version": "*", "markers": 'platform_system == "Windows"'},
+                "dataclasses": {"version": "*", "python": "<3.7"},
+            },
+            "extras": {"dotenv": ["python-dotenv"]},
+            "files": [{"file": "Flask-2.0.1.whl", "hash": "sha256:aa"}],
+        },
+        {"name": "click", "version": "8.0.1", "files": [{"file": "click.whl", "hash": "sha256:bb"}]},
+        {
+            "name": "itsdangerous",
+            "version": "2.0.1",
+            "dependencies": {"flask": "*"},
+            "files": [{"file": "itsdangerous.whl", "hash": "sha256:cc"}],
+        },
+        {"name": "python-dotenv", "version": "0.19.0", "files": [{"file": "dotenv.tar.gz", "hash": "sha256:dd"}]},
+        {"name": "colorama", "version": "0.4.4", "files": [{"file": "colorama.whl", "hash": "sha256:ff"}]},
+        {"name": "dataclasses", "version": "0.8", "files": [{"file": "dataclasses.whl", "hash": "sha256:gg"}]},
+        {"name": "pytest", "version": "6.2.4", "files": [{"file": "pytest.whl", "hash": "sha256:ee"}]},
+    ]
+}
+
+LINUX_36 = {
+    "implementation_name": "cpython",
+    "os_name": "posix",
+    "platform_system": "Linux",
+    "python_full_version": "3.6.9",
+    "python_version": "3.6",
+    "sys_platform": "linux",
+}
+
+
+class TestLockfiles(unittest.TestCase):
+    def test_own_lock_file(self):
+        lock = read_toml(path.join(REPO_DIR, "poetry.lock"))
+        pyproject = read_toml(path.join(REPO_DIR, "pyproject.toml"))
+        lines = locked_requirements(lock, pyproject, marker_environment(sys.executable))
+        names = [line.split("==", 1)[0].lower() for line in lines]
+        assert "sanic" in names and "gitpython" in names and "uvloop" in names
+        # Dev dependencies are left out
+        assert "pytest" not in names and "black" not in names
+        assert all(" --hash=sha256:" in line for line in lines)
+
+    def test_markers_extras_and_cycles(self):
+        pyproject = {"project": {"dependencies": ["flask[dotenv]>=2.0"]}}
+        lines = locked_requirements(NEW_LOCK, pyproject, LINUX_36)
+        # python-dotenv only has an sdist, which is locked by its own hash
+        assert lines == [
+            "click==8.0.1 --hash=sha256:bb",
+            "dataclasses==0.8 --hash=sha256:gg",
+            "Flask==2.0.1 --hash=sha256:aa",
+            "itsdangerous==2.0.1 --hash=sha256:cc",
+            "python-dotenv==0.19.0 --hash=sha256:dd",
+        ]
+        windows_38 = dict(LINUX_36, platform_system="Windows", python_full_version="3.8.10", python_version="3.8")
+        names = [line.split("==", 1)[0] for line in locked_requirements(NEW_LOCK, pyproject, windows_38)]
+        assert names == ["click", "colorama", "Flask", "itsdangerous", "python-dotenv"]
+        # Root dependencies are evaluated too
+        pyproject = {"tool": {"poetry": {"dependencies": {"flask": {"version": "*", "python": "~3.8"}}}}}
+        assert locked_requirements(NEW_LOCK, pyproject, LINUX_36) == []
+
+    def test_python_constraints(self):
+        assert applies(LINUX_36, python="^3.6") and not applies(LINUX_36, python="^3.7")
+        assert applies(LINUX_36, python="3.6") and not applies(LINUX_36, python="3.7")
+        assert applies(LINUX_36, python=">=2.7,<3.0 || >=3.5") and not applies(LINUX_36, python="~2.7 || >=3.8")
+        assert applies(LINUX_36, python="*") and applies(LINUX_36, python="3.6.*")
+        assert not applies(LINUX_36, marker='python_version < "3.6" or sys_platform == "win32"')
+        assert applies(LINUX_36, marker='extra == "socks" or os_name == "posix"')
+
+    def test_unlockable(self):
+        with self.assertRaises(Unlockable):
+            locked_requirements(NEW_LOCK, {"project": {"dependencies": ["django"]}}, LINUX_36)
+        lock = {"package": [{"name": "app", "version": "1.0", "source": {"type": "git", "url": "x"}}]}
+        with self.assertRaises(Unlockable):
+            locked_requirements(lock, {"tool": {"poetry": {"dependencies": {"python": "^3.6", "app": "*"}}}}, LINUX_36)
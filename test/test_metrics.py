@@ -0,0 +1,57 @@
+import json
+import os
+import subprocess
+import tempfile
+import unittest
+from os import path
+from autopyweb.metrics import Registry, Counter, Gauge, Histogram
+
+
+def dead_pid():
+    proc = subprocess.Popen(["true"])
+    proc.wait()
+    return proc.pid
+
+
+class TestMetrics(unittest.TestCase):
+    def test_render_histogram_and_counter(self):
+        registry = Registry(record_dir=False)
+        h = Histogram("t_seconds", "Time.", ("stage",), registry=registry, buckets=(1, 5))
+        c = Counter("t_total", "Count.", ("stage", "result"), registry=registry)
+        h.observe(0.5, stage="fetch")
+        h.observe(3, stage="fetch")
+        h.observe(30, stage="fetch")
+        c.inc(stage="fetch", result="success")
+        lines = registry.render().splitlines()
+        assert "# TYPE t_seconds histogram" in lines
+        assert 't_seconds_bucket{stage="fetch",le="1"} 1' in lines
+        assert 't_seconds_bucket{stage="fetch",le="5"} 2' in lines
+        assert 't_seconds_bucket{stage="fetch",le="+Inf"} 3' in lines
+        assert 't_seconds_sum{stage="fetch"} 33.5' in lines
+        assert 't_seconds_count{stage="fetch"} 3' in lines
+        assert 't_total{stage="fetch",result="success"} 1' in lines
+
+    def test_merges_workers_and_drops_dead_gauges(self):
+        record_dir = tempfile.mkdtemp()
+        registry = Registry(record_dir=record_dir)
+        c = Counter("d_total", "Deploys.", registry=registry)
+        g = Gauge("d_in_flight", "In flight.", registry=registry)
+        c.inc()
+        g.inc()
+        assert path.isfile(path.join(record_dir, "{}.json".format(registry._instance)))
+        # A worker which has exited
+        with open(path.join(record_dir, "other.json"), "w") as f:
+            json.dump({"pid": dead_pid(), "metrics": {"d_total": [[[], 4]], "d_in_flight": [[[], 2]]}}, f)
+        lines = registry.render().splitlines()
+        assert "d_total 5" in lines
+        assert "d_in_flight 1" in lines
+        # The exited worker's counters were folded into one snapshot with those of every other exited worker
+        assert sorted(os.listdir(record_dir)) == sorted(
+            ["{}.json".format(registry._instance), "retired.json", "retired.json.lock"]
+        )
+        with open(path.join(record_dir, "another.json"), "w") as f:
+            json.dump({"pid": dead_pid(), "metrics": {"d_total": [[[], 2]], "d_in_flight": [[[], 2]]}}, f)
+        lines = registry.render().splitlines()
+        assert "d_total 7" in lines and "d_in_flight 1" in lines
+        assert not path.exists(path.join(record_dir, "another.json"))
+        assert "d_total 7" in registry.render().splitlines()
@@ -0,0 +1,91 @@
+import os
+import tempfile
+import time
+import unittest
+from os import path
+from git import Repo
+from autopyweb.mirrors import MirrorStore, fetch_plan, fetch_plans, normalise_origin, plan_fetch
+
+
+class TestMirrors(unittest.TestCase):
+    def test_normalise_origin(self):
+        expected = "github.com/ashleysommer/autopyweb"
+        assert normalise_origin("git@github.com:ashleysommer/autopyweb.git") == expected
+        assert normalise_origin("ssh://git@github.com/ashleysommer/autopyweb") == expected
+        assert normalise_origin("https://user:pw@GitHub.com/ashleysommer/autopyweb/") == expected
+        assert normalise_origin("/srv/git/project.git") == "/srv/git/project"
+
+    def test_same_origin_same_mirror(self):
+        store = MirrorStore(location=tempfile.mkdtemp())
+        a = store.mirror_path("git@github.com:ashleysommer/autopyweb.git")
+        b = store.mirror_path("https://github.com/ashleysommer/autopyweb")
+        c = store.mirror_path("https://github.com/ashleysommer/other")
+        assert a == b
+        assert a != c
+
+    def test_evict_by_age(self):
+        store = MirrorStore(location=tempfile.mkdtemp(), max_bytes=0, max_age=60)
+        with store.open("https://example.com/old.git"):
+            pass
+        with store.open("https://example.com/new.git"):
+            pass
+        old = store.mirror_path("https://example.com/old.git")
+        stale = time.time() - 3600
+        os.utime(path.join(old, "autopyweb-last-used"), (stale, stale))
+        removed = store.evict()
+        assert removed == [old]
+        assert not path.exists(old)
+        assert path.isdir(store.mirror_path("https://example.com/new.git"))
+
+    def test_plan_fetch_is_narrow(self):
+        plan = plan_fetch(branch="feature/x")
+        assert plan.refspec == "+refs/heads/feature/x:refs/remotes/origin/feature/x"
+        plan = plan_fetch(tag="v1.0")
+        assert plan.refspec == "+refs/tags/v1.0:refs/tags/v1.0"
+        sha = "a4bfb84e8f41ca6a07efaf1830973fec8e951ff9"
+        plan = plan_fetch(commit=sha.upper())
+        assert plan.refspec == "+{0}:refs/autopyweb/commits/{0}".format(sha)
+        assert plan_fetch().name == "master"
+
+    def test_fetch_plans_shares_one_fetch(self):
+        origin = tempfile.mkdtemp()
+        repo = Repo.init(origin)
+        with repo.config_writer() as cw:
+            cw.set_value("user", "name", "test")
+            cw.set_value("user", "email", "test@example.com")
+        repo.index.commit("first")
+        repo.git.branch("-M", "master")
+        master = repo.head.commit.hexsha
+        repo.create_head("feature").checkout()
+        repo.index.commit("second")
+        feature = repo.head.commit.hexsha
+
+        store = MirrorStore(location=tempfile.mkdtemp())
+        plans = [plan_fetch(branch="master"), plan_fetch(branch="feature"), plan_fetch(branch="missing")]
+        with store.open(origin) as mirror:
+            found = fetch_plans(mirror, plans, depth=0)
+        # The missing branch fails the combined fetch, the others are still found
+        assert [c.hexsha for c in found[:2]] == [master, feature]
+        assert isinstance(found[2], RuntimeError)
+        with store.open(origin) as mirror:
+            found = fetch_plans(mirror, plans[:2] + [plan_fetch(commit=master)], depth=0)
+        assert [c.hexsha for c in found] == [master, feature, master]
+
+    def test_fetch_commit_not_yet_in_mirror(self):
+        origin = tempfile.mkdtemp()
+        repo = Repo.init(origin)
+        with repo.config_writer() as cw:
+            cw.set_value("user", "name", "test")
+            cw.set_value("user", "email", "test@example.com")
+        repo.index.commit("first")
+        repo.git.branch("-M", "master")
+        first = repo.head.commit.hexsha
+        repo.index.commit("second")
+        second = repo.head.commit.hexsha
+
+        store = MirrorStore(location=tempfile.mkdtemp())
+        with store.open(origin) as mirror:
+            assert fetch_plan(mirror, plan_fetch(commit=first), depth=0).hexsha == first
+            assert mirror.git.rev_parse("refs/autopyweb/commits/{}".format(first)) == first
+            found = fetch_plans(mirror, [plan_fetch(commit=second), plan_fetch(branch="master")], depth=0)
+        assert [c.hexsha for c in found] == [second, second]
@@ -0,0 +1,119 @@
+import threading
+import time
+import unittest
+from autopyweb.functions import deploy_stages
+from autopyweb.jobs import Job, Superseded
+from autopyweb.pipeline import Pipeline, Stage
+
+
+class TestPipeline(unittest.TestCase):
+    def test_independent_stages_overlap(self):
+        barrier = threading.Barrier(2, timeout=5)
+
+        def side(ctx):
+            # Both side stages must be running at once to pass the barrier
+            barrier.wait()
+            return ctx["root"] + 1
+
+        stages = [
+            Stage("root", lambda ctx: 1),
+            Stage("left", side, requires=("root",)),
+            Stage("right", side, requires=("root",)),
+            Stage("join", lambda ctx: ctx["left"] + ctx["right"], requires=("left", "right")),
+        ]
+        ctx = Pipeline(stages, max_workers=2).run()
+        assert ctx["join"] == 4
+        assert set(ctx["timings"].keys()) == {"root", "left", "right", "join"}
+
+    def test_failure_stops_dependents(self):
+        ran = []
+
+        def broken(ctx):
+            raise RuntimeError("boom")
+
+        stages = [
+            Stage("broken", broken),
+            Stage("after", lambda ctx: ran.append("after"), requires=("broken",)),
+            Stage("optional", broken, critical=False),
+        ]
+        with self.assertRaises(RuntimeError):
+            Pipeline(stages).run()
+        assert ran == []
+
+    def test_seeded_requirements(self):
+        stages = [Stage("double", lambda ctx: ctx["checkout"] * 2, requires=("checkout",))]
+        assert Pipeline(stages).run({"checkout": 21})["double"] == 42
+        with self.assertRaises(RuntimeError):
+            Pipeline(stages).run()
+
+    def test_slow_stage_does_not_block_ready_ones(self):
+        order = []
+
+        def slow(ctx):
+            time.sleep(0.2)
+            order.append("slow")
+
+        stages = [
+            Stage("slow", slow),
+            Stage("fast", lambda ctx: order.append("fast")),
+        ]
+        Pipeline(stages, max_workers=2).run()
+        assert order == ["fast", "slow"]
+
+    def test_superseded_job_skips_cancellable_stages(self):
+        job = Job("test")
+        superseded = []
+        job._superseded = lambda: bool(superseded)
+        ran = []
+
+        def run(name):
+            def stage(ctx):
+                ran.append(name)
+                if name == "fetch":
+                    superseded.append(True)
+
+            return stage
+
+        stages = [
+            Stage("fetch", run("fetch")),
+            Stage("launch", run("launch"), requires=("fetch",)),
+            Stage("gc", run("gc"), requires=("fetch",), critical=False),
+            Stage("finish", run("finish"), requires=("fetch",), cancellable=False),
+        ]
+        with self.assertRaises(Superseded):
+            Pipeline(stages, max_workers=2).run(job=job)
+        assert sorted(ran) == ["fetch", "finish"]
+        # Only non-critical stages were left, so the pipeline finishes
+        ran[:] = []
+        superseded[:] = []
+        ctx = Pipeline(stages[:1] + stages[2:], max_workers=2).run(job=job)
+        assert sorted(ran) == ["fetch", "finish"]
+        assert "gc" not in ctx
+
+    def test_superseded_skips_dependents_of_skipped_stages(self):
+        job = Job("test")
+        superseded = []
+        job._superseded = lambda: bool(superseded)
+
+        stages = [
+            Stage("scripts", lambda ctx: superseded.append(True)),
+            Stage("compile", lambda ctx: None, requires=("scripts",), critical=False),
+            Stage("save_plan", lambda ctx: None, requires=("scripts",), critical=False),
+            Stage("launch", lambda ctx: None, requires=("scripts", "compile")),
+            Stage("switch", lambda ctx: None, requires=("launch",), cancellable=False),
+        ]
+        # The skipped compile stage leaves launch and switch unable to run, which ends as superseded
+        with self.assertRaises(Superseded):
+            Pipeline(stages, max_workers=2).run(job=job)
+
+    def test_base_venv_is_made_alongside_the_fetch(self):
+        stages = {s.name: s for s in deploy_stages()}
+
+        def ancestors(name):
+            found = set()
+            for r in stages[name].requires:
+                found |= {r} | ancestors(r)
+            return found
+
+        assert ancestors("base_venv") == {"interpreter"}
+        assert {"base_venv", "detect"} <= ancestors("venv")
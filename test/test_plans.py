@@ -0,0 +1,58 @@
+import os
+import tempfile
+import unittest
+from os import path
+from autopyweb.plans import PlanStore, plain_settings
+
+
+def checkout(requirements):
+    project_dir = tempfile.mkdtemp()
+    with open(path.join(project_dir, "requirements.txt"), "w", encoding="utf-8") as f:
+        f.write(requirements)
+    return project_dir
+
+
+class TestPlans(unittest.TestCase):
+    def test_plans_by_commit_and_manifests(self):
+        store = PlanStore(location=tempfile.mkdtemp(), history=10)
+        first = checkout("flask\n")
+        plan, key = store.lookup(first, commit="a" * 40)
+        assert plan is None
+        store.save(key, {"project": {"project_type": "requirements"}}, commit="a" * 40)
+
+        # Found by its commit, even once the checkout is gone
+        os.unlink(path.join(first, "requirements.txt"))
+        plan, found_key = store.lookup(first, commit="a" * 40)
+        assert found_key == key and plan["project"]["project_type"] == "requirements"
+        # Another commit with the same manifests shares the plan
+        plan, found_key = store.lookup(checkout("flask\n"), commit="b" * 40)
+        assert found_key == key and plan is not None
+        # Changed manifests need a new plan
+        plan, found_key = store.lookup(checkout("sanic\n"), commit="c" * 40)
+        assert plan is None and found_key != key
+
+    def test_plain_settings(self):
+        settings = {"workers": 2, "bind": ["unix:x"], "on_starting": lambda server: None, "os": os, "_x": 1}
+        assert plain_settings(settings) == {"workers": 2, "bind": ["unix:x"]}
+
+    def test_manifests_include_requirement_files(self):
+        store = PlanStore(location=tempfile.mkdtemp(), history=10)
+        project_dir = checkout("-r base.txt\n")
+        with open(path.join(project_dir, "base.txt"), "w", encoding="utf-8") as f:
+            f.write("flask\n")
+        _, key = store.lookup(project_dir)
+        with open(path.join(project_dir, "base.txt"), "w", encoding="utf-8") as f:
+            f.write("sanic\n")
+        assert store.lookup(project_dir)[1] != key
+
+    def test_plans_need_the_files_setup_py_read(self):
+        store = PlanStore(location=tempfile.mkdtemp(), history=10)
+        project_dir = checkout("flask\n")
+        _, key = store.lookup(project_dir, commit="a" * 40)
+        plan = {"project": {"project_type": "setup_py", "inputs": ["requirements.txt"]}}
+        store.save(key, plan, commit="a" * 40, project_dir=project_dir)
+        assert store.lookup(project_dir, commit="a" * 40)[0] is not None
+        with open(path.join(project_dir, "requirements.txt"), "w", encoding="utf-8") as f:
+            f.write("sanic\n")
+        # Neither by its commit nor by the manifests, setup.py has to be run again
+        assert store.lookup(project_dir, commit="a" * 40)[0] is None
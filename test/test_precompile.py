@@ -0,0 +1,43 @@
+import os
+import sys
+import tempfile
+import unittest
+from os import path
+from autopyweb.functions import precompile_project
+from autopyweb.venvs import COMPILED_FILE
+
+
+def write(location, name, content):
+    file_path = path.join(location, name)
+    os.makedirs(path.dirname(file_path), exist_ok=True)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return file_path
+
+
+def compiled(location):
+    return path.isdir(path.join(location, "__pycache__"))
+
+
+class TestPrecompile(unittest.TestCase):
+    def test_compiles_project_and_venv_once(self):
+        venv = tempfile.mkdtemp()
+        os.makedirs(path.join(venv, "bin"))
+        os.symlink(sys.executable, path.join(venv, "bin", "python"))
+        write(venv, "lib/site-packages/dep.py", "X = 1\n")
+        project_dir = tempfile.mkdtemp()
+        write(project_dir, "app.py", "import dep\n")
+        write(project_dir, "pkg/views.py", "Y = 2\n")
+        write(project_dir, ".git/hooks/hook.py", "Z = 3\n")
+        os.symlink(venv, path.join(project_dir, "dynvenv"))
+
+        targets = precompile_project(project_dir, venv, workers=2)
+        assert len(targets) == 2
+        assert compiled(project_dir)
+        assert compiled(path.join(project_dir, "pkg"))
+        assert not compiled(path.join(project_dir, ".git", "hooks"))
+        assert compiled(path.join(venv, "lib", "site-packages"))
+        assert path.isfile(path.join(venv, COMPILED_FILE))
+
+        # The venv is only compiled the first time
+        assert precompile_project(project_dir, venv, workers=2) == [path.realpath(project_dir)]
@@ -0,0 +1,62 @@
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler
+from os import path
+from autopyweb.readiness import probe
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+def serve(status):
+    class Handler(BaseHTTPRequestHandler):
+        def address_string(self):
+            return "unix"
+
+        def do_GET(self):
+            Handler.seen.append(self.path)
+            self.send_response(status)
+            self.send_header("Content-Length", "2")
+            self.end_headers()
+            self.wfile.write(b"ok")
+
+        def log_message(self, *args):
+            pass
+
+    Handler.seen = []
+    sock_path = path.join(tempfile.mkdtemp(), "gunicorn.sock")
+    server = UnixHTTPServer(sock_path, Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, sock_path, Handler.seen
+
+
+class TestReadiness(unittest.TestCase):
+    def test_probe_warms_up_each_path(self):
+        server, sock_path, seen = serve(404)
+        try:
+            readiness = probe(sock_path, 5, warmup_paths=["/", "/health"], warmup_rounds=2)
+        finally:
+            server.shutdown()
+        assert seen == ["/", "/", "/health", "/health"]
+        assert [r["status"] for r in readiness["warmup_requests"]] == [404] * 4
+        assert readiness["time_to_ready"] >= readiness["socket_wait"]
+
+    def test_server_errors_are_not_ready(self):
+        server, sock_path, seen = serve(500)
+        started = time.time()
+        try:
+            with self.assertRaises(RuntimeError):
+                probe(sock_path, 0.5, warmup_paths=["/"])
+        finally:
+            server.shutdown()
+        assert time.time() - started < 3
+        assert len(seen) > 1
+
+    def test_no_socket_is_not_ready(self):
+        sock_path = path.join(tempfile.mkdtemp(), "gunicorn.sock")
+        with self.assertRaises(RuntimeError):
+            probe(sock_path, 0.2, warmup_paths=["/"])
@@ -0,0 +1,71 @@
+import os
+import tempfile
+import time
+import unittest
+from os import path
+from autopyweb.releases import ReleaseStore, StaleRelease
+
+
+def make_release(location, name):
+    release = path.join(location, name)
+    os.makedirs(release)
+    return release
+
+
+class TestReleases(unittest.TestCase):
+    def setUp(self):
+        self.location = path.realpath(tempfile.mkdtemp())
+        self.store = ReleaseStore(record_dir=tempfile.mkdtemp(), keep_warm=3600)
+        self.link = path.join(self.location, "proj-pr1")
+
+    def test_switch_replaces_link_and_keeps_previous(self):
+        blue = make_release(self.location, "proj-aaa")
+        green = make_release(self.location, "proj-bbb")
+        assert self.store.switch(self.link, blue) is None
+        assert self.store.switch(self.link, green) == blue
+        assert os.readlink(self.link) == green
+        record = self.store.get(self.link)
+        assert record["current"] == green
+        assert record["previous"] == blue
+        # Only the link itself is left behind, no temporary links
+        assert sorted(os.listdir(self.location)) == ["proj-aaa", "proj-bbb", "proj-pr1"]
+
+    def test_switch_does_not_undo_a_newer_deploy(self):
+        blue = make_release(self.location, "proj-aaa")
+        green = make_release(self.location, "proj-bbb")
+        started = time.time() - 1
+        self.store.switch(self.link, green, since=time.time())
+        with self.assertRaises(StaleRelease):
+            self.store.switch(self.link, blue, since=started)
+        assert os.readlink(self.link) == green
+        # The same release again is fine
+        assert self.store.switch(self.link, green, since=started) is None
+
+    def test_sweep_removes_only_unlinked_releases(self):
+        blue = make_release(self.location, "proj-aaa")
+        green = make_release(self.location, "proj-bbb")
+        self.store.switch(self.link, blue)
+        self.store.switch(self.link, green)
+        os.symlink(blue, path.join(self.location, "proj-other"))
+        assert self.store.sweep(now=0) == []
+        self.store.switch(self.link, blue)
+        os.unlink(path.join(self.location, "proj-other"))
+        # green is due to be retired once it has been kept warm
+        assert self.store.sweep() == []
+        removed = self.store.sweep(now=float("inf"))
+        assert removed == [green]
+        assert not path.exists(green)
+        assert path.isdir(blue)
+
+    def test_rollback_relaunches_cold_release(self):
+        blue = make_release(self.location, "proj-aaa")
+        green = make_release(self.location, "proj-bbb")
+        with self.assertRaises(RuntimeError):
+            self.store.rollback(self.link)
+        self.store.switch(self.link, blue)
+        self.store.switch(self.link, green)
+        relaunched = []
+        assert self.store.rollback(self.link, relaunch=relaunched.append) == blue
+        assert relaunched == [blue]
+        assert os.readlink(self.link) == blue
+        assert self.store.get(self.link)["previous"] == green
@@ -0,0 +1,30 @@
+import tempfile
+import unittest
+from os import path
+from autopyweb.requirements import is_local, read_requirements
+
+
+def write(location, name, content):
+    file_path = path.join(location, name)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return file_path
+
+
+class TestRequirements(unittest.TestCase):
+    def test_is_local(self):
+        for line in ("-e .", "--editable=./libs/a", ".", "./libs/a", "libs/a", "a @ file:///srv/a", "/srv/a.whl"):
+            assert is_local(line), line
+        for line in ("flask==1.1.1", "a @ https://example.com/a.whl", "git+https://example.com/a.git", "-f ./w"):
+            assert not is_local(line), line
+
+    def test_includes(self):
+        project_dir = path.realpath(tempfile.mkdtemp())
+        main = write(project_dir, "requirements.txt", "-r base.txt\n-c constraints.txt\n-e .\nflask # web\n")
+        base = write(project_dir, "base.txt", "requests\n./libs/a\n-r requirements.txt\n")
+        constraints = write(project_dir, "constraints.txt", "-r pins.txt\n")
+        pins = write(project_dir, "pins.txt", "requests==2.22.0\n")
+        files, shared, local = read_requirements(main)
+        assert files == [main, base, constraints, pins]
+        assert shared == ["requests", "-c {}".format(constraints), "flask"]
+        assert local == ["./libs/a", "-e ."]
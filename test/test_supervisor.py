@@ -0,0 +1,90 @@
+import json
+import os
+import subprocess
+import tempfile
+import time
+import unittest
+from autopyweb.supervisor import Supervisor, pid_alive, RUNNING, STOPPED, FATAL
+
+
+def wait_for_state(supervisor, name, states, timeout=5.0):
+    end = time.time() + timeout
+    while time.time() < end:
+        record = supervisor.get(name)
+        if record is not None and record["state"] in states:
+            return record
+        time.sleep(0.01)
+    raise AssertionError("Process did not reach {}".format(states))
+
+
+class TestSupervisor(unittest.TestCase):
+    def make_supervisor(self, **kwargs):
+        kwargs.setdefault("stop_timeouts", (5, 5))
+        kwargs.setdefault("backoff", 0.01)
+        kwargs.setdefault("backoff_max", 0.05)
+        kwargs.setdefault("stable_after", 30)
+        kwargs.setdefault("start_retries", 2)
+        return Supervisor(record_dir=tempfile.mkdtemp(), **kwargs)
+
+    def test_stop_waits_for_exit_not_timeout(self):
+        supervisor = self.make_supervisor()
+        cwd = tempfile.mkdtemp()
+        open(os.path.join(cwd, "app.pid"), "w").close()
+        record = supervisor.start("app", ["sleep", "30"], cwd=cwd, cleanup=("app.pid",))
+        assert record["state"] == RUNNING
+        pid = record["pid"]
+        started = time.time()
+        record = supervisor.stop("app")
+        assert time.time() - started < 2
+        assert record["state"] == STOPPED
+        assert not pid_alive(pid)
+        assert not os.path.exists(os.path.join(cwd, "app.pid"))
+
+    def test_escalates_when_term_is_ignored(self):
+        supervisor = self.make_supervisor(stop_timeouts=(0.2, 0.2))
+        argv = ["sh", "-c", "trap '' TERM INT; while true; do sleep 0.05; done"]
+        record = supervisor.start("stubborn", argv, cwd=tempfile.mkdtemp())
+        time.sleep(0.2)
+        record = supervisor.stop("stubborn")
+        assert record["state"] == STOPPED
+        assert record["exit_code"] == -9
+
+    def test_crashed_process_is_restarted_then_given_up(self):
+        supervisor = self.make_supervisor()
+        supervisor.start("crashy", ["sh", "-c", "exit 3"], cwd=tempfile.mkdtemp())
+        record = wait_for_state(supervisor, "crashy", (FATAL,))
+        assert record["restarts"] == 2
+        assert record["exit_code"] == 3
+
+    def test_other_worker_can_stop_process(self):
+        record_dir = tempfile.mkdtemp()
+        owner = Supervisor(record_dir=record_dir, stop_timeouts=(5, 5), backoff=0.01)
+        other = Supervisor(record_dir=record_dir, stop_timeouts=(5, 5))
+        pid = owner.start("shared", ["sleep", "30"], cwd=tempfile.mkdtemp())["pid"]
+        assert other.get("shared")["state"] == RUNNING
+        record = other.stop("shared")
+        assert record["state"] == STOPPED
+        assert not pid_alive(pid)
+        # The owner sees the stop was asked for, so it doesn't restart the process
+        record = wait_for_state(owner, "shared", (STOPPED,))
+        assert record["restarts"] == 0
+
+    def test_orphan_is_adopted_not_started_again(self):
+        record_dir = tempfile.mkdtemp()
+        cwd = tempfile.mkdtemp()
+        # Not a child of this process, like the app of a worker which died
+        out = subprocess.check_output(["sh", "-c", "sleep 30 >/dev/null 2>&1 & echo $!"], cwd=cwd)
+        orphan_pid = int(out.decode().strip())
+        dead_owner = subprocess.Popen(["true"])
+        dead_owner.wait()
+        # Left behind by an autopyweb worker which died while its app kept running
+        with open(os.path.join(record_dir, "orphan.json"), "w") as f:
+            json.dump({"name": "orphan", "pid": orphan_pid, "cwd": cwd, "state": RUNNING, "owner": dead_owner.pid}, f)
+        supervisor = Supervisor(record_dir=record_dir, stop_timeouts=(5, 5))
+        record = supervisor.start("orphan", ["sh", "-c", "touch started"], cwd=cwd)
+        assert record["pid"] == orphan_pid and record["owner"] == os.getpid()
+        assert supervisor.get("orphan")["supervised"]
+        record = supervisor.stop("orphan")
+        assert record["state"] == STOPPED
+        assert not pid_alive(orphan_pid, cwd)
+        assert not os.path.exists(os.path.join(cwd, "started"))
@@ -0,0 +1,48 @@
+import json
+import sys
+import tempfile
+import unittest
+from os import path
+from autopyweb import tracing
+from autopyweb.pipeline import Pipeline, Stage
+
+
+def events(trace, cat):
+    return [e for e in trace.to_dict()["traceEvents"] if e.get("cat", None) == cat]
+
+
+class TestTracing(unittest.TestCase):
+    def test_subprocess_span(self):
+        trace = tracing.Trace()
+        with tracing.activate(trace):
+            resp = tracing.run([sys.executable, "-c", "import sys; sum(range(3000000)); sys.exit(3)"])
+        assert resp.returncode == 3
+        (event,) = events(trace, "subprocess")
+        assert event["ph"] == "X"
+        assert event["args"]["argv"][0] == sys.executable
+        assert event["args"]["exit_code"] == 3
+        assert event["args"]["cpu_user"] > 0
+
+    def test_run_without_trace(self):
+        resp = tracing.run(["echo", "hi"], stdout=tracing.subprocess.PIPE)
+        assert resp.stdout == b"hi\n"
+
+    def test_pipeline_stages_join_the_trace(self):
+        target = path.join(tempfile.mkdtemp(), "trace.json")
+        stages = [
+            Stage("one", lambda ctx: tracing.run(["true"]).returncode),
+            Stage("two", lambda ctx: ctx["one"], requires=("one",)),
+        ]
+        with tracing.traced("deploy") as trace:
+            tracing.save_to(target)
+            Pipeline(stages, max_workers=2).run()
+        with open(target, "r", encoding="utf-8") as f:
+            saved = json.load(f)
+        names = {e["name"]: e for e in saved["traceEvents"] if e["ph"] == "X"}
+        assert set(names.keys()) == {"deploy", "one", "two", "true"}
+        # Stages run in another thread from the deploy, and the subprocess within its stage
+        assert names["one"]["tid"] != names["deploy"]["tid"]
+        assert names["true"]["tid"] == names["one"]["tid"]
+        assert names["deploy"]["dur"] >= names["one"]["dur"] + names["two"]["dur"]
+        assert tracing.current() is None
+        assert trace.targets == [target]
@@ -0,0 +1,47 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from os import path
+from autopyweb.usage import RingBuffer, UsageCollector, process_trees, read_processes
+
+
+class TestUsage(unittest.TestCase):
+    def test_ring_buffer(self):
+        file_path = path.join(tempfile.mkdtemp(), "app.usage")
+        buffer = RingBuffer(file_path, size=3)
+        self.addCleanup(buffer.close)
+        for i in range(5):
+            buffer.append({"time": i, "cpu": i / 10.0, "rss": 1024 * i})
+        # The oldest are overwritten, and another process can read them from the file
+        reader = RingBuffer(file_path)
+        self.addCleanup(reader.close)
+        assert reader.size == 3 and reader.count == 5
+        assert [s["time"] for s in reader.samples()] == [2, 3, 4]
+        assert reader.samples(limit=1) == [
+            {"time": 4, "cpu": 0.4, "rss": 4096, "fds": 0, "threads": 0, "processes": 0}
+        ]
+        assert path.getsize(file_path) == 24 + 3 * 6 * 8
+
+    def test_process_trees(self):
+        processes = {1: (0, 0, 0, 1), 10: (1, 0, 0, 1), 11: (10, 0, 0, 1), 12: (10, 0, 0, 1), 20: (1, 0, 0, 1)}
+        trees = process_trees(processes, [10, 99])
+        assert sorted(trees[10]) == [10, 11, 12] and 99 not in trees
+
+    def test_collect(self):
+        child = subprocess.Popen([sys.executable, "-c", "import time; time.sleep(30)"])
+        self.addCleanup(child.wait)
+        self.addCleanup(child.kill)
+        assert child.pid in read_processes()
+        collector = UsageCollector(location=tempfile.mkdtemp(), interval=10, history=5)
+        collector.collect(apps={"me": os.getpid()}, now=1000.0)
+        sample = collector.collect(apps={"me": os.getpid()}, now=1010.0)["me"]
+        assert sample["processes"] >= 2 and sample["rss"] > 0 and sample["fds"] > 0 and sample["threads"] >= 2
+        assert [s["time"] for s in collector.samples("me")] == [1000.0, 1010.0]
+        assert collector.samples("nobody") is None
+        # Once an app is gone its history is kept until it is as old as a buffer covers
+        collector.collect(apps={}, now=1020.0)
+        assert collector.samples("me") is not None
+        collector.collect(apps={}, now=1070.0)
+        assert collector.samples("me") is None
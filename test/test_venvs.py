@@ -0,0 +1,88 @@
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+from os import path
+from autopyweb.metrics import registry
+from autopyweb.venvs import PYTHON_FILE, READY_FILE, VenvPool, VenvStore, interpreter_id, requirements_key
+from autopyweb.venvs import layer_base, make_layer, site_packages
+
+
+def write(location, name, content):
+    file_path = path.join(location, name)
+    with open(file_path, "w", encoding="utf-8") as f:
+        f.write(content)
+    return file_path
+
+
+class TestVenvStore(unittest.TestCase):
+    def test_requirements_key(self):
+        a = write(tempfile.mkdtemp(), "requirements.txt", "flask==1.1.1\n")
+        b = write(tempfile.mkdtemp(), "requirements.txt", "flask==1.1.1\n")
+        c = write(tempfile.mkdtemp(), "requirements.txt", "flask==1.1.2\n")
+        key = requirements_key(files=[a], python=sys.executable)
+        assert key == requirements_key(files=[b], python=sys.executable)
+        assert key != requirements_key(files=[c], python=sys.executable)
+
+    def test_collect_unreferenced(self):
+        store = VenvStore(location=tempfile.mkdtemp(), gc_age=0)
+        project_dir = tempfile.mkdtemp()
+        with store.provision("abc") as env:
+            os.makedirs(env.venv_path)
+            env.mark_ready()
+            store.link("abc", project_dir, "dynvenv")
+        assert store.collect() == []
+        assert store.get("abc").live_refs() == [path.realpath(project_dir)]
+        os.unlink(path.join(project_dir, "dynvenv"))
+        assert store.collect() == ["abc"]
+        assert not path.exists(env.location)
+
+    def test_pool_stats(self):
+        # Not refilled, so claims don't build venvs
+        pool = VenvPool(location=tempfile.mkdtemp(), size=0)
+        entry = path.join(pool.location, "pip-abc")
+        os.makedirs(path.join(entry, "venv"))
+        write(entry, PYTHON_FILE, interpreter_id())
+        write(entry, READY_FILE, "")
+        stats = pool.stats()
+        assert stats["size"] == 0 and stats["ready"]["pip"] == 1
+        assert pool.claim("pip", path.join(tempfile.mkdtemp(), "venv"))
+        assert not pool.claim("pip", path.join(tempfile.mkdtemp(), "venv"))
+        stats = pool.stats()
+        assert stats["ready"]["pip"] == 0 and stats["hits"] == 1 and stats["misses"] == 1
+        # The pool every deploy uses is reported on /metrics
+        lines = registry.render().splitlines()
+        assert "# TYPE autopyweb_venv_pool_ready gauge" in lines
+        assert 'autopyweb_venv_pool_ready{flavor="pip"} 0' in lines
+        assert "autopyweb_venv_pool_size 0" in lines
+
+    def test_pool_give_back(self):
+        pool = VenvPool(location=tempfile.mkdtemp(), size=0)
+        entry = path.join(pool.location, "pip-abc")
+        os.makedirs(path.join(entry, "venv"))
+        write(entry, PYTHON_FILE, interpreter_id())
+        write(entry, READY_FILE, "")
+        assert pool.take("pip") == entry and pool.take("pip") is None
+        # Not adopted, so it is ready for the next deploy
+        pool.give_back(entry)
+        assert pool.take("pip") == entry
+        venv_link = path.join(tempfile.mkdtemp(), "venv")
+        pool.adopt(entry, venv_link)
+        pool.give_back(entry)
+        assert pool.take("pip") is None and path.realpath(venv_link) == path.join(entry, "venv")
+
+    def test_layer(self):
+        base = path.join(tempfile.mkdtemp(), "venv")
+        layer = path.join(tempfile.mkdtemp(), "layer")
+        subprocess.run([sys.executable, "-m", "venv", "--without-pip", base], check=True)
+        write(site_packages(base), "shared.py", "")
+        script = write(
+            path.join(base, "bin"), "where", "#!/usr/bin/env python\nimport sys, shared\nprint(sys.prefix)\n"
+        )
+        os.chmod(script, 0o755)
+        make_layer(base, layer, python=sys.executable)
+        assert layer_base(layer) == base and layer_base(base) is None
+        # The base's scripts and packages, run by the layer's interpreter
+        resp = subprocess.run([path.join(layer, "bin", "where")], stdout=subprocess.PIPE, check=True)
+        assert resp.stdout.decode("utf-8").strip() == layer
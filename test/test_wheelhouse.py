@@ -0,0 +1,21 @@
+import tempfile
+import unittest
+from os import path
+from autopyweb.wheelhouse import pinned
+
+
+class TestWheelhouse(unittest.TestCase):
+    def test_pinned(self):
+        assert pinned(["flask==2.0.1", "uvicorn[standard] == 0.15.0"])
+        assert not pinned(["flask"]) and not pinned(["flask>=2.0"]) and not pinned(["flask==2.*"])
+        assert not pinned(["flask==2.0.1", "gunicorn>=20.0.1,<20.99"])
+        assert not pinned(["--upgrade", "flask==2.0.1"]) and not pinned([])
+        location = tempfile.mkdtemp()
+        with open(path.join(location, "locked.txt"), "w") as f:
+            f.write("# locked\nclick==8.0.1 --hash=sha256:bb\n")
+            f.write("flask==2.0.1 ; python_version >= '3.6' \\\n    --hash=sha256:aa\n")
+        with open(path.join(location, "loose.txt"), "w") as f:
+            f.write("click==8.0.1\n-e git+https://example.com/app.git#egg=app\n")
+        assert pinned(["--require-hashes", "--no-deps", "-r", "locked.txt"], cwd=location)
+        assert not pinned(["-r", "loose.txt"], cwd=location)
+        assert not pinned(["-r", "missing.txt"], cwd=location)